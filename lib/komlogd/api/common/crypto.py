@@ -54,6 +54,16 @@ def serialize_public_key(key):
     )
     return b64encode(pem).decode()
 
+def deserialize_public_key(serialized):
+    '''
+    Returns the public key from its base64 serialization
+    '''
+    pubkey = serialization.load_ssh_public_key(
+        b64decode(serialized.encode('utf-8')),
+        backend=default_backend()
+    )
+    return pubkey
+
 def serialize_private_key(key):
     '''
     Returns the private key serialization in base64
@@ -110,6 +120,17 @@ def process_challenge(privkey, challenge):
     hashed = get_hash(plaintext)
     return b64encode(hashed).decode('utf-8')
 
+def solve_challenge(privkey, challenge):
+    '''
+    Returns the tuple (c, s) with the processed challenge and its signature.
+
+    Both operations are cpu bound, so this function is intended to be run
+    outside the event loop, in an executor.
+    '''
+    c = process_challenge(privkey, challenge)
+    s = sign_message(privkey, c)
+    return c, s
+
 def generate_rsa_key(key_size=4096):
     privkey = rsa.generate_private_key(
         public_exponent=65537,
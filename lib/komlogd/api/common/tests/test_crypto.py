@@ -158,6 +158,13 @@ class ApiCommonCryptoTest(unittest.TestCase):
         pubkey=privkey.public_key()
         self.assertIsNotNone(crypto.serialize_public_key(pubkey))
 
+    def test_deserialize_public_key_success(self):
+        ''' deserialize_public_key should return the public key serialized with serialize_public_key '''
+        privkey=crypto.generate_rsa_key()
+        pubkey=privkey.public_key()
+        serialized=crypto.serialize_public_key(pubkey)
+        self.assertEqual(crypto.deserialize_public_key(serialized).public_numbers(), pubkey.public_numbers())
+
     def test_serialize_private_key_failure_invalid_key(self):
         ''' serialize_private_key should fail if key parameter is not a valid public key '''
         key='invalid_key'
@@ -260,6 +267,14 @@ class ApiCommonCryptoTest(unittest.TestCase):
         with self.assertRaises(ValueError) as cm:
             crypto.process_challenge(privkey, challenge)
 
+    def test_solve_challenge_success(self):
+        ''' solve_challenge should return the processed challenge and its signature '''
+        privkey=crypto.generate_rsa_key()
+        challenge=b64encode(crypto.encrypt(privkey.public_key(), b'challenge')).decode()
+        c, s = crypto.solve_challenge(privkey, challenge)
+        self.assertEqual(c, crypto.process_challenge(privkey, challenge))
+        self.assertTrue(isinstance(s, str))
+
     def test_generate_rsa_key_success(self):
         ''' generate_rsa_key should return a RSAPrivateKey object with size 4096 '''
         privkey=crypto.generate_rsa_key()
@@ -1,4 +1,5 @@
 import decimal
+import threading
 import uuid
 import pandas as pd
 from copy import deepcopy
@@ -41,6 +42,12 @@ class Metric:
             h = hash((self._m_type_.value,self._get_std_uri(self.uri)))
         return h
 
+    def __getstate__(self):
+        # sessions are not sent to other processes
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
     def _get_std_uri(self, uri):
         e_uri = uri.split(':')
         if len(e_uri)>1:
@@ -90,8 +97,14 @@ class Metric:
         return await self.session.store.get(metric=self, *args, **kwargs)
 
     def insert(self, *args, **kwargs):
+        deferred = DeferredInserts.current()
+        if deferred != None:
+            return deferred.insert(metric=self, *args, **kwargs)
         return  self.session.store.insert(metric=self, *args, **kwargs)
 
+    def iter(self, *args, **kwargs):
+        return self.session.store.iter(metric=self, *args, **kwargs)
+
 class Datasource(Metric):
     _m_type_ = Metrics.DATASOURCE
 
@@ -173,4 +186,26 @@ class Sample:
         else:
             raise TypeError('Invalid Metric')
 
+class DeferredInserts:
+    '''
+    Collects the samples inserted by the current thread while active, so they can be
+    inserted later from the event loop. Used to run transfer methods in executors.
+    '''
+    _local = threading.local()
+
+    def __init__(self):
+        self.samples = []
+
+    def __enter__(self):
+        DeferredInserts._local.current = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        DeferredInserts._local.current = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'current', None)
 
+    def insert(self, metric, t, value):
+        self.samples.append(Sample(metric=metric, t=t, value=value))
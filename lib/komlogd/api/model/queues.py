@@ -1,38 +1,117 @@
 import asyncio
+import time
 import traceback
+from collections import deque, OrderedDict
 from komlogd.api.common import logging
+from komlogd.api.model.telemetry import Histogram
 
 class ExitMessage:
     pass
 
+class QueueItem:
+    WAITING = 0
+    READY = 1
+    RUNNING = 2
+
+    def __init__(self, args, kwargs, keys):
+        self.args = args
+        self.kwargs = kwargs
+        self.keys = keys
+        self.queued = time.monotonic()
+        self.state = QueueItem.WAITING
+
 class AsyncQueue:
-    def __init__(self, num_workers, on_msg, name, loop=None):
+    '''
+    Worker queue partitioned by the keys of each item, returned by the key function as
+    a single key or a list of them. Items sharing a key are processed one at a time in
+    arrival order, so an item with several keys waits for the previous items of every
+    one of them. Items without common keys, or without keys, are processed concurrently.
+    Workers are added, up to max_workers, while the backlog grows, and the extra ones
+    stop after idle_timeout seconds without items. If max_size is set, push waits while
+    the queue is full.
+    '''
+
+    def __init__(self, num_workers, on_msg, name, loop=None, key=None, max_size=0, max_workers=None, idle_timeout=30):
         loop = loop or asyncio.get_event_loop()
         self._loop = loop
         self._num_workers = num_workers
+        self._max_workers = max(max_workers or num_workers, num_workers)
+        self._idle_timeout = idle_timeout
         self._on_msg = on_msg
         self._name = name
-        self._queue = asyncio.Queue()
+        self._key = key
+        self._max_size = max_size
+        self._slots = asyncio.Semaphore(max_size) if max_size > 0 else None
+        # key -> items pending, the first one is processed or waiting for its other keys
+        self._partitions = {}
+        self._ready = asyncio.Queue()
+        self._running = 0
+        self._size = 0
+        self._unfinished = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
         self._workers = None
         self._timeout = 0
+        self.stats = {'pushed':0, 'processed':0, 'max_depth':0, 'max_workers':0}
+        self.latencies = {'wait':Histogram(), 'processing':Histogram()}
+
+    @property
+    def depth(self):
+        return self._size
+
+    @property
+    def num_workers(self):
+        return len(self._workers) if self._workers else 0
 
     def start(self):
         logging.logger.debug('Starting AsyncQueue {}'.format(self._name))
         assert self._workers is None
-        self._workers = [asyncio.ensure_future(self._worker_loop(i+1), loop=self._loop) for i in range(self._num_workers)]
+        self._workers = []
+        for i in range(self._num_workers):
+            self._add_worker(extra=False)
+
+    def _add_worker(self, extra):
+        instance = len(self._workers)+1
+        worker = asyncio.ensure_future(self._worker_loop(instance, extra), loop=self._loop)
+        self._workers.append(worker)
+        self.stats['max_workers'] = max(self.stats['max_workers'], len(self._workers))
+        worker.add_done_callback(self._worker_done)
 
-    async def _worker_loop(self, instance):
+    def _worker_done(self, worker):
+        if self._workers and worker in self._workers:
+            self._workers.remove(worker)
+
+    def _autoscale(self):
+        if self._workers is None:
+            return
+        backlog = self._ready.qsize()
+        if backlog > 0 and len(self._workers) < self._max_workers and backlog > len(self._workers)-self._running:
+            logging.logger.debug('Adding worker to {} queue. backlog: {}'.format(self._name, str(backlog)))
+            self._add_worker(extra=True)
+
+    async def _worker_loop(self, instance, extra=False):
         logging.logger.debug('Starting worker {}/{} on {} queue'.format(str(instance), str(self._num_workers), self._name))
         while True:
-            new_msg = False
             try:
-                item = await self._queue.get()
-                new_msg = True
-                if item.__class__ is ExitMessage:
-                    logging.logger.debug('Stopping worker {}/{} on {} queue'.format(str(instance), str(self._num_workers),self._name))
-                    break
-                args, kwargs = item
-                await asyncio.wait_for(self._on_msg(*args, **kwargs),self._timeout, loop=self._loop)
+                if extra:
+                    item = await asyncio.wait_for(self._ready.get(), self._idle_timeout, loop=self._loop)
+                else:
+                    item = await self._ready.get()
+            except asyncio.TimeoutError:
+                logging.logger.debug('Stopping idle worker {} on {} queue'.format(str(instance), self._name))
+                break
+            if item.__class__ is ExitMessage:
+                logging.logger.debug('Stopping worker {}/{} on {} queue'.format(str(instance), str(self._num_workers),self._name))
+                break
+            item.state = QueueItem.RUNNING
+            self._running += 1
+            self._size -= 1
+            if self._slots:
+                self._slots.release()
+            started = time.monotonic()
+            self.latencies['wait'].add(started-item.queued)
+            try:
+                await asyncio.wait_for(self._on_msg(*item.args, **item.kwargs),self._timeout, loop=self._loop)
             except (KeyboardInterrupt, MemoryError, SystemExit):
                 ex_info=traceback.format_exc().splitlines()
                 for line in ex_info:
@@ -43,16 +122,23 @@ class AsyncQueue:
                 for line in ex_info:
                     logging.logger.error(line)
             finally:
-                if new_msg:
-                    self._queue.task_done()
+                self.latencies['processing'].add(time.monotonic()-started)
+                self.stats['processed'] += 1
+                self._running -= 1
+                self._done(item)
+                self._unfinished -= 1
+                if self._unfinished == 0:
+                    self._drained.set()
 
     async def join(self):
         if not self._workers:
             return
-        for _ in range(self._num_workers):
-            await self._queue.put(ExitMessage())
+        await self._drained.wait()
+        workers = list(self._workers)
+        for _ in workers:
+            await self._ready.put(ExitMessage())
         try:
-            await asyncio.gather(*self._workers, loop=self._loop)
+            await asyncio.gather(*workers, loop=self._loop)
             self._workers = None
         except:
             ex_info=traceback.format_exc().splitlines()
@@ -62,7 +148,41 @@ class AsyncQueue:
         finally:
             logging.logger.debug('Exiting AsyncQueue {}'.format(self._name))
 
+    def _is_first(self, item):
+        return all(self._partitions[key][0] is item for key in item.keys)
+
+    def _done(self, item):
+        ''' removes the item from its partitions, and queues the next items if they are ready '''
+        for key in item.keys:
+            partition = self._partitions[key]
+            partition.popleft()
+            if not partition:
+                del self._partitions[key]
+        for key in item.keys:
+            partition = self._partitions.get(key, None)
+            if partition and partition[0].state == QueueItem.WAITING and self._is_first(partition[0]):
+                partition[0].state = QueueItem.READY
+                self._ready.put_nowait(partition[0])
+
     async def push(self, *args,**kwargs):
-        await self._queue.put((args,kwargs))
+        if self._slots:
+            await self._slots.acquire()
+        keys = self._key(*args, **kwargs) if self._key else None
+        if keys is None:
+            keys = ()
+        elif not isinstance(keys, (list, tuple, set, frozenset)):
+            keys = (keys,)
+        item = QueueItem(args, kwargs, tuple(OrderedDict.fromkeys(keys)))
+        for key in item.keys:
+            self._partitions.setdefault(key, deque()).append(item)
+        if self._is_first(item):
+            item.state = QueueItem.READY
+            self._ready.put_nowait(item)
+        self._size += 1
+        self._unfinished += 1
+        self._drained.clear()
+        self.stats['pushed'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self._size)
+        self._autoscale()
         return None
 
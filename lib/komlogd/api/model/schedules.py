@@ -1,4 +1,6 @@
+import calendar
 import inspect
+import time
 from komlogd.api.common import exceptions
 from komlogd.api.model.metrics import Metric
 
@@ -69,15 +71,29 @@ class OnUpdateSchedule(Schedule):
         return metrics
 
 class CronSchedule(Schedule):
-    def __init__(self, minute='*', hour='*', month='*', dow='*', dom='*', exec_on_load=False):
+    def __init__(self, minute='*', hour='*', month='*', dow='*', dom='*', exec_on_load=False, second='0'):
         super().__init__(exec_on_load=exec_on_load)
+        # every field is compiled to a bitmask, bit i set if value i matches
         self._schedule={}
+        self.second = second
         self.minute = minute
         self.hour = hour
         self.month = month
         self.dow = dow
         self.dom = dom
 
+    @property
+    def second(self):
+        return self._second
+
+    @second.setter
+    def second(self, value):
+        try:
+            self._schedule['second'] = self._compile(self._process_var(value, 59, 0))
+            self._second = value
+        except (TypeError, AttributeError):
+            raise exceptions.BadParametersException('Invalid second value: '+str(value))
+
     @property
     def minute(self):
         return self._minute
@@ -85,7 +101,7 @@ class CronSchedule(Schedule):
     @minute.setter
     def minute(self, value):
         try:
-            self._schedule['minute'] = self._process_var(value, 59, 0)
+            self._schedule['minute'] = self._compile(self._process_var(value, 59, 0))
             self._minute = value
         except (TypeError, AttributeError):
             raise exceptions.BadParametersException('Invalid minute value: '+str(value))
@@ -97,7 +113,7 @@ class CronSchedule(Schedule):
     @hour.setter
     def hour(self, value):
         try:
-            self._schedule['hour'] = self._process_var(value, 23, 0)
+            self._schedule['hour'] = self._compile(self._process_var(value, 23, 0))
             self._hour = value
         except (TypeError, AttributeError):
             raise exceptions.BadParametersException('Invalid hour value: '+str(value))
@@ -109,7 +125,7 @@ class CronSchedule(Schedule):
     @month.setter
     def month(self, value):
         try:
-            self._schedule['month'] = self._process_var(value, 12, 1)
+            self._schedule['month'] = self._compile(self._process_var(value, 12, 1))
             self._month = value
         except (TypeError, AttributeError):
             raise exceptions.BadParametersException('Invalid month value: '+str(value))
@@ -121,7 +137,7 @@ class CronSchedule(Schedule):
     @dow.setter
     def dow(self, value):
         try:
-            self._schedule['dow'] = self._process_var(value, 6, 0)
+            self._schedule['dow'] = self._compile(self._process_var(value, 6, 0))
             self._dow = value
         except (TypeError, AttributeError):
             raise exceptions.BadParametersException('Invalid dow value: '+str(value))
@@ -133,7 +149,7 @@ class CronSchedule(Schedule):
     @dom.setter
     def dom(self, value):
         try:
-            self._schedule['dom'] = self._process_var(value, 31, 1)
+            self._schedule['dom'] = self._compile(self._process_var(value, 31, 1))
             self._dom = value
         except (TypeError, AttributeError):
             raise exceptions.BadParametersException('Invalid dom value: '+str(value))
@@ -182,17 +198,79 @@ class CronSchedule(Schedule):
         result_list=list(set(processed_entry))
         return result_list
 
+    def _compile(self, values):
+        mask = 0
+        for value in values:
+            mask |= 1 << value
+        return mask
+
+    def _next_value(self, field, value):
+        ''' Returns the first value of the field greater or equal than value, or None '''
+        mask = self._schedule[field] >> value << value
+        if mask == 0:
+            return None
+        return (mask & -mask).bit_length()-1
+
     def meets(self, t):
-        minute = t.tm_min
-        hour = t.tm_hour
-        month = t.tm_mon
-        dow = t.tm_wday
-        dom = t.tm_mday
-        if (minute in self._schedule['minute'] and
-           hour in self._schedule['hour'] and
-           month in self._schedule['month'] and
-           dow in self._schedule['dow'] and
-           dom in self._schedule['dom']):
+        ''' Checks the struct_time against the schedule. Seconds are not checked. '''
+        if ((self._schedule['minute'] >> t.tm_min) & 1 and
+           (self._schedule['hour'] >> t.tm_hour) & 1 and
+           (self._schedule['month'] >> t.tm_mon) & 1 and
+           (self._schedule['dow'] >> t.tm_wday) & 1 and
+           (self._schedule['dom'] >> t.tm_mday) & 1):
             return True
         return False
 
+    def next_after(self, t, max_years=28):
+        '''
+        Returns the timestamp of the first instant after t, in local time, that meets the schedule.
+        Returns None if the schedule does not meet any date in the next max_years.
+        '''
+        lt = time.localtime(int(t))
+        year, month, day, hour, minute, second = lt[:6]
+        second += 1
+        while year <= lt.tm_year + max_years:
+            if second > 59:
+                second, minute = 0, minute+1
+            if minute > 59:
+                minute, hour = 0, hour+1
+            if hour > 23:
+                hour, day = 0, day+1
+            if day > calendar.monthrange(year, month)[1]:
+                day, month = 1, month+1
+            if month > 12:
+                month, year = 1, year+1
+                continue
+            next_month = self._next_value('month', month)
+            if next_month == None:
+                year, month, day, hour, minute, second = year+1, 1, 1, 0, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute, second = next_month, 1, 0, 0, 0
+                continue
+            if not ((self._schedule['dom'] >> day) & 1 and (self._schedule['dow'] >> calendar.weekday(year, month, day)) & 1):
+                day, hour, minute, second = day+1, 0, 0, 0
+                continue
+            next_hour = self._next_value('hour', hour)
+            if next_hour == None:
+                day, hour, minute, second = day+1, 0, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute, second = next_hour, 0, 0
+            next_minute = self._next_value('minute', minute)
+            if next_minute == None:
+                hour, minute, second = hour+1, 0, 0
+                continue
+            if next_minute != minute:
+                minute, second = next_minute, 0
+            next_second = self._next_value('second', second)
+            if next_second == None:
+                minute, second = minute+1, 0
+                continue
+            ts = time.mktime((year, month, day, hour, minute, next_second, 0, 0, -1))
+            if ts > t:
+                return ts
+            # local time repeated or skipped by a DST change
+            second = next_second+1
+        return None
+
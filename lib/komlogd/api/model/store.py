@@ -8,51 +8,166 @@ import asyncio
 import time
 import decimal
 import pandas as pd
+from collections import OrderedDict
 from komlogd.api.common import exceptions, logging, timeuuid
 from komlogd.api.protocol import validation
 from komlogd.api.protocol.processing import procedure as prproc
+from komlogd.api.model import transactions
 from komlogd.api.model.metrics import Datasource, Sample
 
+# approximate size of a row in a data interval frame: the t in hex and a short value
+ROW_BYTES = 48
+
+def to_store_value(value):
+    ''' Decimal values are stored as int or float '''
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value%1 == 0 else float(value)
+    return value
 
 class MetricStore:
 
-    def __init__(self):
+    def __init__(self, readahead=2, negative_ttl=60, gc_threshold=1000, commit_window=0):
+        self.readahead = readahead
+        self.negative_ttl = negative_ttl
+        self.gc_threshold = gc_threshold
+        self.commit_window = commit_window
         self._dfs = {}
         self._synced_ranges = {}
         self._tr_dfs = {}
         self._tr_synced_ranges = {}
         self._hooked = set()
+        self._pinned = {}
+        self._hook_results = {}
+        self._hooking = {}
+        self._inflight = {}
+        self._last_access = {}
+        self._prefetching = {}
+        self._empty = {}
+        self._unknown = {}
+        self._gaps = {}
+        self._windows = {}
         self._metrics_info = {}
+        self._appended = {}
+        self._commit_groups = {}
+        self.stats = {'gc_versions':0, 'group_commits':0, 'grouped_transactions':0, 'requests':0, 'coalesced':0, 'coalesced_rows':0, 'coalesced_bytes':0,
+            'prefetches':0, 'prefetch_hits':0, 'prefetch_misses':0, 'negative_hits':0}
 
     async def sync(self):
         if getattr(self, '_prev_hooked', False):
-            for metric in self._prev_hooked:
-                resp = await self.hook(metric)
-                if resp['hooked'] == False:
-                    return False
+            results = await self.hook_many(self._prev_hooked)
+            filled = await self._fill_gaps([m for m,resp in results.items() if resp['hooked'] and resp['exists']])
+            if not filled or any(resp['hooked'] == False for resp in results.values()):
+                # gaps not filled are requested again in the next sync
+                return False
             del self._prev_hooked
         return True
 
+    def disconnected(self, metrics=None):
+        '''
+        Called when the connection is lost. Data and synced ranges are kept, but hooked
+        metrics stop being synced from their last sample seen. That gap is requested
+        again once the metric is hooked back in sync(). If metrics is passed, only
+        those are affected, the rest stay hooked.
+        '''
+        now = timeuuid.TimeUUID(lowest=True)
+        lost = set(self._hooked) if metrics is None else self._hooked.intersection(metrics)
+        for metric in lost:
+            df = self._dfs.get(metric, None)
+            if isinstance(df, pd.DataFrame) and not df.empty:
+                last = df.t.max()
+                its = last if last < now else now
+            else:
+                its = now
+            self._gaps.setdefault(metric, its)
+            self._cut_synced_ranges(metric, its)
+            if not getattr(self, '_prev_hooked',False):
+                self._prev_hooked = set()
+            self._prev_hooked.add(metric)
+            # pushed data may be lost while disconnected
+            self._unknown.pop(metric, None)
+            its = self._gaps[metric]
+            empty = [r for r in self._empty.get(metric, []) if r['ets'] <= its]
+            if empty:
+                self._empty[metric] = empty
+            else:
+                self._empty.pop(metric, None)
+            self._hooked.discard(metric)
+            self._hook_results.pop(metric, None)
+        if metrics is None:
+            self._unknown = {}
+
+    def _cut_synced_ranges(self, metric, t):
+        ''' synced ranges of the metric are cut at t '''
+        def cut(ranges):
+            return [r if r['ets'] <= t else {'t':r['t'], 'its':r['its'], 'ets':t} for r in ranges if r['its'] < t]
+        if metric in self._synced_ranges:
+            self._synced_ranges[metric] = cut(self._synced_ranges[metric])
+        for ranges in self._tr_synced_ranges.values():
+            if metric in ranges:
+                ranges[metric] = cut(ranges[metric])
+
+    async def _fill_gaps(self, metrics, max_concurrency=50):
+        ''' requests the data of the metrics from their disconnection gap until now '''
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def fill(metric, its):
+            success = True
+            async with semaphore:
+                ets = timeuuid.TimeUUID(highest=True)
+                for r in self._get_requestable_ranges(metric, its=its, ets=ets, count=None):
+                    resp = await self._request_data_range(metric, r['its'], r['ets'], None)
+                    success = success and resp['success']
+            if success:
+                self._gaps.pop(metric, None)
+            return success
+        gaps = [(metric, self._gaps[metric]) for metric in metrics if metric in self._gaps]
+        results = await asyncio.gather(*[fill(metric, its) for metric, its in gaps])
+        return all(results)
+
     def clear_synced(self):
         self._synced_ranges = {}
         self._tr_synced_ranges = {}
+        self._empty = {}
+        self._unknown = {}
+        self._gaps = {}
         for metric in self._hooked:
             if not getattr(self, '_prev_hooked',False):
                 self._prev_hooked = set()
             self._prev_hooked.add(metric)
         self._hooked = set()
+        self._hook_results = {}
+
+    def add_window(self, window):
+        ''' the window will receive every sample of its metric stored from now on '''
+        self._windows.setdefault(window.metric, set()).add(window)
+
+    def remove_window(self, window):
+        windows = self._windows.get(window.metric, None)
+        if windows != None:
+            windows.discard(window)
+            if not windows:
+                del self._windows[window.metric]
 
     def insert(self, metric, t, value):
         sample = Sample(metric=metric, t=t, value=value)
-        tr = asyncio.Task.current_task().get_tr()
+        tr = transactions.get_tr()
         if tr:
             tid = tr.tid
             self._store(sample.metric, sample.t, sample.value, tm=time.monotonic(), op='i', tid=tid)
             tr.add_dirty_item(self)
         else:
             self._store(sample.metric, sample.t, sample.value, tm=time.monotonic())
+            self.invalidate_negative(sample.metric, sample.t)
 
     async def get(self, metric, t=None, start=None, end=None, count=None):
+        started = time.monotonic()
+        try:
+            return await self._get(metric, t=t, start=start, end=end, count=count)
+        finally:
+            tr = transactions.get_tr()
+            if tr:
+                tr.fetch_time += time.monotonic()-started
+
+    async def _get(self, metric, t=None, start=None, end=None, count=None):
         if t != None:
             its = t
             ets = t
@@ -63,18 +178,200 @@ class MetricStore:
         else:
             its = start
             ets = end
+        bounded = t == None and count == None
+        if bounded:
+            prefetched = await self._wait_prefetch(metric, its, ets)
         total_regs = 0
-        for r in self._get_missing_ranges(metric, its=its, ets=ets, count=count):
+        for r in self._get_requestable_ranges(metric, its=its, ets=ets, count=count):
             resp = await self._request_data_range(metric, r['its'], r['ets'], count)
             if count:
                 total_regs += resp['count']
                 if count <= total_regs:
                     break
+        if bounded:
+            self._read_ahead(metric, its, ets, prefetched)
         return self._get_metric_data(metric, its, ets, count)
 
+    async def _wait_prefetch(self, metric, its, ets):
+        ''' waits for the prefetch covering the interval, if any. Returns True if the interval was prefetched '''
+        tr = transactions.get_tr()
+        prefetch = self._prefetching.get((metric, tr.tid if tr else None), None)
+        if prefetch and prefetch['its'] <= its and prefetch['ets'] >= ets:
+            try:
+                await asyncio.shield(prefetch['task'])
+            except (asyncio.CancelledError, Exception):
+                return False
+            return True
+        return False
+
+    def _read_ahead(self, metric, its, ets, prefetched):
+        '''
+        Detects sequential scans of consecutive windows and requests the next
+        readahead windows in background.
+        '''
+        tr = transactions.get_tr()
+        tid = tr.tid if tr else None
+        if tr:
+            # access history and prefetches of the transaction are released on discard
+            tr.add_dirty_item(self)
+        key = (metric, tid)
+        last = self._last_access.get(key, None)
+        self._last_access[key] = (its, ets)
+        if prefetched:
+            self.stats['prefetch_hits'] += 1
+        if last is None or self.readahead < 1 or (tid is None and metric not in self._hooked):
+            return
+        width = ets.timestamp - its.timestamp
+        if width <= 0:
+            return
+        if 0 <= its.timestamp - last[1].timestamp <= width:
+            # forward scan. next window is [ets, ets+width]
+            next_window = (ets.timestamp, ets.timestamp + width)
+            p_its = timeuuid.TimeUUID(t=ets.timestamp, lowest=True)
+            p_ets = timeuuid.TimeUUID(t=min(ets.timestamp + width*self.readahead, time.time()), highest=True)
+        elif 0 <= last[0].timestamp - ets.timestamp <= width:
+            # backward scan. next window is [its-width, its]
+            next_window = (its.timestamp - width, its.timestamp)
+            p_its = timeuuid.TimeUUID(t=max(its.timestamp - width*self.readahead, 0), lowest=True)
+            p_ets = timeuuid.TimeUUID(t=its.timestamp, highest=True)
+        else:
+            return
+        if not prefetched:
+            self.stats['prefetch_misses'] += 1
+        prefetch = self._prefetching.get(key, None)
+        if prefetch and prefetch['its'].timestamp <= next_window[0] and prefetch['ets'].timestamp >= min(next_window[1], time.time()):
+            # next window still prefetched by the previous request
+            return
+        if p_its >= p_ets:
+            return
+        self.stats['prefetches'] += 1
+        task = asyncio.ensure_future(self._prefetch(metric, p_its, p_ets))
+        self._prefetching[key] = {'its':p_its, 'ets':p_ets, 'task':task}
+
+    async def _prefetch(self, metric, its, ets):
+        for r in self._get_requestable_ranges(metric, its=its, ets=ets, count=None):
+            await self._request_data_range(metric, r['its'], r['ets'], None)
+
+    def _get_requestable_ranges(self, metric, its, ets, count):
+        ''' Returns the missing ranges, except those known to be empty or belonging to unknown metrics '''
+        now = time.monotonic()
+        unknown = self._unknown.get(metric, None)
+        if unknown != None:
+            if unknown > now:
+                self.stats['negative_hits'] += 1
+                return []
+            self._unknown.pop(metric)
+        missing = self._get_missing_ranges(metric, its=its, ets=ets, count=count)
+        empty = [r for r in self._empty.get(metric, []) if r['expires'] > now]
+        if not empty:
+            self._empty.pop(metric, None)
+            return missing
+        self._empty[metric] = empty
+        requestable = []
+        for miss in missing:
+            if miss['its'] == None or miss['ets'] == None:
+                requestable.append(miss)
+                continue
+            pending = [miss]
+            for r in empty:
+                remaining = []
+                for p in pending:
+                    if r['ets'] <= p['its'] or r['its'] >= p['ets']:
+                        remaining.append(p)
+                        continue
+                    if p['its'] < r['its']:
+                        remaining.append({'its':p['its'], 'ets':r['its']})
+                    if r['ets'] < p['ets']:
+                        remaining.append({'its':r['ets'], 'ets':p['ets']})
+                pending = remaining
+            if pending != [miss]:
+                self.stats['negative_hits'] += 1
+            requestable.extend(pending)
+        return requestable
+
+    def _add_empty_range(self, metric, its, ets):
+        if self.negative_ttl <= 0:
+            return
+        self._empty.setdefault(metric, []).append({'its':its, 'ets':ets, 'expires':time.monotonic()+self.negative_ttl})
+
+    def invalidate_negative(self, metric, t):
+        ''' Forgets the empty intervals containing t and the unknown state of the metric '''
+        self._unknown.pop(metric, None)
+        empty = self._empty.get(metric, None)
+        if empty:
+            empty = [r for r in empty if not r['its'] <= t <= r['ets']]
+            if empty:
+                self._empty[metric] = empty
+            else:
+                self._empty.pop(metric)
+
+    def iter(self, metric, start=None, end=None, count=None):
+        '''
+        Returns an async iterator over the data of the interval requested, as it is received from Komlog.
+        Each chunk is returned as a pandas Series. Chunks of hooked metrics, or read inside a transaction,
+        are stored like any other read; otherwise they are only returned, so memory is bounded by the
+        chunks the consumer keeps.
+        '''
+        if start == None and end == None:
+            raise ValueError('You must set at least start or end')
+        elif (start == None or end == None) and count == None:
+            raise ValueError('count parameter must be set if you leave interval open')
+        return MetricStoreIterator(store=self, metric=metric, start=start, end=end, count=count)
+
     async def _request_data_range(self, metric, its, ets, count):
-        response = await prproc.request_data(metric, its, ets, count)
-        tr = asyncio.Task.current_task().get_tr()
+        response = await self._request_data(metric, its, ets, count)
+        d = response['data']
+        tid = self._store_requested_data(metric, d)
+        if response['success'] and len(d) == 0 and its != None and ets != None:
+            self._add_empty_range(metric, its, ets)
+        if len(d) > 0:
+            first, last = min(r[0] for r in d), max(r[0] for r in d)
+        else:
+            first, last = None, None
+        if response['success']:
+            # a failed request may have lost part of the interval, it is not synced
+            self._add_requested_range(metric, its, ets, count, len(d), first, last, tid)
+        return {'count':len(d), 'success':response['success']}
+
+    async def _request_data(self, metric, its, ets, count):
+        '''
+        Requests the data interval to Komlog. If a concurrent request of the same metric
+        covers the interval, its response is shared instead of sending a new request.
+        '''
+        req = self._shared_request(metric, its, ets, count)
+        if req:
+            response = await asyncio.shield(req['task'])
+            data = [r for r in response['data'] if its <= r[0] <= ets] if count == None else response['data']
+            self.stats['coalesced'] += 1
+            self.stats['coalesced_rows'] += len(data)
+            self.stats['coalesced_bytes'] += len(data)*ROW_BYTES
+            return {'success':response['success'], 'data':data, 'error':response['error']}
+        task = asyncio.ensure_future(prproc.request_data(metric, its, ets, count))
+        req = {'its':its, 'ets':ets, 'count':count, 'task':task}
+        self._inflight.setdefault(metric, []).append(req)
+        self.stats['requests'] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            reqs = self._inflight.get(metric, [])
+            if req in reqs:
+                reqs.remove(req)
+            if not reqs:
+                self._inflight.pop(metric, None)
+
+    def _shared_request(self, metric, its, ets, count):
+        ''' Returns the request in flight whose response covers the interval, if any '''
+        for req in self._inflight.get(metric, []):
+            if count == None and req['count'] == None:
+                shared = req['its'] <= its and req['ets'] >= ets
+            else:
+                shared = (req['its'], req['ets'], req['count']) == (its, ets, count)
+            if shared:
+                return req
+        return None
+
+    def _store_requested_data(self, metric, d):
+        tr = transactions.get_tr()
         if tr:
             tr.add_dirty_item(self)
             tid = tr.tid
@@ -82,33 +379,31 @@ class MetricStore:
         else:
             tid = None
             op = None
-        d = response['data']
         for r in d:
             sample = Sample(metric, r[0], r[1])
             self._store(sample.metric, sample.t, sample.value, tm=time.monotonic(), op=op, tid=tid)
-        if count != None and count > 0 and len(d) == count:
-            its = min(r[0] for r in d)
-            ets = max(r[0] for r in d)
+        return tid
+
+    def _add_requested_range(self, metric, its, ets, count, num_rows, first, last, tid):
+        if count != None and count > 0 and num_rows == count:
+            its = first
+            ets = last
         else:
             if its == None:
-                if len(d) > 0 and count == None:
-                    its = min(r[0] for r in d)
+                if num_rows > 0 and count == None:
+                    its = first
                 else:
                     its = timeuuid.MIN_TIMEUUID
             if ets == None:
-                if len(d) > 0 and count == None:
-                    ets = max(r[0] for r in d)
+                if num_rows > 0 and count == None:
+                    ets = last
                 else:
                     ets = timeuuid.MAX_TIMEUUID
         if its and ets:
             self._add_synced_range(metric, time.monotonic(), its, ets, tid)
-        return {'count':len(d)}
 
     def _store(self, metric, t, value, tm, op=None, tid=None):
-        if isinstance(value, decimal.Decimal):
-            tmp_value = int(value) if value%1 == 0 else float(value)
-        else:
-            tmp_value = value
+        tmp_value = to_store_value(value)
         if tid:
             dfs = self._tr_dfs.get(tid, None)
             if dfs == None:
@@ -124,7 +419,17 @@ class MetricStore:
             if not isinstance(df, pd.DataFrame):
                 df = pd.DataFrame(columns=['t','value'])
                 self._dfs[metric] = df
+            elif not df.empty and df.index[-1] >= tm:
+                # rows are versions of the data, their tm must be increasing
+                tm = df.index[-1] + 1e-6
             df.loc[tm]=[t, tmp_value]
+            appended = self._appended.get(metric, 0) + 1
+            if appended >= self.gc_threshold:
+                self._gc_metric(metric)
+                appended = 0
+            self._appended[metric] = appended
+            for window in self._windows.get(metric, []):
+                window.append(t, value)
 
     def _get_missing_ranges(self, metric, its, ets, count):
         def get_missing_open_interval(ranges):
@@ -223,7 +528,7 @@ class MetricStore:
                 if missing == loop_missing:
                     return missing
                 missing = loop_missing
-        tr = asyncio.Task.current_task().get_tr()
+        tr = transactions.get_tr()
         if tr:
             ranges = self._tr_synced_ranges.get(tr.tid,None)
             if ranges == None:
@@ -285,7 +590,7 @@ class MetricStore:
                 new_range = {'t':t,'its':its,'ets':ets}
                 new_ranges = add_new_range(new_range, m_ranges)
                 ranges[metric] = new_ranges
-        elif metric in self._hooked:
+        elif metric in self._hooked or metric in self._pinned:
             ranges = self._synced_ranges.get(metric, [])
             new_range = {'t':t, 'its':its, 'ets':ets}
             new_ranges = add_new_range(new_range, ranges)
@@ -300,7 +605,7 @@ class MetricStore:
             ascending = False
         else:
             ascending = True
-        tr = asyncio.Task.current_task().get_tr()
+        tr = transactions.get_tr()
         if tr:
             # get transaction dataframe if exists
             tid = tr.tid
@@ -313,8 +618,11 @@ class MetricStore:
             tr_df = None
         df = self._dfs.get(metric, None)
         have_df, have_tr_df = isinstance(df, pd.DataFrame), isinstance(tr_df, pd.DataFrame)
+        if have_df and tr:
+            # versions are appended in tm order, so the snapshot of the transaction is a prefix
+            df = df.iloc[:df.index.searchsorted(tr.tm, side='right')]
         if have_df and have_tr_df:
-            df = df[(df.index<=tr.tm) & (df.t.between(its,ets))][['t','value']]
+            df = df[df.t.between(its,ets)][['t','value']]
             tr_df = tr_df[tr_df.t.between(its,ets)][['t','value']]
             # in concat, tr_df at the end, because its index will always be higher. No need to sort it.
             join_df = pd.concat([df,tr_df])
@@ -334,18 +642,84 @@ class MetricStore:
                 return s.iloc[-count:]
             return s
 
+    def gc(self):
+        ''' Removes the versions of the data that no transaction can read anymore '''
+        return sum(self._gc_metric(metric) for metric in list(self._dfs.keys()))
+
+    def _gc_metric(self, metric):
+        '''
+        A version of a sample is garbage once a newer version of it is visible to the
+        oldest transaction not finished, and so to every reader.
+        '''
+        df = self._dfs.get(metric, None)
+        if not isinstance(df, pd.DataFrame) or df.empty:
+            return 0
+        horizon = transactions.oldest_snapshot()
+        end = len(df) if horizon is None else df.index.searchsorted(horizon, side='right')
+        dead = df.t.iloc[:end].duplicated(keep='last')
+        num_dead = int(dead.sum())
+        if num_dead > 0:
+            self._dfs[metric] = df.drop(df.index[:end][dead.values])
+            self.stats['gc_versions'] += num_dead
+        return num_dead
+
     async def hook(self, metric):
+        ''' hooks the metric. Already hooked metrics are not hooked again, and concurrent calls share the same request '''
+        if metric in self._hooked and metric in self._hook_results:
+            return dict(self._hook_results[metric])
+        task = self._hooking.get(metric, None)
+        if task is None:
+            task = asyncio.ensure_future(self._hook(metric))
+            self._hooking[metric] = task
+            task.add_done_callback(lambda f: self._hooking.pop(metric, None))
+        result = await asyncio.shield(task)
+        return dict(result)
+
+    async def _hook(self, metric):
         result = await prproc.hook_to_metric(metric)
         if result['hooked']:
             self._hooked.add(metric)
             if result['exists']:
+                self._unknown.pop(metric, None)
                 #sync future
                 now = timeuuid.TimeUUID()
                 await self.get(metric, start=now, end=timeuuid.MAX_TIMEUUID, count=200)
             else:
                 self._add_synced_range(metric, t=time.monotonic(), its=timeuuid.MIN_TIMEUUID, ets=timeuuid.MAX_TIMEUUID)
+                if self.negative_ttl > 0:
+                    self._unknown[metric] = time.monotonic()+self.negative_ttl
+            self._hook_results[metric] = result
         return result
 
+    async def hook_many(self, metrics, max_concurrency=50):
+        ''' hooks the metrics concurrently, at most max_concurrency at a time. Returns the result by metric '''
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def hook_one(metric):
+            async with semaphore:
+                return await self.hook(metric)
+        metrics = list(OrderedDict.fromkeys(metrics))
+        results = await asyncio.gather(*[hook_one(metric) for metric in metrics])
+        return OrderedDict(zip(metrics, results))
+
+    def pin(self, metrics):
+        '''
+        The ranges requested of pinned metrics are kept as synced, like those of hooked metrics,
+        until they are unpinned. Used to serve historical intervals requested once from the store.
+        '''
+        for metric in metrics:
+            self._pinned[metric] = self._pinned.get(metric, 0) + 1
+
+    def unpin(self, metrics):
+        for metric in metrics:
+            pins = self._pinned.get(metric, 0) - 1
+            if pins > 0:
+                self._pinned[metric] = pins
+                continue
+            self._pinned.pop(metric, None)
+            if metric not in self._hooked:
+                # not pushed to us, so their ranges would get stale
+                self._synced_ranges.pop(metric, None)
+
     def is_in(self, metric, t, value):
         ''' Returns False if tuple (metric,t,value) is not found. Only checks the last value '''
         if not metric in self._dfs:
@@ -354,10 +728,7 @@ class MetricStore:
         if not t in df.t.values:
             return False
         else:
-            if isinstance(value, decimal.Decimal):
-                tmp_value = int(value) if value%1 == 0 else float(value)
-            else:
-                tmp_value = value
+            tmp_value = to_store_value(value)
             smpls = df[df.t == t]
             if not smpls.value.values[-1] == tmp_value:
                 return False
@@ -375,27 +746,41 @@ class MetricStore:
             return True
         return False
 
-    async def _tr_commit(self, tr):
+    def _tr_inserted_samples(self, tr):
+        ''' Returns the last sample inserted in the transaction for each metric and t '''
         i_samples = []
-        g_samples = []
         for metric, df in self._tr_dfs.get(tr.tid, {}).items():
             i_smpls = df[df.op == 'i']
             i_smpls = i_smpls[~i_smpls.t.duplicated(keep='last')]
             for index, row in i_smpls.iterrows():
                 i_samples.append(Sample(metric=metric, t=row.t, value=row.value_orig))
+        return i_samples
+
+    async def _tr_commit(self, tr):
+        i_samples = self._tr_inserted_samples(tr)
+        g_samples = []
+        for metric, df in self._tr_dfs.get(tr.tid, {}).items():
             g_smpls = df[df['op'] == 'g']
             g_smpls = g_smpls[~g_smpls.t.duplicated(keep='last')]
             if metric in self._hooked:
                 for index, row in g_smpls.iterrows():
                     g_samples.append((index,Sample(metric=metric, t=row.t, value=row.value)))
         for t,sample in g_samples:
-            self._store(metric=sample.metric, t=sample.t, value=sample.value,tm=index)
+            self._store(metric=sample.metric, t=sample.t, value=sample.value, tm=time.monotonic())
         for metric, ranges in self._tr_synced_ranges.get(tr.tid, {}).items():
             if metric in self._hooked:
                 for r in ranges:
                     self._add_synced_range(metric, r['t'], r['its'], r['ets'])
         if len(i_samples) > 0:
-            await prproc.send_samples(i_samples, irt=tr.irt)
+            result = await self._group_commit(i_samples, irt=tr.irt)
+            failed = set()
+            for error in result['errors']:
+                logging.logger.error('Transaction {}. Error sending samples: {}'.format(tr.tid.hex, error['error']))
+                failed.update(self._error_keys(error))
+            # samples rejected are not committed, they are neither stored nor propagated downstream
+            tr.committed.extend(s for s in i_samples if (s.metric.uri, s.t) not in failed)
+            for sample in i_samples:
+                self.invalidate_negative(sample.metric, sample.t)
             items = [s.metric for s in i_samples if isinstance(s.metric, Datasource) and s.metric.supplies != None]
             info_metrics = set()
             for m in items:
@@ -410,7 +795,180 @@ class MetricStore:
                     except KeyError:
                         self._metrics_info[m] = {'supplies':sorted(m.supplies)}
 
+    async def _group_commit(self, samples, irt):
+        '''
+        Samples commited with the same irt within commit_window seconds are sent together,
+        so samples with the same t go in the same message. Grouping is disabled by default,
+        since every commit waits for the window. Returns the result of sending the samples
+        of this commit.
+        '''
+        if self.commit_window <= 0:
+            response = await prproc.send_samples(samples, irt=irt)
+            return {'success':response['success'], 'errors':response.get('errors', [])}
+        group = self._commit_groups.get(irt, None)
+        if group is None:
+            group = {'commits':[]}
+            self._commit_groups[irt] = group
+            asyncio.ensure_future(self._send_commit_group(irt, group))
+        future = asyncio.Future()
+        group['commits'].append((samples, future))
+        return await future
+
+    async def _send_commit_group(self, irt, group):
+        await asyncio.sleep(self.commit_window)
+        self._commit_groups.pop(irt, None)
+        commits = [(samples, future) for samples, future in group['commits'] if not future.cancelled()]
+        if not commits:
+            return
+        merged = OrderedDict()
+        for samples, future in commits:
+            for sample in samples:
+                # on the same metric and t, the last commit wins
+                merged.pop((sample.metric, sample.t), None)
+                merged[(sample.metric, sample.t)] = sample
+        self.stats['group_commits'] += 1
+        self.stats['grouped_transactions'] += len(commits)
+        try:
+            response = await prproc.send_samples(list(merged.values()), irt=irt)
+        except Exception as e:
+            for samples, future in commits:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        errors = [(self._error_keys(error), error) for error in response.get('errors', [])]
+        for samples, future in commits:
+            if future.done():
+                continue
+            keys = {(sample.metric.uri, sample.t) for sample in samples}
+            own = [error for error_keys, error in errors if not error_keys.isdisjoint(keys)]
+            future.set_result({'success':len(own) == 0, 'errors':own})
+
+    def _error_keys(self, error):
+        ''' Returns the (uri, t) of the samples of the message that failed '''
+        msg = error['msg']
+        uris = [item['uri'] for item in msg.uris] if hasattr(msg, 'uris') else [msg.uri]
+        return {(uri, msg.t) for uri in uris}
+
     def _tr_discard(self, tr):
         self._tr_dfs.pop(tr.tid, None)
         self._tr_synced_ranges.pop(tr.tid, None)
+        for key in [key for key in self._prefetching.keys() if key[1] == tr.tid]:
+            self._prefetching.pop(key)['task'].cancel()
+        for key in [key for key in self._last_access.keys() if key[1] == tr.tid]:
+            self._last_access.pop(key)
+
+
+class MetricStoreIterator:
+    '''
+    Async iterator returned by MetricStore.iter. Only the parts of the interval not
+    synced nor known to be empty are requested, sharing the requests in flight. The
+    data of the interval already in the store is returned in the last chunk.
+    '''
+
+    def __init__(self, store, metric, start, end, count):
+        self.store = store
+        self.metric = metric
+        self.start = start
+        self.end = end
+        self.count = count
+        self._ranges = None
+        self._range = None
+        self._stream = None
+        self._streamed = []
+        self._total = 0
+        self._done = False
+        self._local_done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._ranges is None:
+            self._ranges = self.store._get_requestable_ranges(self.metric, its=self.start, ets=self.end, count=self.count)
+        while not self._done:
+            if self._stream is None:
+                if not self._ranges or (self.count and self._total >= self.count):
+                    self._done = True
+                    break
+                self._start_range(self._ranges.pop(0))
+                if self.store._shared_request(self.metric, self._range['its'], self._range['ets'], self.count):
+                    response = await self.store._request_data(self.metric, self._range['its'], self._range['ets'], self.count)
+                    self._stream = None
+                    self._add_chunk(response['data'])
+                    self._end_range(response['success'])
+                    return self._series(response['data'])
+                self._stream = prproc.DataIntervalStream(self.metric, self._range['its'], self._range['ets'], self.count)
+            try:
+                d = await self._stream.__anext__()
+            except StopAsyncIteration:
+                self._stream = None
+                self._end_range(True)
+                continue
+            except exceptions.SessionException:
+                self._stream = None
+                self._end_range(False)
+                raise
+            self._add_chunk(d)
+            return self._series(d)
+        if not self._local_done:
+            self._local_done = True
+            s = self._local_data()
+            if s is not None and len(s) > 0:
+                return s
+        raise StopAsyncIteration
+
+    def _keep(self):
+        ''' chunks are only kept in the store if their range can be marked as synced '''
+        return transactions.get_tr() != None or self.metric in self.store._hooked
+
+    def _start_range(self, r):
+        self._range = {'its':r['its'], 'ets':r['ets'], 'num_rows':0, 'first':None, 'last':None, 'tid':None}
+        self._streamed.append((r['its'] or timeuuid.MIN_TIMEUUID, r['ets'] or timeuuid.MAX_TIMEUUID))
+
+    def _add_chunk(self, d):
+        r = self._range
+        if self._keep():
+            r['tid'] = self.store._store_requested_data(self.metric, d)
+        if len(d) > 0:
+            first, last = min(row[0] for row in d), max(row[0] for row in d)
+            r['first'] = first if r['first'] == None or first < r['first'] else r['first']
+            r['last'] = last if r['last'] == None or last > r['last'] else r['last']
+            r['num_rows'] += len(d)
+            self._total += len(d)
+
+    def _end_range(self, success):
+        r = self._range
+        self._range = None
+        if not success:
+            return
+        if r['num_rows'] == 0 and r['its'] != None and r['ets'] != None:
+            self.store._add_empty_range(self.metric, r['its'], r['ets'])
+        if self._keep():
+            self.store._add_requested_range(self.metric, r['its'], r['ets'], self.count, r['num_rows'], r['first'], r['last'], r['tid'])
+
+    def _series(self, d):
+        s = pd.Series(index=[r[0] for r in d], data=[to_store_value(r[1]) for r in d], dtype=object)
+        s.name = self.metric
+        return s
+
+    def _local_data(self):
+        ''' data of the interval in the store, except the ranges already returned '''
+        s = self.store._get_metric_data(self.metric, self.start, self.end, self.count)
+        if s is None:
+            return None
+        for its, ets in self._streamed:
+            s = s[(s.index < its) | (s.index > ets)]
+        if self.count:
+            remaining = self.count - self._total
+            if remaining <= 0:
+                return None
+            s = s.iloc[-remaining:]
+        return s
 
+    def close(self):
+        ''' stops the iteration. The range being received is not marked as synced '''
+        self._done = True
+        self._local_done = True
+        if self._stream:
+            self._stream.close()
+            self._stream = None
@@ -0,0 +1,66 @@
+'''
+
+Transfer methods telemetry
+
+'''
+
+import bisect
+
+# bucket upper bounds in seconds, from 100us to ~105s
+BUCKETS = tuple(0.0001*2**i for i in range(21))
+
+class Histogram:
+    ''' Latency histogram with exponential buckets '''
+
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS)+1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ''' Returns the upper bound of the bucket holding the percentile p '''
+        if self.count == 0:
+            return None
+        rank = p/100*self.count
+        acc = 0
+        for i,count in enumerate(self.counts):
+            acc += count
+            if acc >= rank and count > 0:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count':self.count,
+            'mean':self.sum/self.count if self.count else None,
+            'p50':self.percentile(50),
+            'p99':self.percentile(99),
+            'max':self.max,
+        }
+
+class TransferMethodTelemetry:
+    ''' Execution counters and latencies of a transfer method '''
+
+    def __init__(self):
+        self.counters = {'success':0, 'failure':0, 'commit_failure':0, 'timeout':0}
+        self.latencies = {
+            'queue_delay':Histogram(),
+            'function':Histogram(),
+            'fetch':Histogram(),
+            'commit':Histogram(),
+        }
+
+    def to_dict(self):
+        return {
+            'counters':dict(self.counters),
+            'latencies':{k:v.to_dict() for k,v in self.latencies.items()},
+        }
+
@@ -0,0 +1,106 @@
+import asyncio
+import unittest
+from komlogd.api.model import test
+from komlogd.api.model.queues import AsyncQueue
+
+loop = asyncio.get_event_loop()
+
+def first_arg(key, *args, **kwargs):
+    return key
+
+class ApiModelQueuesTest(unittest.TestCase):
+
+    def tearDown(self):
+        [task.cancel() for task in asyncio.Task.all_tasks()]
+
+    @test.sync(loop)
+    async def test_AsyncQueue_success_partitions_processed_in_order(self):
+        ''' items with the same key should be processed in order, items with different keys concurrently '''
+        events = []
+        release = asyncio.Event()
+        async def on_msg(key, i):
+            events.append(('start', key, i))
+            if (key, i) == ('a', 0):
+                await release.wait()
+            events.append(('end', key, i))
+        q = AsyncQueue(num_workers=3, on_msg=on_msg, name='test', key=first_arg)
+        q._timeout = None
+        q.start()
+        await q.push('a', 0)
+        await q.push('a', 1)
+        await q.push('b', 0)
+        await asyncio.sleep(0.01)
+        self.assertEqual(events, [('start','a',0), ('start','b',0), ('end','b',0)])
+        self.assertEqual(q.depth, 1)
+        release.set()
+        await q.join()
+        self.assertEqual(events[3:], [('end','a',0), ('start','a',1), ('end','a',1)])
+        self.assertEqual(q.stats['processed'], 3)
+        self.assertEqual(q.latencies['wait'].count, 3)
+        self.assertEqual(q._partitions, {})
+
+    @test.sync(loop)
+    async def test_AsyncQueue_success_items_with_several_keys_processed_in_order(self):
+        ''' an item with several keys should wait for the previous items of every key, and the next items for it '''
+        events = []
+        release = asyncio.Event()
+        async def on_msg(keys, i):
+            events.append(('start', i))
+            if i == 0:
+                await release.wait()
+            events.append(('end', i))
+        q = AsyncQueue(num_workers=3, on_msg=on_msg, name='test', key=first_arg)
+        q._timeout = None
+        q.start()
+        await q.push(['b'], 0)
+        await q.push(['a','b'], 1)
+        await q.push(['a'], 2)
+        await q.push(['c'], 3)
+        await asyncio.sleep(0.01)
+        self.assertEqual(events, [('start',0), ('start',3), ('end',3)])
+        release.set()
+        await q.join()
+        self.assertEqual(events[3:], [('end',0), ('start',1), ('end',1), ('start',2), ('end',2)])
+        self.assertEqual(q._partitions, {})
+
+    @test.sync(loop)
+    async def test_AsyncQueue_success_push_waits_while_full(self):
+        ''' push should wait while the queue holds max_size items '''
+        processed = []
+        async def on_msg(key):
+            processed.append(key)
+        q = AsyncQueue(num_workers=1, on_msg=on_msg, name='test', key=first_arg, max_size=2)
+        q._timeout = None
+        await q.push('a')
+        await q.push('b')
+        push = asyncio.ensure_future(q.push('c'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(push.done())
+        self.assertEqual(q.depth, 2)
+        q.start()
+        await push
+        await q.join()
+        self.assertEqual(processed, ['a','b','c'])
+        self.assertEqual(q.stats['max_depth'], 2)
+
+    @test.sync(loop)
+    async def test_AsyncQueue_success_workers_autoscaled(self):
+        ''' workers should be added while the backlog grows, and removed when idle '''
+        release = asyncio.Event()
+        async def on_msg(key):
+            await release.wait()
+        q = AsyncQueue(num_workers=1, on_msg=on_msg, name='test', key=first_arg, max_workers=3, idle_timeout=0.01)
+        q._timeout = None
+        q.start()
+        for key in ('a','b','c','d'):
+            await q.push(key)
+        await asyncio.sleep(0)
+        self.assertEqual(q.num_workers, 3)
+        release.set()
+        await asyncio.sleep(0.1)
+        self.assertEqual(q.num_workers, 1)
+        self.assertEqual(q.stats['max_workers'], 3)
+        self.assertEqual(q.stats['processed'], 4)
+        await q.join()
+        self.assertEqual(q.num_workers, 0)
+
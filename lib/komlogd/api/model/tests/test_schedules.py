@@ -166,7 +166,7 @@ class ApiModelSchedulesTest(unittest.TestCase):
     def test_CronSchedule_meets_false(self):
         ''' CronSchedule meets should return false if timestruct does not meet schedule '''
         sc = schedules.CronSchedule()
-        sc._schedule={'minute':[],'hour':[],'month':[],'dow':[],'dom':[]}
+        sc._schedule={'second':0,'minute':0,'hour':0,'month':0,'dow':0,'dom':0}
         t = time.localtime()
         self.assertFalse(sc.meets(t))
 
@@ -174,6 +174,37 @@ class ApiModelSchedulesTest(unittest.TestCase):
         ''' CronSchedule meets should return true if timestruct meets schedule '''
         sc = schedules.CronSchedule()
         t = time.localtime()
-        sc._schedule={'minute':[t.tm_min],'hour':[t.tm_hour],'month':[t.tm_mon],'dow':[t.tm_wday],'dom':[t.tm_mday]}
+        sc._schedule={'second':1,'minute':1<<t.tm_min,'hour':1<<t.tm_hour,'month':1<<t.tm_mon,'dow':1<<t.tm_wday,'dom':1<<t.tm_mday}
         self.assertTrue(sc.meets(t))
 
+    def test_creation_CronSchedule_failure_invalid_second(self):
+        ''' creating a CronSchedule object should fail if second is invalid '''
+        for second in [-1, 60, {'set'}, ['a','list'], {'a':'dict'}]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                sc = schedules.CronSchedule(second=second)
+            self.assertEqual(cm.exception.msg, 'Invalid second value: '+str(second))
+
+    def test_CronSchedule_next_after_success(self):
+        ''' next_after should return the first instant after t that meets the schedule '''
+        sc = schedules.CronSchedule(hour='3', minute='30')
+        t = time.mktime((2017, 6, 1, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(sc.next_after(t), time.mktime((2017, 6, 2, 3, 30, 0, 0, 0, -1)))
+        sc = schedules.CronSchedule(second='*/15')
+        t = time.mktime((2017, 12, 31, 23, 59, 50, 0, 0, -1))
+        self.assertEqual(sc.next_after(t), time.mktime((2018, 1, 1, 0, 0, 0, 0, 0, -1)))
+        self.assertEqual(sc.next_after(t-6), t-5)
+        # every minute by default, at second 0
+        sc = schedules.CronSchedule()
+        t = time.mktime((2017, 6, 1, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(sc.next_after(t), t+60)
+        self.assertEqual(sc.next_after(t-0.5), t)
+        # friday 13th of february
+        sc = schedules.CronSchedule(month='2', dom='13', dow='4', hour='0', minute='0')
+        t = time.mktime((2017, 6, 1, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(sc.next_after(t), time.mktime((2026, 2, 13, 0, 0, 0, 0, 0, -1)))
+
+    def test_CronSchedule_next_after_none_if_never_meets(self):
+        ''' next_after should return None if the schedule never meets '''
+        sc = schedules.CronSchedule(month='2', dom='30')
+        self.assertIsNone(sc.next_after(time.time()))
+
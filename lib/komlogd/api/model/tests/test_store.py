@@ -9,8 +9,9 @@ from komlogd.api.session import KomlogSession
 from komlogd.api.common import exceptions
 from komlogd.api.common.timeuuid import TimeUUID, MIN_TIMEUUID, MAX_TIMEUUID
 from komlogd.api.model import test
-from komlogd.api.model.store import MetricStore
+from komlogd.api.model.store import MetricStore, ROW_BYTES
 from komlogd.api.model.metrics import Datasource, Datapoint, Sample
+from komlogd.api.model import transactions
 from komlogd.api.model.transactions import TransactionTask, Transaction
 from komlogd.api.model.session import sessionIndex
 
@@ -54,14 +55,15 @@ class ApiModelStoreTest(unittest.TestCase):
         ms.hook = test.AsyncMock(side_effect = [
             {'hooked':True,'exists':False},
             {'hooked':True,'exists':True},
-            {'hooked':False,'exists':False}])
+            {'hooked':False,'exists':False},
+            {'hooked':True,'exists':True}])
         ms._prev_hooked = set()
         ms._prev_hooked.add(Datasource(uri='uri'))
         ms._prev_hooked.add(Datasource(uri='uri2'))
         ms._prev_hooked.add(Datasource(uri='uri3'))
         ms._prev_hooked.add(Datasource(uri='uri4'))
         self.assertFalse(await ms.sync())
-        self.assertEqual(ms.hook.call_count, 3)
+        self.assertEqual(ms.hook.call_count, 4)
         self.assertTrue(Datasource(uri='uri') in ms._prev_hooked)
         self.assertTrue(Datasource(uri='uri2') in ms._prev_hooked)
         self.assertTrue(Datasource(uri='uri3') in ms._prev_hooked)
@@ -78,6 +80,112 @@ class ApiModelStoreTest(unittest.TestCase):
         self.assertEqual(ms._hooked,set())
         self.assertFalse(hasattr(ms, '_prev_hooked'))
 
+    def test_disconnected_success_ranges_cut_at_last_sample(self):
+        ''' disconnected should keep data and ranges of hooked metrics until their last sample '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        other = Datapoint('uri2')
+        start = TimeUUID(100)
+        ms._hooked.add(metric)
+        ms._add_synced_range(metric, time.monotonic(), start, MAX_TIMEUUID)
+        ms._synced_ranges[other] = [{'t':time.monotonic(), 'its':start, 'ets':TimeUUID(200)}]
+        last = TimeUUID(150)
+        ms._store(metric, TimeUUID(120), 1, tm=time.monotonic())
+        ms._store(metric, last, 2, tm=time.monotonic())
+        ms.disconnected()
+        self.assertEqual(ms._hooked, set())
+        self.assertEqual(ms._prev_hooked, {metric})
+        self.assertEqual(ms._gaps, {metric:last})
+        self.assertEqual([(r['its'],r['ets']) for r in ms._synced_ranges[metric]], [(start,last)])
+        self.assertEqual(len(ms._synced_ranges[other]), 1)
+        self.assertEqual(len(ms._dfs[metric]), 2)
+        # gap start is kept on further disconnections
+        ms._hooked.add(metric)
+        ms._store(metric, TimeUUID(170), 3, tm=time.monotonic())
+        ms.disconnected()
+        self.assertEqual(ms._gaps, {metric:last})
+
+    def test_disconnected_success_only_metrics_passed(self):
+        ''' disconnected should only cut the ranges and unhook the metrics passed '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        other = Datapoint('uri2')
+        start = TimeUUID(100)
+        for m in (metric, other):
+            ms._hooked.add(m)
+            ms._hook_results[m] = {'hooked':True, 'exists':True}
+            ms._add_synced_range(m, time.monotonic(), start, MAX_TIMEUUID)
+        ms.disconnected(metrics=[metric])
+        self.assertEqual(ms._hooked, {other})
+        self.assertEqual(ms._prev_hooked, {metric})
+        self.assertEqual(list(ms._gaps.keys()), [metric])
+        self.assertEqual(list(ms._hook_results.keys()), [other])
+        self.assertEqual(ms._synced_ranges[other][0]['ets'], MAX_TIMEUUID)
+        self.assertTrue(ms._synced_ranges[metric][0]['ets'] < MAX_TIMEUUID)
+
+    @test.sync(loop)
+    async def test_sync_success_only_disconnection_gap_requested(self):
+        ''' sync should hook the metrics again and request only the data since the disconnection '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            start = TimeUUID(100)
+            ms._add_synced_range(metric, time.monotonic(), start, MAX_TIMEUUID)
+            last = TimeUUID(150)
+            ms._store(metric, last, 2, tm=time.monotonic())
+            ms.disconnected()
+            bck_hook = prproc.hook_to_metric
+            bck = prproc.request_data
+            prproc.hook_to_metric = test.AsyncMock(return_value = {'hooked':True,'exists':True})
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            self.assertTrue(await ms.sync())
+            self.assertEqual(ms._gaps, {})
+            gap_calls = [c for c in prproc.request_data.call_args_list if c[0][1] == last]
+            self.assertEqual(len(gap_calls), 1)
+            # data before the disconnection is not requested again
+            await ms.get(metric, start=start, end=last)
+            self.assertFalse(any(c[0][1] < last for c in prproc.request_data.call_args_list))
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+        except:
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_sync_success_gap_kept_if_request_fails(self):
+        ''' sync should keep the gap, without marking it synced, if its request fails, and request it again in the next sync '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            start = TimeUUID(100)
+            ms._add_synced_range(metric, time.monotonic(), start, MAX_TIMEUUID)
+            last = TimeUUID(150)
+            ms._store(metric, last, 2, tm=time.monotonic())
+            ms.disconnected()
+            bck_hook = prproc.hook_to_metric
+            bck = prproc.request_data
+            prproc.hook_to_metric = test.AsyncMock(return_value = {'hooked':True,'exists':True})
+            prproc.request_data = test.AsyncMock(return_value = {'success':False,'data':[],'error':'error'})
+            self.assertFalse(await ms.sync())
+            self.assertEqual(ms._gaps, {metric:last})
+            self.assertEqual(ms._prev_hooked, {metric})
+            self.assertTrue(all(r['ets'] <= last for r in ms._synced_ranges[metric]))
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            now = TimeUUID()
+            self.assertTrue(await ms.sync())
+            self.assertEqual(ms._gaps, {})
+            self.assertTrue(any(c[0][1] == last for c in prproc.request_data.call_args_list))
+            self.assertEqual(ms._get_missing_ranges(metric, last, now, None), [])
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+        except:
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+            raise
+
     def test_insert_failure_invalid_metric(self):
         ''' insert should fail if metric is not a valid Metric Object '''
         ms = MetricStore()
@@ -120,6 +228,7 @@ class ApiModelStoreTest(unittest.TestCase):
             with self.assertRaises(TypeError) as cm:
                 ms.insert(metric, t, value)
 
+    @unittest.skipIf(transactions.contextvars is not None, 'transactions are propagated with contextvars')
     def test_insert_failure_non_running_in_a_TransactionTask(self):
         ''' insert should fail if the function is not running in a TransactionTask '''
         ms = MetricStore()
@@ -130,6 +239,33 @@ class ApiModelStoreTest(unittest.TestCase):
             ms.insert(metric, t, value)
         self.assertEqual(str(cm.exception),"'NoneType' object has no attribute 'get_tr'")
 
+    @unittest.skipIf(transactions.contextvars is None, 'contextvars not available')
+    def test_insert_success_non_running_in_a_task(self):
+        ''' insert should store the sample outside any transaction if the function is not running in a task '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        t = TimeUUID()
+        ms.insert(metric, t, 1)
+        self.assertEqual(ms._tr_dfs, {})
+        self.assertTrue(ms.is_in(metric, t, 1))
+
+    @test.sync(loop)
+    async def test_insert_success_transaction_propagated_to_child_tasks(self):
+        ''' tasks created inside a TransactionTask should run in its transaction, other tasks should not '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        t1 = TimeUUID(1)
+        t2 = TimeUUID(2)
+        async def insert(t):
+            ms.insert(metric, t, 1)
+        async def f():
+            await asyncio.ensure_future(insert(t1))
+        async with Transaction(t1) as tr:
+            await TransactionTask(coro=f(), tr=tr)
+            await asyncio.ensure_future(insert(t2))
+            self.assertEqual(list(ms._tr_dfs[tr.tid][metric].t), [t1])
+            self.assertEqual(list(ms._dfs[metric].t), [t2])
+
     @test.sync(loop)
     async def test_insert_success_within_active_transaction_datasource(self):
         ''' insert data within an active transaction should store temporarily the results and activate the transaction dirty flag '''
@@ -2300,6 +2436,354 @@ class ApiModelStoreTest(unittest.TestCase):
             prproc.hook_to_metric = bck
             raise
 
+    @test.sync(loop)
+    async def test_request_data_success_concurrent_overlapping_requests_coalesced(self):
+        ''' concurrent requests covered by an in-flight request should share its response '''
+        try:
+            ms = MetricStore()
+            metric = Datapoint('uri')
+            ts = [TimeUUID(i) for i in (110, 150, 250)]
+            data = [(ts[0],decimal.Decimal(1)),(ts[1],decimal.Decimal(2)),(ts[2],decimal.Decimal(3))]
+            async def request_data(metric, its, ets, count):
+                await asyncio.sleep(0.1)
+                return {'success':True, 'data':data, 'error':None}
+            bck = prproc.request_data
+            prproc.request_data = Mock(side_effect=request_data)
+            r1, r2, r3 = await asyncio.gather(
+                ms._request_data(metric, TimeUUID(100), TimeUUID(300), None),
+                ms._request_data(metric, TimeUUID(140), TimeUUID(200), None),
+                ms._request_data(metric, TimeUUID(100), TimeUUID(300), 2))
+            self.assertEqual(prproc.request_data.call_count, 2)
+            self.assertEqual(r1['data'], data)
+            self.assertEqual(r2['data'], [data[1]])
+            self.assertEqual(ms.stats['requests'], 2)
+            self.assertEqual(ms.stats['coalesced'], 1)
+            self.assertEqual(ms.stats['coalesced_rows'], 1)
+            self.assertEqual(ms.stats['coalesced_bytes'], ROW_BYTES)
+            self.assertEqual(ms._inflight, {})
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_sequential_windows_prefetched(self):
+        ''' consecutive windows should be detected and the next ones requested in background '''
+        try:
+            ms = MetricStore(readahead=2)
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            bck = prproc.request_data
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            base = time.time()-86400
+            windows = [(TimeUUID(base+i*3600, lowest=True), TimeUUID(base+(i+1)*3600, highest=True)) for i in range(4)]
+            await ms.get(metric, start=windows[0][0], end=windows[0][1])
+            self.assertEqual(ms.stats['prefetches'], 0)
+            await ms.get(metric, start=windows[1][0], end=windows[1][1])
+            self.assertEqual(ms.stats['prefetches'], 1)
+            self.assertEqual(ms.stats['prefetch_misses'], 1)
+            await ms.get(metric, start=windows[2][0], end=windows[2][1])
+            await ms.get(metric, start=windows[3][0], end=windows[3][1])
+            self.assertEqual(ms.stats['prefetch_hits'], 2)
+            # windows 0 and 1, prefetch of windows 2 and 3, and prefetch of the windows after 3
+            self.assertEqual(ms.stats['prefetches'], 2)
+            await asyncio.gather(*[p['task'] for p in ms._prefetching.values()])
+            self.assertEqual(prproc.request_data.call_count, 4)
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_no_prefetch_if_readahead_disabled(self):
+        ''' no prefetch should be requested if readahead is 0 '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            bck = prproc.request_data
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            base = time.time()-86400
+            for i in range(3):
+                await ms.get(metric, start=TimeUUID(base+i*3600, lowest=True), end=TimeUUID(base+(i+1)*3600, highest=True))
+            self.assertEqual(ms.stats['prefetches'], 0)
+            self.assertEqual(prproc.request_data.call_count, 3)
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_empty_interval_not_requested_again(self):
+        ''' an interval without data should not be requested again until the negative cache expires '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            bck = prproc.request_data
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            start = TimeUUID(100)
+            end = TimeUUID(200)
+            for i in range(3):
+                self.assertIsNone(await ms.get(metric, start=start, end=end))
+            self.assertEqual(prproc.request_data.call_count, 1)
+            self.assertEqual(ms.stats['negative_hits'], 2)
+            # overlapping intervals only request the unknown part
+            new_end = TimeUUID(300)
+            await ms.get(metric, start=TimeUUID(150), end=new_end)
+            self.assertEqual(prproc.request_data.call_count, 2)
+            self.assertEqual(prproc.request_data.call_args[0][1:], (end, new_end, None))
+            ms._empty[metric][0]['expires'] = time.monotonic()-1
+            await ms.get(metric, start=start, end=end)
+            self.assertEqual(prproc.request_data.call_count, 3)
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_empty_interval_invalidated_by_pushed_data(self):
+        ''' pushed data should invalidate the empty intervals that contain it '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            bck = prproc.request_data
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            ts = [TimeUUID(i) for i in (100, 200, 300, 400)]
+            await ms.get(metric, start=ts[0], end=ts[1])
+            await ms.get(metric, start=ts[2], end=ts[3])
+            ms.insert(metric, TimeUUID(150), 1)
+            self.assertEqual(len(ms._empty[metric]), 1)
+            await ms.get(metric, start=ts[0], end=ts[1])
+            await ms.get(metric, start=ts[2], end=ts[3])
+            self.assertEqual(prproc.request_data.call_count, 3)
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_failed_request_not_cached_as_empty(self):
+        ''' a failed request should not be stored in the negative cache '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            bck = prproc.request_data
+            prproc.request_data = test.AsyncMock(return_value = {'success':False,'data':[],'error':'error'})
+            await ms.get(metric, start=TimeUUID(100), end=TimeUUID(200))
+            await ms.get(metric, start=TimeUUID(100), end=TimeUUID(200))
+            self.assertEqual(prproc.request_data.call_count, 2)
+            self.assertEqual(ms._empty, {})
+            prproc.request_data = bck
+        except:
+            prproc.request_data = bck
+            raise
+
+    @test.sync(loop)
+    async def test_get_success_unknown_metric_not_requested_until_data_received(self):
+        ''' metrics reported as non existent by hook should not be requested until data is received for them '''
+        try:
+            ms = MetricStore(readahead=0)
+            metric = Datapoint('uri')
+            bck_hook = prproc.hook_to_metric
+            bck = prproc.request_data
+            prproc.hook_to_metric = test.AsyncMock(return_value = {'hooked':True,'exists':False})
+            prproc.request_data = test.AsyncMock(return_value = {'success':True,'data':[],'error':None})
+            await ms.hook(metric)
+            self.assertTrue(metric in ms._unknown)
+            async with Transaction(TimeUUID()) as tr:
+                ms._synced_ranges = {}
+                await TransactionTask(coro=ms.get(metric, start=TimeUUID(100), end=TimeUUID(200)), tr=tr)
+            self.assertEqual(prproc.request_data.call_count, 0)
+            ms.insert(metric, TimeUUID(150), 1)
+            self.assertFalse(metric in ms._unknown)
+            await ms.get(metric, start=TimeUUID(300), end=TimeUUID(400))
+            self.assertEqual(prproc.request_data.call_count, 1)
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+        except:
+            prproc.hook_to_metric = bck_hook
+            prproc.request_data = bck
+            raise
+
+    def test_iter_failure_no_start_nor_end(self):
+        ''' iter should fail if no start nor end is set '''
+        ms = MetricStore()
+        with self.assertRaises(ValueError):
+            ms.iter(Datapoint('uri'))
+
+    @test.sync(loop)
+    async def test_iter_success_chunks_stored_as_received(self):
+        ''' iter should store every chunk before returning it, and mark the interval synced at the end '''
+        try:
+            ms = MetricStore()
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            start = TimeUUID(100)
+            end = TimeUUID(300)
+            ts = [TimeUUID(i) for i in (110, 120, 210)]
+            chunks = [[(ts[2],decimal.Decimal('3'))], [(ts[0],decimal.Decimal('1')),(ts[1],decimal.Decimal('2.5'))]]
+            class Stream:
+                def __init__(self, *args, **kwargs):
+                    pass
+                async def __anext__(self):
+                    if chunks:
+                        return chunks.pop(0)
+                    raise StopAsyncIteration
+            bck = prproc.DataIntervalStream
+            prproc.DataIntervalStream = Stream
+            it = ms.iter(metric, start=start, end=end)
+            s1 = await it.__anext__()
+            self.assertEqual(list(s1.index), [ts[2]])
+            self.assertEqual(list(s1.values), [3])
+            self.assertEqual(len(ms._dfs[metric]), 1)
+            self.assertEqual(ms._synced_ranges.get(metric,[]), [])
+            s2 = await it.__anext__()
+            self.assertEqual(list(s2.values), [1, 2.5])
+            self.assertEqual(len(ms._dfs[metric]), 3)
+            with self.assertRaises(StopAsyncIteration):
+                await it.__anext__()
+            self.assertEqual(len(ms._synced_ranges[metric]), 1)
+            self.assertEqual(ms._synced_ranges[metric][0]['its'], start)
+            self.assertEqual(ms._synced_ranges[metric][0]['ets'], end)
+            prproc.DataIntervalStream = bck
+        except:
+            prproc.DataIntervalStream = bck
+            raise
+
+    @test.sync(loop)
+    async def test_iter_success_synced_and_empty_ranges_not_requested(self):
+        ''' iter should only request the ranges not synced nor known empty, and return the stored data at the end '''
+        try:
+            ms = MetricStore()
+            ts = {i:TimeUUID(i) for i in (100, 150, 200, 210, 250, 300)}
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            ms._add_synced_range(metric, time.monotonic(), ts[100], ts[200])
+            ms._store(metric, ts[150], 5, tm=time.monotonic())
+            ms._add_empty_range(metric, ts[250], ts[300])
+            requested = []
+            class Stream:
+                def __init__(self, metric, start, end, count=None):
+                    requested.append((start, end))
+                    self.chunks = [[(ts[210],decimal.Decimal('1'))]]
+                async def __anext__(self):
+                    if self.chunks:
+                        return self.chunks.pop(0)
+                    raise StopAsyncIteration
+            bck = prproc.DataIntervalStream
+            prproc.DataIntervalStream = Stream
+            chunks = []
+            async for chunk in ms.iter(metric, start=ts[100], end=ts[300]):
+                chunks.append(chunk)
+            self.assertEqual(requested, [(ts[200], ts[250])])
+            self.assertEqual([list(c.index) for c in chunks], [[ts[210]], [ts[150]]])
+            self.assertEqual(ms._get_missing_ranges(metric, ts[100], ts[250], None), [])
+            # unknown metrics are not requested
+            requested.clear()
+            other = Datapoint('uri2')
+            ms._unknown[other] = time.monotonic()+60
+            it = ms.iter(other, start=ts[100], end=ts[300])
+            with self.assertRaises(StopAsyncIteration):
+                await it.__anext__()
+            self.assertEqual(requested, [])
+            prproc.DataIntervalStream = bck
+        except:
+            prproc.DataIntervalStream = bck
+            raise
+
+    @test.sync(loop)
+    async def test_iter_success_request_in_flight_shared(self):
+        ''' iter should share the response of a request in flight covering the range instead of requesting it '''
+        try:
+            ms = MetricStore()
+            metric = Datapoint('uri')
+            ms._hooked.add(metric)
+            start = TimeUUID(100)
+            end = TimeUUID(300)
+            t = TimeUUID(200)
+            task = asyncio.Future()
+            task.set_result({'success':True, 'data':[(t, decimal.Decimal('1'))], 'error':None})
+            ms._inflight[metric] = [{'its':start, 'ets':end, 'count':None, 'task':task}]
+            bck = prproc.DataIntervalStream
+            prproc.DataIntervalStream = Mock(side_effect=Exception('not expected'))
+            chunks = []
+            async for chunk in ms.iter(metric, start=start, end=end):
+                chunks.append(chunk)
+            self.assertEqual([list(c.index) for c in chunks], [[t]])
+            self.assertEqual(ms.stats['coalesced'], 1)
+            self.assertEqual(ms.stats['requests'], 0)
+            self.assertEqual(ms._get_missing_ranges(metric, start, end, None), [])
+            prproc.DataIntervalStream = bck
+        except:
+            prproc.DataIntervalStream = bck
+            raise
+
+    @test.sync(loop)
+    async def test_iter_success_chunks_of_not_hooked_metric_not_stored(self):
+        ''' iter should not keep in the store the chunks of metrics not hooked outside transactions '''
+        try:
+            ms = MetricStore()
+            metric = Datapoint('uri')
+            chunks = [[(TimeUUID(110),decimal.Decimal('1'))], [(TimeUUID(120),decimal.Decimal('2'))]]
+            class Stream:
+                def __init__(self, *args, **kwargs):
+                    pass
+                async def __anext__(self):
+                    if chunks:
+                        return chunks.pop(0)
+                    raise StopAsyncIteration
+            bck = prproc.DataIntervalStream
+            prproc.DataIntervalStream = Stream
+            values = []
+            async for chunk in ms.iter(metric, start=TimeUUID(100), end=TimeUUID(300)):
+                values.extend(chunk.values)
+            self.assertEqual(values, [1, 2])
+            self.assertFalse(metric in ms._dfs)
+            self.assertEqual(ms._synced_ranges.get(metric, []), [])
+            prproc.DataIntervalStream = bck
+        except:
+            prproc.DataIntervalStream = bck
+            raise
+
+    @test.sync(loop)
+    async def test_hook_success_already_hooked_metric_not_hooked_again(self):
+        ''' if the metric is already hooked, hook should return the previous result without requesting it again '''
+        try:
+            ms = MetricStore()
+            metric = Datapoint('uri')
+            bck = prproc.hook_to_metric
+            prproc.hook_to_metric = test.AsyncMock(return_value = {'hooked':True,'exists':False})
+            self.assertEqual(await ms.hook(metric), {'hooked':True, 'exists':False})
+            self.assertEqual(await ms.hook(metric), {'hooked':True, 'exists':False})
+            self.assertEqual(prproc.hook_to_metric.call_count, 1)
+            ms.clear_synced()
+            self.assertEqual(await ms.hook(metric), {'hooked':True, 'exists':False})
+            self.assertEqual(prproc.hook_to_metric.call_count, 2)
+            prproc.hook_to_metric = bck
+        except:
+            prproc.hook_to_metric = bck
+            raise
+
+    @test.sync(loop)
+    async def test_hook_many_success_concurrent_hooks_deduplicated(self):
+        ''' hook_many should hook every distinct metric once, even with concurrent calls '''
+        try:
+            ms = MetricStore()
+            metrics = [Datapoint('uri1'), Datapoint('uri2'), Datapoint('uri1'), Datapoint('uri3')]
+            bck = prproc.hook_to_metric
+            prproc.hook_to_metric = test.AsyncMock(return_value = {'hooked':True,'exists':False})
+            results = await asyncio.gather(ms.hook_many(metrics, max_concurrency=2), ms.hook_many(metrics[:2]))
+            self.assertEqual(list(results[0].keys()), [Datapoint('uri1'), Datapoint('uri2'), Datapoint('uri3')])
+            self.assertTrue(all(r == {'hooked':True, 'exists':False} for r in results[0].values()))
+            self.assertEqual(len(results[1]), 2)
+            self.assertEqual(prproc.hook_to_metric.call_count, 3)
+            self.assertEqual(ms._hooked, set(metrics))
+            self.assertEqual(ms._hooking, {})
+            prproc.hook_to_metric = bck
+        except:
+            prproc.hook_to_metric = bck
+            raise
+
     def test_is_in_failure_metric_not_in_dfs(self):
         ''' is_in should return False if metric is not in the store '''
         ms = MetricStore()
@@ -2406,6 +2890,100 @@ class ApiModelStoreTest(unittest.TestCase):
             self.assertIsNone(ms._store(metric, reg['t'], reg['value'], tm=time.monotonic()))
         self.assertFalse(ms.has_updates(metric, t, tm))
 
+    def test_store_success_versions_increasing(self):
+        ''' rows stored outside transactions should keep their tm increasing '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        tm = time.monotonic()
+        ms._store(metric, TimeUUID(1), 1, tm=tm)
+        ms._store(metric, TimeUUID(2), 2, tm=tm)
+        ms._store(metric, TimeUUID(3), 3, tm=tm-1)
+        self.assertEqual(len(ms._dfs[metric]), 3)
+        self.assertTrue(ms._dfs[metric].index.is_monotonic_increasing)
+        self.assertTrue(ms._dfs[metric].index.is_unique)
+
+    @test.sync(loop)
+    async def test_get_metric_data_success_in_tr_reads_snapshot(self):
+        ''' reads in a transaction should not see data stored after the transaction started '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        t1 = TimeUUID(1)
+        t2 = TimeUUID(2)
+        ms._store(metric, t1, 1, tm=time.monotonic())
+        tr = Transaction(t2)
+        ms._store(metric, t1, 11, tm=time.monotonic())
+        ms._store(metric, t2, 2, tm=time.monotonic())
+        async def f():
+            return ms._get_metric_data(metric, its=t1, ets=t2, count=None)
+        data = await TransactionTask(coro=f(), tr=tr)
+        self.assertEqual(list(data.index), [t1])
+        self.assertEqual(list(data.values), [1])
+        data = ms._get_metric_data(metric, its=t1, ets=t2, count=None)
+        self.assertEqual(list(data.values), [11, 2])
+        tr.discard()
+
+    def test_gc_success_versions_visible_to_transactions_kept(self):
+        ''' gc should remove old versions of samples only when no transaction can read them '''
+        ms = MetricStore()
+        metric = Datapoint('uri')
+        t1 = TimeUUID(1)
+        t2 = TimeUUID(2)
+        ms._store(metric, t1, 1, tm=time.monotonic())
+        ms._store(metric, t1, 2, tm=time.monotonic())
+        tr = Transaction(t2)
+        ms._store(metric, t1, 3, tm=time.monotonic())
+        ms._store(metric, t2, 4, tm=time.monotonic())
+        self.assertEqual(ms.gc(), 1)
+        self.assertEqual(list(ms._dfs[metric].value), [2, 3, 4])
+        tr.discard()
+        self.assertEqual(ms.gc(), 1)
+        self.assertEqual(list(ms._dfs[metric].value), [3, 4])
+        self.assertEqual(ms.stats['gc_versions'], 2)
+        self.assertTrue(ms.is_in(metric, t1, 3))
+
+    def test_store_success_gc_after_gc_threshold_appends(self):
+        ''' old versions should be removed every gc_threshold rows stored '''
+        ms = MetricStore(gc_threshold=4)
+        metric = Datapoint('uri')
+        t = TimeUUID(1)
+        for i in range(4):
+            ms._store(metric, t, i, tm=time.monotonic())
+        self.assertEqual(list(ms._dfs[metric].value), [3])
+
+    @test.sync(loop)
+    async def test_group_commit_success_concurrent_commits_sent_together(self):
+        ''' commits with the same irt in the commit window should be sent in one batch, each with its own result '''
+        ms = MetricStore(commit_window=0.01)
+        m1 = Datapoint('uri1')
+        m2 = Datapoint('uri2')
+        t = TimeUUID()
+        s1 = [Sample(m1, t, 1)]
+        s2 = [Sample(m2, t, 2), Sample(m1, t, 3)]
+        s3 = [Sample(m2, t, 4)]
+        error = {'msg':Mock(uri='uri2', t=t, spec=['uri','t']), 'success':False, 'error':'code: 1'}
+        with patch.object(prproc, 'send_samples', new=test.AsyncMock(return_value={'success':False, 'errors':[error]})) as send_samples:
+            results = await asyncio.gather(ms._group_commit(s1, irt=1), ms._group_commit(s2, irt=1), ms._group_commit(s3, irt=2))
+        self.assertEqual(send_samples.call_count, 2)
+        sent = send_samples.call_args_list[0][0][0]
+        self.assertEqual([(s.metric, s.value) for s in sent], [(m2, 2), (m1, 3)])
+        self.assertEqual(send_samples.call_args_list[0][1], {'irt':1})
+        self.assertEqual(results[0], {'success':True, 'errors':[]})
+        self.assertEqual(results[1], {'success':False, 'errors':[error]})
+        self.assertEqual(results[2], {'success':False, 'errors':[error]})
+        self.assertEqual(ms.stats['group_commits'], 2)
+        self.assertEqual(ms.stats['grouped_transactions'], 3)
+        self.assertEqual(ms._commit_groups, {})
+
+    @test.sync(loop)
+    async def test_group_commit_success_window_disabled(self):
+        ''' with commit_window 0 samples should be sent right away '''
+        ms = MetricStore(commit_window=0)
+        samples = [Sample(Datapoint('uri'), TimeUUID(), 1)]
+        with patch.object(prproc, 'send_samples', new=test.AsyncMock(return_value={'success':True})) as send_samples:
+            self.assertEqual(await ms._group_commit(samples, irt=None), {'success':True, 'errors':[]})
+        send_samples.assert_called_once_with(samples, irt=None)
+        self.assertEqual(ms.stats['group_commits'], 0)
+
     def test_has_updates_success_metric_has_been_updated(self):
         ''' has_updates should return True if (metric,t) has rows newer than tm '''
         ms = MetricStore()
@@ -2554,6 +3132,25 @@ class ApiModelStoreTest(unittest.TestCase):
             prproc.send_samples = bck
             raise
 
+    @test.sync(loop)
+    async def test_tr_commit_success_samples_with_send_error_not_committed(self):
+        ''' tr_commit should not report as committed the samples whose message failed '''
+        ms = MetricStore(commit_window=0)
+        m1 = Datapoint(uri='uri1')
+        m2 = Datapoint(uri='uri2')
+        t1 = TimeUUID(100)
+        t2 = TimeUUID(200)
+        tr = Transaction(TimeUUID())
+        async def f():
+            ms.insert(m1, t1, 1)
+            ms.insert(m2, t1, 2)
+            ms.insert(m2, t2, 3)
+        await TransactionTask(coro=f(), tr=tr)
+        error = {'msg':Mock(uri='uri2', t=t2, spec=['uri','t']), 'success':False, 'error':'code: 1'}
+        with patch.object(prproc, 'send_samples', new=test.AsyncMock(return_value={'success':False, 'errors':[error]})):
+            await ms._tr_commit(tr)
+        self.assertEqual(sorted((s.metric.uri, s.t) for s in tr.committed), [('uri1', t1), ('uri2', t1)])
+
     @test.sync(loop)
     async def test_tr_commit_tr_exists_some_data_remove_duplicates(self):
         ''' tr_commit should write data to store and send samples to Komlog avoiding duplicates '''
@@ -0,0 +1,41 @@
+import unittest
+from komlogd.api.model import telemetry
+
+class ApiModelTelemetryTest(unittest.TestCase):
+
+    def test_Histogram_success_empty(self):
+        ''' an empty histogram should not return percentiles '''
+        h = telemetry.Histogram()
+        self.assertIsNone(h.percentile(50))
+        self.assertEqual(h.to_dict(), {'count':0, 'mean':None, 'p50':None, 'p99':None, 'max':0})
+
+    def test_Histogram_success_percentiles(self):
+        ''' percentiles should return the upper bound of the bucket that holds them '''
+        h = telemetry.Histogram()
+        for i in range(99):
+            h.add(0.00005)
+        h.add(0.3)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.max, 0.3)
+        self.assertEqual(h.percentile(50), telemetry.BUCKETS[0])
+        self.assertEqual(h.percentile(99), telemetry.BUCKETS[0])
+        self.assertEqual(h.percentile(100), telemetry.BUCKETS[12])
+        self.assertAlmostEqual(h.to_dict()['mean'], (99*0.00005+0.3)/100)
+
+    def test_Histogram_success_values_over_last_bucket(self):
+        ''' values over the last bucket should be reported with the max value '''
+        h = telemetry.Histogram()
+        h.add(1000)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertEqual(h.percentile(50), 1000)
+
+    def test_TransferMethodTelemetry_to_dict(self):
+        ''' to_dict should return counters and latencies '''
+        tel = telemetry.TransferMethodTelemetry()
+        tel.counters['success'] += 1
+        tel.latencies['commit'].add(0.01)
+        d = tel.to_dict()
+        self.assertEqual(d['counters'], {'success':1, 'failure':0, 'commit_failure':0, 'timeout':0})
+        self.assertEqual(sorted(d['latencies'].keys()), ['commit','fetch','function','queue_delay'])
+        self.assertEqual(d['latencies']['commit']['count'], 1)
+
@@ -5,7 +5,7 @@ import pandas as pd
 import time
 from komlogd.api import session
 from komlogd.api.common import crypto, timeuuid
-from komlogd.api.model import test
+from komlogd.api.model import test, transactions
 from komlogd.api.model.transactions import Transaction, TransactionTask
 from komlogd.api.model.session import sessionIndex
 
@@ -24,6 +24,7 @@ class ApiModelTransactionsTest(unittest.TestCase):
             self.assertEqual(task.get_tr(), tr)
         task_test()
 
+    @unittest.skipIf(transactions.contextvars is not None, 'transactions are propagated with contextvars')
     def test_TransactionTask_has_tr_attribute_None(self):
         ''' check that normal tasks has tr parameter if they run in a supported loop '''
         async def function():
@@ -34,6 +35,19 @@ class ApiModelTransactionsTest(unittest.TestCase):
             self.assertEqual(task.get_tr(), None)
         task_test()
 
+    def test_get_tr_success_inherited_by_tasks(self):
+        ''' get_tr should return the transaction of the TransactionTask in the tasks it creates '''
+        async def child():
+            return transactions.get_tr()
+        async def function():
+            return await asyncio.ensure_future(child())
+        @test.sync(loop)
+        async def task_test():
+            tr = Transaction(pd.Timestamp('now',tz='utc'))
+            self.assertEqual(await TransactionTask(coro=function(), tr=tr), tr)
+            self.assertIsNone(await loop.create_task(child()))
+        task_test()
+
     def test_TransactionTask_has_no_tr_attribute(self):
         ''' the loop must support TransactionTask or will fail '''
         loop2 = asyncio.new_event_loop()
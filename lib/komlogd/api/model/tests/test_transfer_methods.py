@@ -6,9 +6,11 @@ import time
 from komlogd.api import transfer_methods
 from komlogd.api.common import timeuuid
 from komlogd.api.model import test
-from komlogd.api.model.metrics import Datasource, Datapoint
+from komlogd.api.model.metrics import Datasource, Datapoint, Sample
+from komlogd.api.model.store import MetricStore
 from komlogd.api.model.schedules import OnUpdateSchedule, CronSchedule
-from komlogd.api.model.transfer_methods import TransferMethodsIndex
+from komlogd.api.model.transfer_methods import TransferMethodsIndex, AdmissionController
+from unittest.mock import Mock
 
 loop = asyncio.get_event_loop()
 
@@ -427,6 +429,32 @@ class ApiModelTransferMethodsTest(unittest.TestCase):
         self.assertTrue(tm1 in activated)
         self.assertTrue(tm2 in activated)
 
+    @test.sync(loop)
+    async def test_get_tms_activated_with_index_updated_on_enable_disable_delete(self):
+        ''' the activation metrics index should only contain the enabled tms '''
+        tm1 = transfer_methods.transfermethod(f=noop)
+        tm2 = transfer_methods.transfermethod(f=noop)
+        tm1._decorate_method(tm1._f)
+        tm2._decorate_method(tm2._f)
+        tmi = TransferMethodsIndex()
+        self.assertTrue(tmi.add_tm(tm1))
+        self.assertTrue(tmi.add_tm(tm2))
+        self.assertTrue(await tmi.enable_all())
+        self.assertEqual(tmi._activated_by, {})
+        tm1.schedule = OnUpdateSchedule(activation_metrics=[Datasource('uri'),Datasource('uri2')])
+        tm2.schedule = OnUpdateSchedule(activation_metrics=Datasource('uri2'))
+        self.assertEqual(tmi._activated_by, {Datasource('uri'):{tm1.mid}, Datasource('uri2'):{tm1.mid, tm2.mid}})
+        self.assertEqual(tmi._get_tms_activated_with([Datasource('uri')]), [tm1])
+        self.assertTrue(tmi.disable_tm(tm1.mid))
+        self.assertEqual(tmi._activated_by, {Datasource('uri2'):{tm2.mid}})
+        self.assertEqual(tmi._get_tms_activated_with([Datasource('uri'),Datasource('uri2')]), [tm2])
+        self.assertEqual(tmi._get_tms_activated_with([Datasource('uri')], enabled=False), [tm1])
+        tm2.schedule = OnUpdateSchedule(activation_metrics=Datasource('uri3'))
+        self.assertEqual(tmi._activated_by, {Datasource('uri3'):{tm2.mid}})
+        self.assertTrue(tmi.delete_tm(tm2.mid))
+        self.assertEqual(tmi._activated_by, {})
+        self.assertEqual(tmi._indexed, {})
+
     @test.sync(loop)
     async def test_get_tms_that_meet_none_found(self):
         ''' _get_tms_that_meet should return [] if no tm meets that schedule '''
@@ -463,10 +491,8 @@ class ApiModelTransferMethodsTest(unittest.TestCase):
         self.assertTrue(tm1.mid in tmi._enabled_methods)
         self.assertTrue(tm2.mid in tmi._enabled_methods)
         t = time.localtime()
-        tm1.schedule = CronSchedule()
-        tm1.schedule._schedule = {'minute':[t.tm_min],'hour':[t.tm_hour],'month':[t.tm_mon],'dow':[t.tm_wday],'dom':[t.tm_mday]}
-        tm2.schedule = CronSchedule()
-        tm2.schedule._schedule = {'minute':[t.tm_min],'hour':[t.tm_hour],'month':[t.tm_mon],'dow':[t.tm_wday],'dom':[t.tm_mday]}
+        tm1.schedule = CronSchedule(minute=str(t.tm_min), hour=str(t.tm_hour), month=str(t.tm_mon), dow=str(t.tm_wday), dom=str(t.tm_mday))
+        tm2.schedule = CronSchedule(minute=str(t.tm_min), hour=str(t.tm_hour), month=str(t.tm_mon), dow=str(t.tm_wday), dom=str(t.tm_mday))
         self.assertIsNotNone(tmi._enabled_methods[tm1.mid]['first'])
         self.assertIsNotNone(tmi._enabled_methods[tm2.mid]['first'])
         meet_tms = tmi._get_tms_that_meet(t=t)
@@ -474,6 +500,181 @@ class ApiModelTransferMethodsTest(unittest.TestCase):
         self.assertTrue(tm1 in meet_tms)
         self.assertTrue(tm2 in meet_tms)
 
+    @test.sync(loop)
+    async def test_cron_scheduler_success_due_tms_fired_in_one_batch(self):
+        ''' every cron tm due at the same instant should be fired in one batch and scheduled again '''
+        tm1 = transfer_methods.transfermethod(f=noop, schedule=CronSchedule())
+        tm2 = transfer_methods.transfermethod(f=noop, schedule=CronSchedule())
+        tm3 = transfer_methods.transfermethod(f=noop, schedule=CronSchedule())
+        for tm in (tm1, tm2, tm3):
+            tm._decorate_method(tm._f)
+            tm.run = test.AsyncMock(return_value=None)
+        tmi = TransferMethodsIndex()
+        for tm in (tm1, tm2, tm3):
+            self.assertTrue(tmi.add_tm(tm))
+        self.assertTrue(await tmi.enable_all())
+        self.assertTrue(tmi.disable_tm(tm3.mid))
+        self.assertEqual(len(tmi._cron._tokens), 2)
+        now = time.time()
+        for tm in (tm1, tm2):
+            tmi._cron.add(tm.mid, tm.schedule, after=now)
+        due = tmi._cron._heap[0][0]
+        self.assertEqual(due, now - now % 60 + 60)
+        self.assertEqual(tmi._cron._fire_due(due+0.5), 2)
+        await asyncio.sleep(0)
+        for tm in (tm1, tm2):
+            self.assertEqual(tm.run.call_count, 1)
+            self.assertEqual(tm.run.call_args[1]['t'].timestamp, due)
+        self.assertEqual(tm3.run.call_count, 0)
+        self.assertEqual(tmi._cron.stats['batches'], 1)
+        self.assertEqual(tmi._cron.stats['fired'], 2)
+        self.assertAlmostEqual(tmi._cron.stats['last_drift'], 0.5)
+        self.assertEqual(sorted(e[0] for e in tmi._cron._heap if tmi._cron._tokens.get(e[2]) is e[3]), [due+60, due+60])
+
+    @test.sync(loop)
+    async def test_cron_scheduler_success_seconds_schedule(self):
+        ''' tms with a seconds field should be scheduled at their next matching second '''
+        tm = transfer_methods.transfermethod(f=noop, schedule=CronSchedule(second='*/10'))
+        tm._decorate_method(tm._f)
+        tm.run = test.AsyncMock(return_value=None)
+        tmi = TransferMethodsIndex()
+        self.assertTrue(tmi.add_tm(tm))
+        self.assertTrue(await tmi.enable_tm(tm.mid))
+        now = 1500000003.5
+        tmi._cron.add(tm.mid, tm.schedule, after=now)
+        due = tmi._cron._heap[0][0]
+        self.assertEqual(due, 1500000010)
+        self.assertEqual(tmi._cron._fire_due(due), 1)
+        self.assertEqual(tmi._cron._heap[0][0], 1500000020)
+
+    @test.sync(loop)
+    async def test_get_telemetry_success(self):
+        ''' get_telemetry should return the telemetry of enabled and disabled tms '''
+        tm1 = transfer_methods.transfermethod(f=noop)
+        tm2 = transfer_methods.transfermethod(f=noop)
+        tm1._decorate_method(tm1._f)
+        tm2._decorate_method(tm2._f)
+        tmi = TransferMethodsIndex()
+        self.assertTrue(tmi.add_tm(tm1))
+        self.assertTrue(tmi.add_tm(tm2))
+        self.assertTrue(await tmi.enable_tm(tm1.mid))
+        tm1.telemetry.counters['success'] += 1
+        telemetry = tmi.get_telemetry()
+        self.assertEqual(sorted(telemetry.keys()), sorted([tm1.mid, tm2.mid]))
+        self.assertEqual(telemetry[tm1.mid]['name'], 'noop')
+        self.assertTrue(telemetry[tm1.mid]['enabled'])
+        self.assertFalse(telemetry[tm2.mid]['enabled'])
+        self.assertEqual(telemetry[tm1.mid]['counters']['success'], 1)
+        self.assertEqual(telemetry[tm1.mid]['stats'], {'runs':0, 'coalesced':0, 'skipped':0})
+
+    def _add_enabled_tm(self, tmi, activation_metrics, run=None, runs_now=True):
+        tm = Mock(mid=uuid.uuid4(), schedule=OnUpdateSchedule(activation_metrics=activation_metrics))
+        tm._runs_now = Mock(return_value=runs_now)
+        tm.run = test.AsyncMock(side_effect=run, return_value=[])
+        tmi._enabled_methods[tm.mid] = {'tm':tm, 'first':None}
+        tmi._index_tm(tm.mid)
+        return tm
+
+    def test_downstream_order_success_topological(self):
+        ''' downstream tms should be ordered after the tms that insert their activation metrics '''
+        m1, m2, m3 = Datapoint('m1'), Datapoint('m2'), Datapoint('m3')
+        tmi = TransferMethodsIndex()
+        tm_c = self._add_enabled_tm(tmi, [m1, m3])
+        tm_b = self._add_enabled_tm(tmi, [m2])
+        tm_a = self._add_enabled_tm(tmi, [m1])
+        tmi._outputs = {tm_a.mid:{m2}, tm_b.mid:{m3}}
+        self.assertEqual(tmi._downstream_order([m1]), [tm_a.mid, tm_b.mid, tm_c.mid])
+        self.assertEqual(tmi._downstream_order([m3]), [tm_c.mid])
+        tmi._outputs[tm_c.mid] = {m2}
+        self.assertEqual(len(tmi._downstream_order([m1])), 3)
+
+    @test.sync(loop)
+    async def test_propagate_success_downstream_tms_run_once_in_order(self):
+        ''' propagate should run downstream tms locally, each one once, and ignore samples already received '''
+        store = MetricStore()
+        session = Mock(username='user', store=store)
+        m1, m2, m3 = [Datapoint(uri, session=session) for uri in ('m1','m2','m3')]
+        t = timeuuid.TimeUUID()
+        calls = []
+        def run_b(**kwargs):
+            calls.append(('b', kwargs['metrics']))
+            return [Sample(m3, t, 2)]
+        def run_c(**kwargs):
+            calls.append(('c', kwargs['metrics']))
+            return []
+        tmi = TransferMethodsIndex()
+        tm_c = self._add_enabled_tm(tmi, [m2, m3], run=run_c)
+        tm_b = self._add_enabled_tm(tmi, [m2], run=run_b)
+        tmi._outputs[tm_b.mid] = {m3}
+        source = uuid.uuid4()
+        await tmi.propagate(source, [Sample(m2, t, 1), Sample(m1, t, 0)])
+        self.assertEqual(calls, [('b', [m2]), ('c', [m2, m3])])
+        self.assertEqual(tm_c.request_run.call_count, 0)
+        self.assertFalse(tm_b.run.call_args[1]['propagate'])
+        self.assertTrue(store.is_in(m2, t, 1))
+        self.assertTrue(store.is_in(m3, t, 2))
+        self.assertFalse(store.is_in(m1, t, 0))
+        self.assertEqual(tmi._outputs, {source:{m1, m2}, tm_b.mid:{m3}})
+        await tmi.propagate(source, [Sample(m2, t, 1)])
+        self.assertEqual(len(calls), 2)
+
+    @test.sync(loop)
+    async def test_propagate_success_tm_updated_after_running_requested(self):
+        ''' tms updated after running in the cascade should be requested, not run again '''
+        store = MetricStore()
+        session = Mock(username='user', store=store)
+        m1, m2 = [Datapoint(uri, session=session) for uri in ('m1','m2')]
+        t = timeuuid.TimeUUID()
+        tmi = TransferMethodsIndex()
+        tm_b = self._add_enabled_tm(tmi, [m1], run=lambda **kwargs: [Sample(m2, t, 2)])
+        tm_a = self._add_enabled_tm(tmi, [m1, m2])
+        tmi._outputs[tm_a.mid] = {m1}
+        await tmi.propagate(uuid.uuid4(), [Sample(m1, t, 1)])
+        self.assertEqual(tm_a.run.call_count, 1)
+        self.assertEqual(tm_b.run.call_count, 1)
+        tm_a.request_run.assert_called_once_with(t=t, metrics=[m2], irt=None)
+
+    @test.sync(loop)
+    async def test_propagate_success_tm_delayed_by_its_options_requested(self):
+        ''' tms that would not run now because of coalesce, min_interval or skip_if_running should be requested '''
+        store = MetricStore()
+        session = Mock(username='user', store=store)
+        m1, m2 = [Datapoint(uri, session=session) for uri in ('m1','m2')]
+        t = timeuuid.TimeUUID()
+        tmi = TransferMethodsIndex()
+        tm_a = self._add_enabled_tm(tmi, [m1], runs_now=False)
+        tm_b = self._add_enabled_tm(tmi, [m1, m2])
+        tmi._outputs[tm_a.mid] = {m2}
+        await tmi.propagate(uuid.uuid4(), [Sample(m1, t, 1)])
+        self.assertEqual(tm_a.run.call_count, 0)
+        tm_a.request_run.assert_called_once_with(t=t, metrics=[m1], irt=None)
+        self.assertEqual(tm_b.run.call_count, 1)
+        self.assertEqual(tm_b.run.call_args[1]['metrics'], [m1])
+
+    @test.sync(loop)
+    async def test_admission_controller_success_queued_by_priority(self):
+        ''' executions over max_running should wait, and be admitted by priority and arrival order '''
+        ac = AdmissionController(max_running=1)
+        admitted = []
+        async def run(name, priority):
+            await ac.acquire(priority)
+            admitted.append(name)
+        await ac.acquire('normal')
+        tasks = [asyncio.ensure_future(run(name, priority)) for name, priority in (('low','low'),('normal1','normal'),('high','high'),('normal2','normal'))]
+        await asyncio.sleep(0)
+        self.assertEqual(ac.running, 1)
+        self.assertEqual(ac.queue_length, 4)
+        tasks[3].cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(ac.queue_length, 3)
+        for i in range(3):
+            ac.release()
+            await asyncio.sleep(0)
+        self.assertEqual(admitted, ['high','normal1','low'])
+        self.assertEqual(ac.running, 1)
+        self.assertEqual(ac.queue_length, 0)
+        self.assertEqual(ac.stats, {'admitted':4, 'queued':4, 'max_queue_length':4})
+
     @test.sync(loop)
     async def test_retry_failed_success_no_disabled_tms(self):
         ''' retry_failed should return True if no disabled tms exist '''
@@ -0,0 +1,86 @@
+import unittest
+import asyncio
+import pandas as pd
+from komlogd.api.common.timeuuid import TimeUUID
+from komlogd.api.model import test
+from komlogd.api.model.metrics import Datapoint
+from komlogd.api.model.windows import MetricWindow
+from unittest.mock import Mock
+
+loop = asyncio.get_event_loop()
+
+class ApiModelWindowsTest(unittest.TestCase):
+
+    def test_MetricWindow_append_success_keeps_order_and_replaces(self):
+        ''' append should keep samples ordered and replace samples with the same t '''
+        w = MetricWindow(metric=Datapoint('uri'), size=10)
+        t1 = TimeUUID(100)
+        t2 = TimeUUID(200)
+        t3 = TimeUUID(300)
+        w.append(t3, 3)
+        w.append(t1, 1)
+        w.append(t2, 2)
+        w.append(t2, 22)
+        self.assertEqual(list(w.series().index), [t1, t2, t3])
+        self.assertEqual(list(w.series().values), [1, 22, 3])
+
+    def test_MetricWindow_append_success_count_window_pruned(self):
+        ''' count based windows should keep the last size samples only '''
+        w = MetricWindow(metric=Datapoint('uri'), size=2)
+        ts = [TimeUUID(i) for i in range(1,5)]
+        for i,t in enumerate(ts):
+            w.append(t, i)
+        self.assertEqual(list(w.series().index), ts[2:])
+        w.append(ts[0], 0)
+        self.assertEqual(list(w.series().index), ts[2:])
+        s = w.series()
+        self.assertEqual(list(s.index), ts[2:])
+        self.assertEqual(list(w.series(ts[2]).index), [ts[2]])
+
+    def test_MetricWindow_append_success_duration_window_pruned(self):
+        ''' duration based windows should keep the samples within the duration of the last one '''
+        w = MetricWindow(metric=Datapoint('uri'), size=pd.Timedelta('10s'))
+        ts = [TimeUUID(i) for i in (100, 105, 110, 115)]
+        for i,t in enumerate(ts):
+            w.append(t, i)
+        self.assertEqual(list(w.series().index), ts[2:])
+        self.assertEqual(list(w.series().index), ts[2:])
+        self.assertEqual(list(w.series(ts[2]).index), [ts[2]])
+
+    def test_MetricWindow_series_success_views_not_modified_by_later_samples(self):
+        ''' series returned should not change when samples are added, replaced or inserted later '''
+        w = MetricWindow(metric=Datapoint('uri'), size=3)
+        ts = [TimeUUID(i) for i in range(1,100)]
+        for i,t in enumerate(ts[:3]):
+            w.append(t, i)
+        s = w.series()
+        w.append(ts[1], 11)
+        w.append(ts[3], 3)
+        late = TimeUUID(3.5)
+        w.append(late, 35)
+        self.assertEqual(list(s.index), ts[:3])
+        self.assertEqual(list(s.values), [0, 1, 2])
+        self.assertEqual(list(w.series().index), [ts[2], late, ts[3]])
+        # the arrays are compacted instead of growing while the window size is kept
+        for i,t in enumerate(ts[4:]):
+            w.append(t, i)
+        self.assertEqual(len(w), 3)
+        self.assertEqual(list(w.series().index), ts[-3:])
+        self.assertTrue(len(w._ts) <= 16)
+
+    @test.sync(loop)
+    async def test_MetricWindow_load_success_requested_once(self):
+        ''' load should request the window to the store only the first time '''
+        t1 = TimeUUID(100)
+        t2 = TimeUUID(200)
+        store = Mock()
+        store.get = test.AsyncMock(return_value=pd.Series(index=[t1], data=[1]))
+        metric = Datapoint('uri', session=Mock(username='user', store=store))
+        w = MetricWindow(metric=metric, size=pd.Timedelta('500s'))
+        await w.load(t2)
+        await w.load(t2)
+        self.assertEqual(store.get.call_count, 1)
+        self.assertEqual(store.get.call_args[1]['end'], t2)
+        self.assertEqual(store.get.call_args[1]['start'].timestamp, t2.timestamp-500)
+        self.assertEqual(list(w.series().index), [t1])
+
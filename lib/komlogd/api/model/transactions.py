@@ -2,17 +2,51 @@ import asyncio
 import uuid
 import time
 import sys
+import weakref
 from komlogd.api.common import logging, exceptions
 
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+# Transaction of the running context. Tasks copy the context of the task that creates
+# them, so they inherit its transaction. Without contextvars (python < 3.7) every task
+# is created as a TransactionTask by the loop task factory instead.
+_current_tr = contextvars.ContextVar('komlogd_transaction', default=None) if contextvars else None
+
+def get_tr():
+    ''' Returns the transaction of the running task, None if it does not run inside any '''
+    if _current_tr is not None:
+        return _current_tr.get()
+    return asyncio.Task.current_task().get_tr()
+
+# Transactions not finished yet. Each one is a snapshot of the store data at its tm,
+# so versions of a sample newer than the oldest tm must be kept.
+_snapshots = weakref.WeakValueDictionary()
+
+def oldest_snapshot():
+    ''' Returns the tm of the oldest transaction not finished yet, None if there is none '''
+    tms = [tr.tm for tr in list(_snapshots.values())]
+    return min(tms) if tms else None
+
+async def _run_in_tr(coro, tr):
+    _current_tr.set(tr)
+    return await coro
 
 class TransactionTask(asyncio.Task):
 
     def __init__(self, coro, *, loop=None, tr=None):
-        super().__init__(coro, loop=loop)
         if tr is None:
-            ct = self.current_task(loop=self._loop)
-            if ct is not None:
-                tr = ct.get_tr()
+            if _current_tr is not None:
+                tr = _current_tr.get()
+            else:
+                ct = asyncio.Task.current_task(loop=loop)
+                if ct is not None:
+                    tr = ct.get_tr()
+        elif _current_tr is not None:
+            coro = _run_in_tr(coro, tr)
+        super().__init__(coro, loop=loop)
         self._tr = tr
 
     def get_tr(self):
@@ -25,6 +59,11 @@ class Transaction:
         self.t = t
         self.irt = irt
         self._dirty = set()
+        # time spent fetching data from the store in this transaction
+        self.fetch_time = 0
+        # samples sent to the server on commit
+        self.committed = []
+        _snapshots[self.tid] = self
 
     async def __aenter__(self):
         logging.logger.debug('Entering transaction {}'.format(self.tid.hex))
@@ -41,7 +80,15 @@ class Transaction:
         await asyncio.gather(*tasks)
         self._dirty = set()
 
+    def inserted_samples(self):
+        ''' Returns the samples inserted in the transaction, without commiting them '''
+        samples = []
+        for item in self._dirty:
+            samples.extend(item._tr_inserted_samples(self))
+        return samples
+
     def discard(self):
+        _snapshots.pop(self.tid, None)
         for item in self._dirty:
             item._tr_discard(self)
         self._dirty = set()
@@ -50,15 +97,16 @@ class Transaction:
         self._dirty.add(item)
 
 
-loop = asyncio.get_event_loop()
-loop.set_task_factory(lambda loop, coro: TransactionTask(coro, loop=loop))
+def _task_factory(loop, coro):
+    return TransactionTask(coro, loop=loop)
 
 if sys.platform == 'win32':
     loop = asyncio.ProactorEventLoop()
-    loop.set_task_factory(lambda loop, coro: TransactionTask(coro, loop=loop))
     asyncio.set_event_loop(loop)
 else:
     loop = asyncio.get_event_loop()
-    loop.set_task_factory(lambda loop, coro: TransactionTask(coro, loop=loop))
+
+if _current_tr is None:
+    loop.set_task_factory(_task_factory)
 
 
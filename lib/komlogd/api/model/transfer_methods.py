@@ -5,16 +5,168 @@ Transfer Methods
 '''
 
 import asyncio
+import heapq
+import itertools
 import time
+import weakref
 import pandas as pd
 from komlogd.api.common import logging, exceptions, timeuuid
 from komlogd.api.model import schedules
 
+class CronScheduler:
+    '''
+    Single timer for every CronSchedule tm of an index. Keeps the next fire time of
+    each tm in a heap, sleeps until the earliest one and fires every tm due at that
+    instant in one batch.
+    '''
+
+    def __init__(self, index):
+        self._index = index
+        self._heap = []
+        self._tokens = {}
+        self._seq = itertools.count()
+        self._task = None
+        self._wakeup = None
+        self.stats = {'batches':0, 'fired':0, 'last_drift':0, 'max_drift':0}
+
+    def add(self, mid, schedule, after=None):
+        after = after if after != None else time.time()
+        self._tokens[mid] = token = object()
+        self._push(mid, schedule, after, token)
+        if self._task == None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        elif self._wakeup and not self._wakeup.done() and self._heap and self._heap[0][2] == mid:
+            # new earliest fire time, the timer must be rescheduled
+            self._wakeup.set_result(True)
+
+    def remove(self, mid):
+        # entries in the heap are discarded when they are due
+        self._tokens.pop(mid, None)
+
+    def _push(self, mid, schedule, after, token):
+        ts = schedule.next_after(after)
+        if ts != None:
+            heapq.heappush(self._heap, (ts, next(self._seq), mid, token))
+
+    async def _run(self):
+        while self._heap:
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._wakeup = asyncio.Future()
+                await asyncio.wait([self._wakeup], timeout=delay)
+                self._wakeup = None
+            else:
+                self._fire_due(time.time())
+                await asyncio.sleep(0)
+
+    def _fire_due(self, now):
+        due = self._heap[0][0]
+        batch = []
+        while self._heap and self._heap[0][0] <= now:
+            ts, seq, mid, token = heapq.heappop(self._heap)
+            if self._tokens.get(mid, None) is token:
+                batch.append((ts, mid, token))
+        if not batch:
+            return 0
+        fired = 0
+        # tms fired at the same instant share t, so their samples can be sent together
+        ticks = {}
+        for ts, mid, token in batch:
+            tm_info = self._index.get_tm_info(mid)
+            if not (tm_info and tm_info['enabled']):
+                self._tokens.pop(mid, None)
+                continue
+            logging.logger.debug('periodic_transfer_method_call '+mid.hex)
+            queued = time.monotonic()-(now-ts)
+            if ts not in ticks:
+                ticks[ts] = timeuuid.TimeUUID(t=ts)
+            asyncio.ensure_future(tm_info['tm'].run(t=ticks[ts], metrics=[], queued=queued))
+            fired += 1
+            # instants missed while the loop was blocked are not fired again
+            self._push(mid, tm_info['tm'].schedule, max(ts, now), token)
+        drift = now - due
+        self.stats['batches'] += 1
+        self.stats['fired'] += fired
+        self.stats['last_drift'] = drift
+        self.stats['max_drift'] = max(self.stats['max_drift'], drift)
+        logging.logger.debug('cron batch fired {} tms. drift: {:.3f} s'.format(fired, drift))
+        return fired
+
+PRIORITIES = {'high':0, 'normal':1, 'low':2}
+
+class AdmissionController:
+    '''
+    Global limit of tm executions running at a time. Executions beyond max_running
+    wait in a queue, served by priority class and then in arrival order.
+    '''
+
+    def __init__(self, max_running=100):
+        self.max_running = max_running
+        self._running = 0
+        self._queue = []
+        self._waiting = 0
+        self._seq = itertools.count()
+        self.stats = {'admitted':0, 'queued':0, 'max_queue_length':0}
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queue_length(self):
+        ''' waiters not admitted nor cancelled. Cancelled ones are left in the heap until popped '''
+        return self._waiting
+
+    async def acquire(self, priority='normal'):
+        if self._running < self.max_running and self.queue_length == 0:
+            self._running += 1
+            self.stats['admitted'] += 1
+            return
+        waiter = asyncio.Future()
+        heapq.heappush(self._queue, (PRIORITIES[priority], next(self._seq), waiter))
+        self._waiting += 1
+        self.stats['queued'] += 1
+        self.stats['max_queue_length'] = max(self.stats['max_queue_length'], self._waiting)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._waiting -= 1
+            elif waiter.done():
+                # admitted while being cancelled, pass the slot to the next one
+                self.release()
+            raise
+        self.stats['admitted'] += 1
+
+    def release(self):
+        self._running -= 1
+        while self._queue and self._running < self.max_running:
+            priority, seq, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                self._running += 1
+                self._waiting -= 1
+                waiter.set_result(True)
+
 class TransferMethodsIndex:
+    _instances = weakref.WeakSet()
 
     def __init__(self):
         self._enabled_methods={}
         self._disabled_methods = {}
+        # activation metric -> mids of the enabled tms activated with it
+        self._activated_by = {}
+        self._indexed = {}
+        # mid -> metrics inserted by the tm in its commits
+        self._outputs = {}
+        self._cron = CronScheduler(self)
+        self.admission = AdmissionController()
+        TransferMethodsIndex._instances.add(self)
+
+    @classmethod
+    def schedule_updated(cls, mid):
+        ''' notifies every index that the schedule of the tm has changed '''
+        for index in list(cls._instances):
+            index.reindex_tm(mid)
 
     def add_tm(self, tm):
         if self.get_tm_info(tm.mid):
@@ -28,13 +180,17 @@ class TransferMethodsIndex:
             logging.logger.debug('enabling tm '+mid.hex)
             try:
                 logging.logger.debug('tm activation metrics: '+str([m.uri for m in tm_info['tm'].schedule.activation_metrics]))
+                by_store = {}
                 for metric in tm_info['tm'].schedule.activation_metrics:
-                    result = await metric.session.store.hook(metric=metric)
-                    if result['hooked'] == False:
-                        logging.logger.error('Error syncing metric {}. Aborting tm initialization'.format(metric.uri))
-                        return False
+                    by_store.setdefault(metric.session.store, []).append(metric)
+                for store, metrics in by_store.items():
+                    results = await store.hook_many(metrics)
+                    for metric, result in results.items():
+                        if result['hooked'] == False:
+                            logging.logger.error('Error syncing metric {}. Aborting tm initialization'.format(metric.uri))
+                            return False
             except (exceptions.SessionException, exceptions.SessionNotFoundException) as e:
-                logging.logger.error('Error syncing metric {}. Aborting tm initialization'.format(metric.uri))
+                logging.logger.error('Error syncing metrics of tm {}. Aborting tm initialization'.format(mid.hex))
                 logging.logger.error('Error: {}.'.format(e.msg))
                 self._disabled_methods[mid]=tm_info
                 if tm_info['first'] == None:
@@ -46,10 +202,9 @@ class TransferMethodsIndex:
                     tm_info['first'] = now
                     if tm_info['tm'].schedule.exec_on_load:
                         t = timeuuid.TimeUUID()
-                        asyncio.ensure_future(tm_info['tm'].run(t=t, metrics=[]))
+                        asyncio.ensure_future(tm_info['tm'].run(t=t, metrics=[], queued=time.monotonic()))
             self._enabled_methods[mid] = tm_info
-            if isinstance(tm_info['tm'].schedule, schedules.CronSchedule):
-                asyncio.ensure_future(self._periodic_transfer_method_call(mid))
+            self._index_tm(mid)
             return True
         elif mid in self._enabled_methods:
             logging.logger.debug('tm already enabled '+mid.hex)
@@ -62,6 +217,7 @@ class TransferMethodsIndex:
         tm_info = self._enabled_methods.pop(mid, None)
         if tm_info:
             logging.logger.debug('disabling tm '+mid.hex)
+            self._unindex_tm(mid)
             self._disabled_methods[mid] = tm_info
             return True
         elif mid in self._disabled_methods:
@@ -72,6 +228,8 @@ class TransferMethodsIndex:
             return False
 
     def delete_tm(self, mid):
+        self._unindex_tm(mid)
+        self._outputs.pop(mid, None)
         self._enabled_methods.pop(mid,None)
         self._disabled_methods.pop(mid,None)
         return True
@@ -98,17 +256,180 @@ class TransferMethodsIndex:
         else:
             return None
 
+    def get_telemetry(self):
+        ''' Returns the execution telemetry of every transfer method of the index, by mid '''
+        telemetry = {}
+        tm_infos = [(True, info) for info in self._enabled_methods.values()]
+        tm_infos.extend((False, info) for info in self._disabled_methods.values())
+        for enabled, tm_info in tm_infos:
+            tm = tm_info['tm']
+            tm_telemetry = getattr(tm, 'telemetry', None)
+            if tm_telemetry is None:
+                continue
+            item = tm_telemetry.to_dict()
+            item['name'] = getattr(getattr(tm, 'f', None), '__name__', None)
+            item['enabled'] = enabled
+            item['stats'] = dict(getattr(tm, 'stats', {}))
+            telemetry[tm.mid] = item
+        return telemetry
+
+    async def dump_telemetry(self, interval=60):
+        ''' logs the telemetry of every transfer method each interval seconds '''
+        while True:
+            await asyncio.sleep(interval)
+            for mid, item in self.get_telemetry().items():
+                logging.logger.info('tm {} ({}): {}'.format(mid.hex, item['name'], str({k:v for k,v in item.items() if k not in ('name',)})))
+            logging.logger.info('tm admission: running {}, queue length {}, {}'.format(self.admission.running, self.admission.queue_length, str(self.admission.stats)))
+
     def metrics_updated(self, t, metrics, irt):
         tms = self._get_tms_activated_with(metrics)
         for tm in tms:
             logging.logger.debug('Requesting execution of tm: '+ tm.mid.hex)
-            asyncio.ensure_future(tm.run(t=t, metrics=metrics, irt=irt))
+            tm.request_run(t=t, metrics=metrics, irt=irt)
+
+    async def propagate(self, mid, samples, irt=None):
+        '''
+        Runs locally the tms activated by the samples commited by tm mid, instead of
+        waiting for the server to send them back. Downstream tms are run in topological
+        order of the graph built from their activation metrics and the metrics they insert,
+        so each one runs once per cascade. Tms updated again after running, because the
+        graph edges were not learned yet or form a cycle, are requested as if the samples
+        came from the server. Samples already received from the server are ignored, and
+        samples dispatched here are ignored when the server sends them.
+        '''
+        self._add_outputs(mid, samples)
+        by_t = {}
+        for sample in samples:
+            by_t.setdefault(sample.t, []).append(sample)
+        for t in sorted(by_t.keys()):
+            await self._cascade(t, by_t[t], irt)
+
+    async def _cascade(self, t, samples, irt):
+        updated = self._store_dispatched(samples)
+        done = set()
+        pending = []
+        while updated:
+            tm = None
+            for mid in self._downstream_order(updated):
+                if mid not in done and any(m in self._indexed[mid] for m in updated):
+                    tm = self._enabled_methods[mid]['tm']
+                    break
+            if tm is None:
+                break
+            done.add(mid)
+            metrics = [m for m in updated if m in self._indexed[mid]]
+            if not tm._runs_now():
+                # coalesce, min_interval and skip_if_running apply as to any other update,
+                # its samples are propagated when it runs
+                tm.request_run(t=t, metrics=metrics, irt=irt)
+                continue
+            logging.logger.debug('Running downstream tm: '+mid.hex)
+            committed = await tm.run(t=t, metrics=metrics, irt=irt, queued=time.monotonic(), propagate=False)
+            if committed:
+                self._add_outputs(mid, committed)
+                new = [m for m in self._store_dispatched([s for s in committed if s.t == t]) if m not in updated]
+                updated.extend(new)
+                for done_mid in done:
+                    again = [m for m in new if m in self._indexed.get(done_mid, ())]
+                    if again:
+                        self._enabled_methods[done_mid]['tm'].request_run(t=t, metrics=again, irt=irt)
+                pending.extend(s for s in committed if s.t != t)
+        if pending:
+            by_t = {}
+            for sample in pending:
+                by_t.setdefault(sample.t, []).append(sample)
+            for t in sorted(by_t.keys()):
+                await self._cascade(t, by_t[t], irt)
+
+    def _add_outputs(self, mid, samples):
+        self._outputs.setdefault(mid, set()).update(s.metric for s in samples)
+
+    def _store_dispatched(self, samples):
+        '''
+        Stores the samples of metrics that activate any tm. Returns the metrics stored,
+        skipping samples the server already sent us, whose tms were already requested.
+        '''
+        metrics = []
+        for sample in samples:
+            if sample.metric not in self._activated_by:
+                continue
+            try:
+                store = sample.metric.session.store
+            except exceptions.SessionNotFoundException:
+                continue
+            if store.is_in(metric=sample.metric, t=sample.t, value=sample.value):
+                continue
+            store.insert(sample.metric, sample.t, sample.value)
+            if sample.metric not in metrics:
+                metrics.append(sample.metric)
+        return metrics
+
+    def _downstream_order(self, metrics):
+        ''' Returns the enabled tms reachable from metrics, in topological order '''
+        nodes = []
+        queue = list(metrics)
+        seen = set()
+        while queue:
+            metric = queue.pop(0)
+            if metric in seen:
+                continue
+            seen.add(metric)
+            for mid in sorted(self._activated_by.get(metric, []), key=lambda x: x.hex):
+                if mid not in nodes:
+                    nodes.append(mid)
+                    queue.extend(self._outputs.get(mid, []))
+        indegree = {mid:0 for mid in nodes}
+        edges = {}
+        for u in nodes:
+            outputs = self._outputs.get(u, set())
+            edges[u] = [v for v in nodes if v != u and not outputs.isdisjoint(self._indexed[v])]
+            for v in edges[u]:
+                indegree[v] += 1
+        order = []
+        while len(order) < len(nodes):
+            ready = [mid for mid in nodes if mid not in order and indegree[mid] == 0]
+            if not ready:
+                # cycle, break it with the first tm remaining
+                ready = [mid for mid in nodes if mid not in order]
+            mid = ready[0]
+            order.append(mid)
+            for v in edges[mid]:
+                indegree[v] -= 1
+        return order
+
+    def reindex_tm(self, mid):
+        ''' updates the activation metrics index of an enabled tm, after its schedule changes '''
+        if mid in self._enabled_methods:
+            self._unindex_tm(mid)
+            self._index_tm(mid)
+
+    def _index_tm(self, mid):
+        schedule = self._enabled_methods[mid]['tm'].schedule
+        if isinstance(schedule, schedules.CronSchedule):
+            self._cron.add(mid, schedule)
+        metrics = set(schedule.activation_metrics)
+        for metric in metrics:
+            self._activated_by.setdefault(metric, set()).add(mid)
+        self._indexed[mid] = metrics
+
+    def _unindex_tm(self, mid):
+        self._cron.remove(mid)
+        for metric in self._indexed.pop(mid, []):
+            mids = self._activated_by.get(metric, None)
+            if mids != None:
+                mids.discard(mid)
+                if not mids:
+                    del self._activated_by[metric]
 
     def _get_tms_activated_with(self, metrics, enabled=True):
         if enabled:
-            all_tms = [tm_info['tm'] for tm_info in self._enabled_methods.values()]
-        else:
-            all_tms = [tm_info['tm'] for tm_info in self._disabled_methods.values()]
+            mids = []
+            for m in metrics:
+                for mid in self._activated_by.get(m, []):
+                    if mid not in mids:
+                        mids.append(mid)
+            return [self._enabled_methods[mid]['tm'] for mid in mids]
+        all_tms = [tm_info['tm'] for tm_info in self._disabled_methods.values()]
         tms =  []
         for tm in all_tms:
             for m in metrics:
@@ -129,18 +450,6 @@ class TransferMethodsIndex:
                     tms.append(tm_info['tm'])
         return tms
 
-    async def _periodic_transfer_method_call(self, mid):
-        t = timeuuid.TimeUUID()
-        await asyncio.sleep(60-t.timestamp%60)
-        t=timeuuid.TimeUUID(t=t.timestamp+(60-t.timestamp%60))
-        localtime = time.localtime(t.timestamp)
-        tm_info = self.get_tm_info(mid)
-        if (tm_info and tm_info['enabled']):
-            if tm_info['tm'].schedule.meets(t=localtime):
-                logging.logger.debug('periodic_transfer_method_call '+mid.hex)
-                await tm_info['tm'].run(t=t, metrics=[])
-            asyncio.ensure_future(self._periodic_transfer_method_call(mid))
-
     async def _retry_failed(self, sleep=5):
         if getattr(self, '_retry_task', None) != None and self._retry_task.done() == False:
             return False
@@ -0,0 +1,136 @@
+'''
+
+Metric windows
+
+Last samples of a metric, kept up to date with the data stored, so transfer
+methods don't need to request the whole interval on every run.
+
+'''
+
+import bisect
+import numpy as np
+import pandas as pd
+from komlogd.api.common import timeuuid
+from komlogd.api.model.store import to_store_value
+
+
+class MetricWindow:
+    '''
+    Samples are kept ordered by t in preallocated arrays. New samples are written
+    after the last one and pruned samples are left behind the head, so series()
+    returns views of the arrays that later samples don't modify. The arrays are
+    compacted, or grown, once the last position is reached.
+    '''
+
+    def __init__(self, metric, size):
+        '''
+        size is the number of samples (int) or the time interval (pd.Timedelta) to keep.
+        '''
+        self.metric = metric
+        self.size = size
+        capacity = max(16, 2*size) if self.count_based else 64
+        self._ts = np.empty(capacity, dtype=object)
+        self._values = np.empty(capacity, dtype=object)
+        self._head = 0
+        self._tail = 0
+        self._loaded = False
+
+    def __len__(self):
+        return self._tail - self._head
+
+    @property
+    def count_based(self):
+        return not isinstance(self.size, pd.Timedelta)
+
+    def append(self, t, value):
+        ''' adds the sample, keeping samples ordered by t. Existing samples are replaced '''
+        value = to_store_value(value)
+        if self._head == self._tail or t > self._ts[self._tail-1]:
+            self._reserve()
+            self._ts[self._tail] = t
+            self._values[self._tail] = value
+            self._tail += 1
+        else:
+            i = bisect.bisect_left(self._ts, t, self._head, self._tail)
+            if i < self._tail and self._ts[i] == t:
+                self._copy()
+                self._values[i-self._head] = value
+                self._head, self._tail = 0, self._tail-self._head
+                return
+            if self.count_based and i == self._head and len(self) >= self.size:
+                # older than every sample of a full window
+                return
+            # late samples are inserted in new arrays, not to modify the views already returned
+            self._copy(insert=i)
+            i -= self._head
+            self._head, self._tail = 0, self._tail-self._head+1
+            self._ts[i] = t
+            self._values[i] = value
+        self._prune()
+
+    def _reserve(self):
+        ''' makes room for a new sample after the last one '''
+        if self._tail < len(self._ts):
+            return
+        self._copy()
+        self._head, self._tail = 0, self._tail-self._head
+
+    def _copy(self, insert=None):
+        '''
+        copies the live samples to the start of new arrays, leaving a free position
+        before insert if set. Head and tail must be updated by the caller.
+        '''
+        live = self._tail - self._head
+        capacity = len(self._ts)
+        if (live+1)*2 > capacity:
+            capacity = (live+1)*2
+        ts = np.empty(capacity, dtype=object)
+        values = np.empty(capacity, dtype=object)
+        if insert is None:
+            ts[:live] = self._ts[self._head:self._tail]
+            values[:live] = self._values[self._head:self._tail]
+        else:
+            before = insert - self._head
+            ts[:before] = self._ts[self._head:insert]
+            values[:before] = self._values[self._head:insert]
+            ts[before+1:live+1] = self._ts[insert:self._tail]
+            values[before+1:live+1] = self._values[insert:self._tail]
+        self._ts = ts
+        self._values = values
+
+    def _prune(self):
+        if self.count_based:
+            self._head = max(self._head, self._tail - self.size)
+        else:
+            limit = self._ts[self._tail-1].timestamp - self.size.total_seconds()
+            while self._ts[self._head].timestamp <= limit:
+                self._head += 1
+
+    async def load(self, t):
+        ''' requests the window ending at t to the store the first time '''
+        if self._loaded:
+            return
+        if self.count_based:
+            data = await self.metric.get(end=t, count=self.size)
+        else:
+            start = timeuuid.TimeUUID(t=t.timestamp-self.size.total_seconds(), lowest=True)
+            data = await self.metric.get(start=start, end=t)
+        if data is not None:
+            for ts, value in data.items():
+                self.append(ts, value)
+        self._loaded = True
+
+    def series(self, t=None):
+        ''' returns the window ending at t as a pandas Series, a view of the samples kept '''
+        end = self._tail if t == None else bisect.bisect_right(self._ts, t, self._head, self._tail)
+        start = self._head
+        if self.count_based:
+            start = max(start, end - self.size)
+        elif end > start:
+            limit = self._ts[end-1].timestamp if t == None else t.timestamp
+            limit = timeuuid.TimeUUID(t=limit-self.size.total_seconds(), highest=True)
+            start = bisect.bisect_right(self._ts, limit, start, end)
+        index = pd.Index(self._ts[start:end], dtype=object, copy=False)
+        s = pd.Series(self._values[start:end], index=index, dtype=object, copy=False)
+        s.name = self.metric
+        return s
@@ -8,6 +8,22 @@ from komlogd.api.protocol.codes import Status
 from komlogd.api.model.schedules import OnUpdateSchedule, CronSchedule
 from komlogd.api.model.metrics import Metrics, Datasource, Datapoint, Metric, Sample
 
+def _samples_message(t, smpls, irt):
+    if len(smpls)>1:
+        uris = []
+        for smp in smpls:
+            uris.append({
+                'uri':smp.metric.uri,
+                'type':smp.metric._m_type_.value,
+                'content':smp.value,
+            })
+        return messages.SendMultiData(t=t, uris=uris, irt=irt)
+    elif isinstance(smpls[0].metric, Datasource):
+        return messages.SendDsData(uri=smpls[0].metric.uri, t=t, content=smpls[0].value, irt=irt)
+    elif isinstance(smpls[0].metric, Datapoint):
+        return messages.SendDpData(uri=smpls[0].metric.uri, t=t, content=smpls[0].value, irt=irt)
+    return None
+
 async def send_samples(samples, irt=None):
     by_session_samples = {}
     for sample in samples:
@@ -22,19 +38,14 @@ async def send_samples(samples, irt=None):
     for session, ts in by_session_samples.items():
         msgs = []
         for t,smpls in ts.items():
-            if len(smpls)>1:
-                uris = []
-                for smp in smpls:
-                    uris.append({
-                        'uri':smp.metric.uri,
-                        'type':smp.metric._m_type_.value,
-                        'content':smp.value,
-                    })
-                msgs.append(messages.SendMultiData(t=t, uris=uris, irt=irt))
-            elif isinstance(smpls[0].metric, Datasource):
-                msgs.append(messages.SendDsData(uri=smpls[0].metric.uri, t=t, content=smpls[0].value, irt=irt))
-            elif isinstance(smpls[0].metric, Datapoint):
-                msgs.append(messages.SendDpData(uri=smpls[0].metric.uri, t=t, content=smpls[0].value, irt=irt))
+            # samples of each connection are sent in their own message, to keep the order per uri
+            shards = {}
+            for smp in smpls:
+                shards.setdefault(session.shard(smp.metric.uri), []).append(smp)
+            for smpls in shards.values():
+                msg = _samples_message(t, smpls, irt)
+                if msg:
+                    msgs.append(msg)
         msgs.sort(key=lambda x: x.t)
         for msg in msgs:
             rsp = await session.send_message(msg)
@@ -49,43 +60,73 @@ async def send_samples(samples, irt=None):
                 response['success'] = False
     return response
 
+class DataIntervalStream:
+    '''
+    Async iterator over the data chunks received in response to a RequestData message.
+    Each iteration returns the list of (t, value) tuples of a SendDataInterval chunk, in
+    ascending order. Raises SessionException if the request fails.
+    '''
+
+    def __init__(self, metric, start, end, count=None):
+        self.metric = metric
+        self.start = start
+        self.end = end
+        self.count = count
+        self._msg = None
+        self._done = False
+        self._done_start = False if start else True
+        self._done_end = False if end else True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+        session = self.metric.session
+        if self._msg is None:
+            self._msg = messages.RequestData(uri=self.metric.uri, start=self.start, end=self.end, count=self.count)
+            rsp = await session.send_message(self._msg)
+        else:
+            rsp = await session._mark_message_undone(self._msg.seq)
+        while True:
+            if not isinstance(rsp, messages.KomlogMessage):
+                self.close()
+                logging.logger.debug('Error requesting data for {}. {}'.format(str(self.metric.uri),'Unknown response'))
+                raise exceptions.SessionException('Unknown response')
+            elif rsp.action == messages.Actions.GENERIC_RESPONSE:
+                if rsp.status != Status.MESSAGE_ACCEPTED_FOR_PROCESSING:
+                    self.close()
+                    logging.logger.debug('Error requesting data for {}. {}'.format(str(self.metric.uri),str(rsp.__dict__)))
+                    raise exceptions.SessionException(str(rsp.__dict__))
+                rsp = await session._mark_message_undone(self._msg.seq)
+            elif rsp.action == messages.Actions.SEND_DATA_INTERVAL:
+                if self.start and rsp.start == self.start:
+                    self._done_start = True
+                if self.end and rsp.end == self.end:
+                    self._done_end = True
+                if self._done_start and self._done_end:
+                    self.close()
+                else:
+                    # the consumer may hold the chunk longer than response_timeout, the deadline
+                    # starts again with the next iteration
+                    session._hold_message(self._msg.seq)
+                return [(row[0],row[1]) for row in rsp.data[::-1]]
+
+    def close(self):
+        ''' stops waiting for more chunks '''
+        self._done = True
+        if self._msg:
+            self.metric.session._mark_message_done(self._msg.seq)
+
 async def request_data(metric, start, end, count):
-    msg = messages.RequestData(uri=metric.uri, start=start, end=end, count=count)
-    rsp = await metric.session.send_message(msg)
-    done = False
-    done_start = False if start else True
-    done_end = False if end else True
     response = {'success':True, 'data':[],'error':None}
-    while not done:
-        if not isinstance(rsp, messages.KomlogMessage):
-            metric.session._mark_message_done(msg.seq)
-            done = True
-            logging.logger.debug('Error requesting data for {}. {}'.format(str(metric.uri),'Unknown response'))
-            response['success'] = False
-            response['error'] = 'Unknown response'
-        elif rsp.action == messages.Actions.GENERIC_RESPONSE:
-            if rsp.status != Status.MESSAGE_ACCEPTED_FOR_PROCESSING:
-                metric.session._mark_message_done(msg.seq)
-                done = True
-                logging.logger.debug('Error requesting data for {}. {}'.format(str(metric.uri),str(rsp.__dict__)))
-                response['success'] = False
-                response['error'] = str(rsp.__dict__)
-            else:
-                future = metric.session._mark_message_undone(msg.seq)
-                rsp = await future
-        elif rsp.action == messages.Actions.SEND_DATA_INTERVAL:
-            if start and rsp.start == start:
-                done_start = True
-            if end and rsp.end == end:
-                done_end = True
-            for row in rsp.data[::-1]:
-                response['data'].append((row[0],row[1]))
-            if done_start and done_end:
-                metric.session._mark_message_done(msg.seq)
-                done = True
-            else:
-                future = metric.session._mark_message_undone(msg.seq)
-                rsp = await future
+    try:
+        async for chunk in DataIntervalStream(metric, start, end, count):
+            response['data'].extend(chunk)
+    except exceptions.SessionException as e:
+        response['success'] = False
+        response['error'] = e.msg
     return response
 
 async def hook_to_metric(metric):
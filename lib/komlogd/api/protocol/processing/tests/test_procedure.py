@@ -6,7 +6,7 @@ import json
 import pandas as pd
 from komlogd.api.model import test
 from komlogd.api.session import KomlogSession
-from komlogd.api.common import crypto
+from komlogd.api.common import crypto, exceptions
 from komlogd.api.common.timeuuid import TimeUUID
 from komlogd.api.protocol import messages
 from komlogd.api.protocol.processing import message as prmsg
@@ -104,6 +104,28 @@ class ApiProtocolProcessingProcedureTest(unittest.TestCase):
         sessionIndex.unregister_session(session1.sid)
         sessionIndex.unregister_session(session2.sid)
 
+    @test.sync(loop)
+    async def test_send_samples_success_one_message_per_connection(self):
+        ''' send_samples should group in the same message only samples of uris assigned to the same connection '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        session = KomlogSession(username=username, privkey=privkey, num_connections=2)
+        session.send_message = test.AsyncMock(return_value = None)
+        t = TimeUUID()
+        samples = [Sample(Datapoint('datapoint'+str(i),session=session),t,i) for i in range(10)]
+        shards = {}
+        for smp in samples:
+            shards.setdefault(session.shard(smp.metric.uri), set()).add(smp.metric.uri)
+        response = await prproc.send_samples(samples)
+        self.assertEqual(session.send_message.call_count, len(shards))
+        for c in session.send_message.call_args_list:
+            msg = c[0][0]
+            if isinstance(msg, messages.SendMultiData):
+                uris = {u['uri'] for u in msg.uris}
+            else:
+                uris = {msg.uri}
+            self.assertTrue(uris in shards.values())
+
     @test.sync(loop)
     async def test_request_data_failure_unknown_response(self):
         ''' request_data should fail if we receive and unknown response '''
@@ -121,6 +143,76 @@ class ApiProtocolProcessingProcedureTest(unittest.TestCase):
         self.assertEqual(response['error'],'Unknown response')
         sessionIndex.unregister_session(session1.sid)
 
+    @test.sync(loop)
+    async def test_data_interval_stream_success_chunks_returned_as_received(self):
+        ''' DataIntervalStream should return each chunk received until the whole interval is received '''
+        username1 = 'username1'
+        privkey1=crypto.generate_rsa_key()
+        session1 = KomlogSession(username=username1, privkey=privkey1)
+        start = TimeUUID(100)
+        end = TimeUUID(300)
+        ts = [TimeUUID(i) for i in (110, 120, 210, 220)]
+        chunk1 = messages.SendDataInterval(uri='my_ds', m_type=Metrics.DATASOURCE, start=TimeUUID(200), end=end, data=[[ts[3].hex,'d'],[ts[2].hex,'c']])
+        chunk2 = messages.SendDataInterval(uri='my_ds', m_type=Metrics.DATASOURCE, start=start, end=TimeUUID(200), data=[[ts[1].hex,'b'],[ts[0].hex,'a']])
+        session1.send_message = test.AsyncMock(return_value = messages.GenericResponse(status=4202, error=0, reason=None))
+        responses = [chunk1, chunk2]
+        def mark_undone(seq):
+            f = asyncio.Future()
+            f.set_result(responses.pop(0))
+            return f
+        session1._mark_message_undone = Mock(side_effect=mark_undone)
+        session1._mark_message_done = Mock(return_value=None)
+        metric = Datasource('my_ds', session=session1)
+        chunks = []
+        async for chunk in prproc.DataIntervalStream(metric, start, end):
+            chunks.append(chunk)
+        self.assertEqual(chunks, [[(ts[2],'c'),(ts[3],'d')],[(ts[0],'a'),(ts[1],'b')]])
+        self.assertEqual(session1.send_message.call_count, 1)
+        self.assertEqual(session1._mark_message_undone.call_count, 2)
+        self.assertEqual(session1._mark_message_done.call_count, 1)
+        sessionIndex.unregister_session(session1.sid)
+
+    @test.sync(loop)
+    async def test_data_interval_stream_success_chunks_kept_while_consumer_holds_one(self):
+        ''' the response deadline should not run while the consumer processes a chunk '''
+        username1 = 'username1'
+        privkey1=crypto.generate_rsa_key()
+        session1 = KomlogSession(username=username1, privkey=privkey1, response_timeout=10)
+        start = TimeUUID(100)
+        end = TimeUUID(300)
+        ts = [TimeUUID(i) for i in (110, 210)]
+        session1._send_frame = test.AsyncMock(return_value=None)
+        metric = Datasource('my_ds', session=session1)
+        stream = prproc.DataIntervalStream(metric, start, end)
+        sending = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        seq = session1._send_frame.call_args[0][0].seq
+        chunk1 = messages.SendDataInterval(uri='my_ds', m_type=Metrics.DATASOURCE, start=TimeUUID(200), end=end, data=[[ts[1].hex,'b']], irt=seq)
+        chunk2 = messages.SendDataInterval(uri='my_ds', m_type=Metrics.DATASOURCE, start=start, end=TimeUUID(200), data=[[ts[0].hex,'a']], irt=seq)
+        session1._deliver_response(chunk1)
+        self.assertEqual(await sending, [(ts[1],'b')])
+        session1._deliver_response(chunk2)
+        self.assertEqual(session1._sweep_waiting_responses(now=session1._loop.time()+100), 0)
+        self.assertEqual(await stream.__anext__(), [(ts[0],'a')])
+        with self.assertRaises(StopAsyncIteration):
+            await stream.__anext__()
+        self.assertEqual(session1._waiting_response, {})
+        self.assertEqual(session1._deadlines, {})
+        sessionIndex.unregister_session(session1.sid)
+
+    @test.sync(loop)
+    async def test_data_interval_stream_failure_request_not_accepted(self):
+        ''' DataIntervalStream should raise SessionException if the request is not accepted '''
+        username1 = 'username1'
+        privkey1=crypto.generate_rsa_key()
+        session1 = KomlogSession(username=username1, privkey=privkey1)
+        session1.send_message = test.AsyncMock(return_value = messages.GenericResponse(status=4404, error=1, reason='not found'))
+        metric = Datasource('my_ds', session=session1)
+        with self.assertRaises(exceptions.SessionException):
+            async for chunk in prproc.DataIntervalStream(metric, TimeUUID(100), TimeUUID(300)):
+                pass
+        sessionIndex.unregister_session(session1.sid)
+
     @test.sync(loop)
     async def test_hook_to_metric_failure_invalid_response(self):
         ''' hook_to_metric should fail if we receive and unknown response '''
@@ -5,29 +5,49 @@ import traceback
 import time
 import uuid
 import pandas as pd
+from collections import OrderedDict, deque
 from komlogd.api.common import logging, exceptions, crypto
 from komlogd.api.protocol import messages, validation
 from komlogd.api.protocol.processing import message as prmsg
 from komlogd.api.model import store, queues
 from komlogd.api.model.session import sessionIndex
 
+LOGIN_URL = 'https://www.komlog.io/login'
+WS_URL = 'https://agents.komlog.io/'
 
 
 class KomlogSession:
 
-    def __init__(self, username, privkey):
+    def __init__(self, username, privkey, response_timeout=120, sweep_interval=5, num_connections=1, login_url=LOGIN_URL, ws_url=WS_URL, commit_window=0, num_workers=5, max_workers=50, max_queue_size=10000):
         self.sid = uuid.uuid4()
         self.username = username
         self.privkey = privkey
-        self.store = store.MetricStore()
+        self.login_url = login_url
+        self.ws_url = ws_url
+        self.store = store.MetricStore(commit_window=commit_window)
         self._loop = asyncio.get_event_loop()
         self._session = None
-        self._ws = None
+        self.num_connections = num_connections
+        self._wss = [None]*num_connections
+        self._ws_sessions = [None]*num_connections
+        self._stale_sessions = []
+        self._hook_routes = {}
+        self._rr = 0
+        self._auth_lock = asyncio.Lock()
+        self._sync_lock = asyncio.Lock()
         self._session_future = None
-        self._loop_future = None
+        self._loop_futures = []
+        self._sweeper_future = None
         self._deferred = []
+        self.response_timeout = response_timeout
+        self.sweep_interval = sweep_interval
+        self._deadlines = {}
+        self._expired = OrderedDict()
+        self._max_expired = 1000
+        self.stats = {'expired':0, 'late':0, 'orphaned':0}
         self._waiting_response = {}
-        self._q_msg_workers = queues.AsyncQueue(num_workers=5, on_msg=self._process_received_message, name='Message Workers', loop=self._loop)
+        self._pending_responses = {}
+        self._q_msg_workers = queues.AsyncQueue(num_workers=num_workers, on_msg=self._process_received_data, name='Message Workers', loop=self._loop, key=self._message_key, max_size=max_queue_size, max_workers=max_workers)
         sessionIndex.register_session(self)
 
     def __del__(self):
@@ -70,12 +90,18 @@ class KomlogSession:
         logging.logger.info('closing Komlog connection')
         self._stop_f = True
         await self._q_msg_workers.join()
-        if self._ws and self._ws.closed is False:
-            await self._ws.close()
+        if self._sweeper_future:
+            self._sweeper_future.cancel()
+        for ws in self._wss:
+            if ws and ws.closed is False:
+                await ws.close()
         if self._session:
             await self._session.close()
-        if self._loop_future:
-            await self._loop_future
+        for stale in self._stale_sessions:
+            await stale.close()
+        self._stale_sessions = []
+        if self._loop_futures:
+            await asyncio.gather(*self._loop_futures)
             self._session_future.set_result(True)
         sessionIndex.unregister_session(self.sid)
 
@@ -83,11 +109,13 @@ class KomlogSession:
         if self._session_future is None:
             logging.logger.info('Authenticating agent')
             await self._auth()
-            logging.logger.info('Initializing websocket connection')
-            await self._ws_connect()
+            logging.logger.info('Initializing websocket connections')
+            for i in range(self.num_connections):
+                await self._ws_connect(i)
             self._q_msg_workers.start()
             logging.logger.info('Entering loop')
-            self._loop_future = asyncio.ensure_future(self._session_loop(), loop=self._loop)
+            self._loop_futures = [asyncio.ensure_future(self._session_loop(i), loop=self._loop) for i in range(self.num_connections)]
+            self._sweeper_future = asyncio.ensure_future(self._sweeper_loop(), loop=self._loop)
             self._session_future = asyncio.futures.Future(loop=self._loop)
 
     async def join(self):
@@ -103,8 +131,7 @@ class KomlogSession:
             'pv':messages.KomlogMessage._version_
         }
         try:
-            login_url = 'https://www.komlog.io/login'
-            async with self._session.post(login_url, data=data) as resp:
+            async with self._session.post(self.login_url, data=data) as resp:
                 resp_content = await resp.json()
                 if resp.status == 403:
                     logging.logger.error('Access Denied')
@@ -115,11 +142,10 @@ class KomlogSession:
                 elif not (resp.status == 200 and 'challenge' in resp_content):
                     logging.logger.error('Unexpected server response: '+str(resp))
                     raise exceptions.LoginException('Unexpected error')
-            c = crypto.process_challenge(self._privkey, resp_content['challenge'])
-            s = crypto.sign_message(self._privkey, c)
+            c, s = await self._solve_challenge(resp_content['challenge'])
             data['c']=c
             data['s']=s
-            async with self._session.post(login_url, data=data) as resp:
+            async with self._session.post(self.login_url, data=data) as resp:
                 resp_content = await resp.json()
                 if resp.status == 403:
                     logging.logger.error('Access Denied. is agent active?')
@@ -129,76 +155,224 @@ class KomlogSession:
                 await self._session.close()
             raise
 
-    async def _ws_connect(self):
+    async def _solve_challenge(self, challenge):
+        # RSA decryption and signing are cpu bound, keep them out of the event loop
+        return await self._loop.run_in_executor(None, crypto.solve_challenge, self._privkey, challenge)
+
+    async def _ws_connect(self, i=0):
         try:
-            ws_url = 'https://agents.komlog.io/'
-            self._ws = await self._session.ws_connect(ws_url)
+            self._wss[i] = await self._session.ws_connect(self.ws_url)
+            self._ws_sessions[i] = self._session
         except:
-            if self._ws:
-                await self._ws.close()
+            if self._wss[i]:
+                await self._wss[i].close()
             raise
 
-    async def _session_loop(self):
+    async def _session_loop(self, i=0):
         while not getattr(self, '_stop_f',False):
             try:
-                if not self._session:
-                    logging.logger.debug('Restarting Komlog session')
-                    await self._auth()
-                    await self._ws_connect()
-                elif not self._ws:
-                    logging.logger.debug('Restarting websocket connection')
-                    await self._ws_connect()
+                async with self._auth_lock:
+                    if not self._session:
+                        logging.logger.debug('Restarting Komlog session')
+                        await self._auth()
+                if not self._wss[i]:
+                    logging.logger.debug('Restarting websocket connection {}'.format(str(i)))
+                    await self._ws_connect(i)
                 await self._ws_reconnected()
-                async for msg in self._ws:
+                async for msg in self._wss[i]:
                     logging.logger.debug('Message received from server: '+str(msg))
-                    if msg.tp == aiohttp.WSMsgType.CLOSED:
+                    if msg.type == aiohttp.WSMsgType.CLOSED:
                         break
-                    elif msg.tp == aiohttp.WSMsgType.ERROR:
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
                         break
                     else:
-                        await self._q_msg_workers.push(msg)
+                        await self._process_received_message(msg)
             except Exception:
                 ex_info=traceback.format_exc().splitlines()
                 for line in ex_info:
                     logging.logger.error(line)
             finally:
-                logging.logger.debug('Unexpected session close')
-                if self._ws and self._ws.closed:
-                    if self._ws.close_code == 4403:
+                logging.logger.debug('Unexpected session close on connection {}'.format(str(i)))
+                ws = self._wss[i]
+                if ws and ws.closed:
+                    if ws.close_code == 4403:
                         logging.logger.debug('Server denied access. Retrying connection.')
-                        self._session = None
-                    self._ws = None
+                        if self._session and self._session is self._ws_sessions[i]:
+                            self._stale_sessions.append(self._session)
+                            self._session = None
+                    self._wss[i] = None
+                    self._ws_sessions[i] = None
+                    await self._close_stale_sessions()
                 if not getattr(self, '_stop_f',False):
-                    self._ws_disconnected()
+                    self._ws_disconnected(i)
                     await asyncio.sleep(15)
 
-    def _ws_disconnected(self):
-        self.store.clear_synced()
+    async def _close_stale_sessions(self):
+        ''' sessions denied by the server are closed once none of our connections use them '''
+        for stale in self._stale_sessions[:]:
+            if not any(stale is session for session in self._ws_sessions):
+                self._stale_sessions.remove(stale)
+                await stale.close()
+
+    async def _sweeper_loop(self):
+        while not getattr(self, '_stop_f',False):
+            await asyncio.sleep(self.sweep_interval)
+            self._sweep_waiting_responses()
+
+    def _sweep_waiting_responses(self, now=None):
+        ''' resolves with None every waiting future whose deadline has expired '''
+        now = now if now != None else self._loop.time()
+        expired = [seq for seq,deadline in self._deadlines.items() if deadline <= now]
+        for seq in expired:
+            self._deadlines.pop(seq)
+            future = self._waiting_response.pop(seq, None)
+            self._pending_responses.pop(seq, None)
+            if future and not future.done():
+                logging.logger.debug('Response timeout for message {}'.format(str(seq)))
+                future.set_result(None)
+            self._expired[seq] = now
+            self.stats['expired'] += 1
+        if expired:
+            self._deferred = [msg for msg in self._deferred if msg.seq not in self._expired]
+        while len(self._expired) > self._max_expired:
+            self._expired.popitem(last=False)
+        return len(expired)
+
+    def _ws_disconnected(self, i=0):
+        '''
+        Only the metrics hooked through the lost connection stop being synced. The
+        server keeps pushing the rest through the connections still open.
+        '''
+        uris = set(uri for uri,j in self._hook_routes.items() if j == i)
+        for uri in uris:
+            del self._hook_routes[uri]
+        if not any(ws and not ws.closed for ws in self._wss):
+            self._hook_routes = {}
+            self.store.disconnected()
+        else:
+            self.store.disconnected(metrics=[m for m in self.store._hooked if m.uri in uris])
 
     async def _ws_reconnected(self):
-        await self.store.sync()
-        for msg in self._deferred[:]:
-            logging.logger.debug('sending deferred message')
-            self._deferred.remove(msg)
-            await self.send_message(msg)
+        async with self._sync_lock:
+            await self.store.sync()
+            for msg in self._deferred[:]:
+                logging.logger.debug('sending deferred message')
+                self._deferred.remove(msg)
+                # once sent, the response is waited for response_timeout, as any other message
+                deadline = self._deadlines.get(msg.seq, None)
+                if msg.seq in self._waiting_response:
+                    resent = self._loop.time()+self.response_timeout
+                    self._deadlines[msg.seq] = min(deadline, resent) if deadline != None else resent
+                try:
+                    # the original sender is still waiting for the response future
+                    await self._send_frame(msg)
+                except Exception:
+                    self._deferred.append(msg)
+                    if deadline != None:
+                        self._deadlines[msg.seq] = deadline
+                    else:
+                        self._deadlines.pop(msg.seq, None)
+                    raise
+
+    def _select_ws(self, message):
+        return self._wss[self._select_ws_index(message)]
+
+    def shard(self, uri):
+        ''' Returns the connection assigned to the uri '''
+        return hash(uri) % self.num_connections
+
+    def _select_ws_index(self, message):
+        '''
+        Messages about the same uri are sent through the same connection, so per metric
+        ordering is kept. If that connection is down, the next available one is used.
+        Messages with several uris are routed by the first one, send_samples only groups
+        in a message uris assigned to the same connection.
+        '''
+        uri = getattr(message, 'uri', None)
+        uris = getattr(message, 'uris', None)
+        if not uri and uris:
+            uri = uris[0]['uri']
+        if uri:
+            first = self.shard(uri)
+        else:
+            first = self._rr % self.num_connections
+            self._rr += 1
+        for n in range(self.num_connections):
+            i = (first+n) % self.num_connections
+            ws = self._wss[i]
+            if ws and not ws.closed:
+                return i
+        raise exceptions.WebsocketConnectionException('No websocket connection available')
+
+    async def _send_frame(self, message):
+        i = self._select_ws_index(message)
+        ws = self._wss[i]
+        if message.action == messages.Actions.HOOK_TO_URI:
+            self._hook_routes[message.uri] = i
+        # send_str is a coroutine since aiohttp 3
+        result = ws.send_str(json.dumps(message.to_dict()))
+        if asyncio.iscoroutine(result):
+            await result
 
     async def _process_received_message(self, msg):
+        '''
+        Responses to our requests are routed directly to the waiting procedure.
+        Only server initiated messages are queued for the message workers.
+        '''
         try:
             data=json.loads(msg.data)
-            if 'action' in data:
+            if not (isinstance(data, dict) and 'action' in data):
+                return
+            irt = uuid.UUID(data['irt']) if data.get('irt') else None
+            if irt and irt in self._expired:
+                logging.logger.debug('Discarding late response to message {}'.format(str(irt)))
+                self.stats['late'] += 1
+            elif irt and irt in self._waiting_response:
                 message=messages.KomlogMessage.load_from_dict(data)
-                if message.irt and message.irt in self._waiting_response:
-                    if self._waiting_response[message.irt].done():
-                        # some messages generate multiple responses. Protocol procedures are responsible for
-                        # marking msg done or undone, adding more pending futures in the last case.
-                        logging.logger.debug('Enqueueing message again')
-                        await self._q_msg_workers.push(msg)
-                    else:
-                        logging.logger.debug('processing message response procedure')
-                        self._waiting_response[message.irt].set_result(message)
-                else:
-                    logging.logger.debug('processing non requested message')
-                    prmsg.processing_map[message.action](msg=message, session=self)
+                self._deliver_response(message)
+            else:
+                if irt:
+                    self.stats['orphaned'] += 1
+                await self._q_msg_workers.push(data)
+        except Exception:
+            ex_info=traceback.format_exc().splitlines()
+            for line in ex_info:
+                logging.logger.error(line)
+
+    def _deliver_response(self, message):
+        future = self._waiting_response[message.irt]
+        if future.done():
+            # some messages generate multiple responses. Protocol procedures are responsible for
+            # marking msg done or undone. Responses are kept in order until the next future is added.
+            logging.logger.debug('Buffering response to message {}'.format(str(message.irt)))
+            self._pending_responses.setdefault(message.irt, deque()).append(message)
+        else:
+            logging.logger.debug('processing message response procedure')
+            future.set_result(message)
+
+    def _message_key(self, data):
+        '''
+        Returns the uris of the message. Messages pushed about the same metric are processed
+        in arrival order, and those about several metrics wait for every one of them.
+        '''
+        payload = data.get('payload', None) if isinstance(data, dict) else None
+        if not isinstance(payload, dict):
+            return None
+        uri = payload.get('uri', None)
+        if isinstance(uri, dict):
+            uri = uri.get('uri', None)
+        if isinstance(uri, str):
+            return uri
+        uris = payload.get('uris', None)
+        if isinstance(uris, list):
+            return [item['uri'] for item in uris if isinstance(item, dict) and isinstance(item.get('uri', None), str)]
+        return None
+
+    async def _process_received_data(self, data):
+        try:
+            message=messages.KomlogMessage.load_from_dict(data)
+            logging.logger.debug('processing non requested message')
+            prmsg.processing_map[message.action](msg=message, session=self)
         except Exception:
             ex_info=traceback.format_exc().splitlines()
             for line in ex_info:
@@ -206,37 +380,54 @@ class KomlogSession:
 
     def _mark_message_done(self, seq):
         self._waiting_response.pop(seq,None)
+        self._pending_responses.pop(seq,None)
+        self._deadlines.pop(seq,None)
 
-    def _mark_message_undone(self, seq):
+    def _mark_message_undone(self, seq, timeout=None, expires=True):
         future = asyncio.futures.Future(loop=self._loop)
         self._waiting_response[seq]=future
+        if expires:
+            timeout = timeout if timeout != None else self.response_timeout
+            self._deadlines[seq]=self._loop.time()+timeout
+        else:
+            self._deadlines.pop(seq,None)
+        pending = self._pending_responses.get(seq)
+        if pending:
+            future.set_result(pending.popleft())
         return future
 
+    def _hold_message(self, seq):
+        '''
+        stops the response deadline of the message until it is marked undone again. Responses
+        received meanwhile are kept in order.
+        '''
+        self._deadlines.pop(seq,None)
+
     async def send_message(self, message, defer=True, timeout=None, defer_timeout=None):
         if not isinstance(message, messages.KomlogMessage):
             raise exceptions.InvalidMessageException()
+        # the future is registered before sending, the response may arrive while the frame is sent
+        fut = self._mark_message_undone(message.seq, timeout=timeout)
         try:
             logging.logger.debug('sending message '+str(message.to_dict()))
-            self._ws.send_str(json.dumps(message.to_dict()))
+            await self._send_frame(message)
         except Exception:
             ex_info=traceback.format_exc().splitlines()
             for line in ex_info:
                 logging.logger.error(line)
-            if defer:
-                self._deferred.append(message)
-                fut = self._mark_message_undone(message.seq)
-                try:
-                    result = await asyncio.wait_for(fut, defer_timeout)
-                    return result
-                except asyncio.TimeoutError:
-                    return None
-            else:
-                return None
-        else:
-            fut = self._mark_message_undone(message.seq)
-            try:
-                result = await asyncio.wait_for(fut, timeout)
-                return result
-            except asyncio.TimeoutError:
+            if not defer:
+                self._mark_message_done(message.seq)
                 return None
+            self._deferred.append(message)
+            # deferred messages wait for the reconnection, only defer_timeout expires them
+            if defer_timeout != None:
+                self._deadlines[message.seq] = self._loop.time()+defer_timeout
+            else:
+                self._deadlines.pop(message.seq, None)
+            timeout = defer_timeout
+        try:
+            result = await asyncio.wait_for(fut, timeout)
+            return result
+        except asyncio.TimeoutError:
+            return None
 
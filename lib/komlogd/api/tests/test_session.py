@@ -1,9 +1,18 @@
 import unittest
 import uuid
 import asyncio
+import json
 import pandas as pd
+from unittest.mock import Mock
+from base64 import b64encode, b64decode
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
 from komlogd.api import session
 from komlogd.api.common import crypto, exceptions
+from komlogd.api.common.timeuuid import TimeUUID
+from komlogd.api.model import test
+from komlogd.api.model.metrics import Datapoint
+from komlogd.api.protocol import messages
 from komlogd.api.model.session import sessionIndex
 
 class ApiSessionTest(unittest.TestCase):
@@ -48,3 +57,315 @@ class ApiSessionTest(unittest.TestCase):
         s = session.KomlogSession(username=username, privkey=privkey)
         s2 = sessionIndex.get_session(sid=s.sid)
         self.assertEqual(s,s2)
+
+    def test_komlogsession_creation_success_commit_grouping_opt_in(self):
+        ''' commits should only be grouped if a commit_window is set '''
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username='username', privkey=privkey)
+        self.assertEqual(s.store.commit_window, 0)
+        s = session.KomlogSession(username='username', privkey=privkey, commit_window=0.002)
+        self.assertEqual(s.store.commit_window, 0.002)
+
+    def test_solve_challenge_success(self):
+        ''' _solve_challenge should return the processed challenge and its signature '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey)
+        challenge=b64encode(crypto.encrypt(privkey.public_key(), b'challenge')).decode()
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        c, sign = loop.run_until_complete(s._solve_challenge(challenge))
+        self.assertEqual(c, crypto.process_challenge(privkey, challenge))
+        # PSS signatures are randomized, verify it instead
+        privkey.public_key().verify(b64decode(sign), b64decode(c), padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+        loop.close()
+
+    def test_sweep_waiting_responses_success_expired_futures_resolved(self):
+        ''' _sweep_waiting_responses should resolve with None the futures whose deadline expired '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        seq1 = uuid.uuid1()
+        seq2 = uuid.uuid1()
+        f1 = s._mark_message_undone(seq1)
+        f2 = s._mark_message_undone(seq2, timeout=100)
+        self.assertEqual(s._sweep_waiting_responses(now=loop.time()+50), 1)
+        self.assertTrue(f1.done())
+        self.assertEqual(f1.result(), None)
+        self.assertFalse(f2.done())
+        self.assertFalse(seq1 in s._waiting_response)
+        self.assertFalse(seq1 in s._deadlines)
+        self.assertTrue(seq1 in s._expired)
+        self.assertTrue(seq2 in s._waiting_response)
+        self.assertEqual(s.stats['expired'], 1)
+        s._mark_message_done(seq2)
+        self.assertEqual(s._deadlines, {})
+        self.assertEqual(s._waiting_response, {})
+        loop.close()
+
+    def test_send_message_success_deferred_message_waits_without_deadline(self):
+        ''' a deferred message without defer_timeout should not be expired by the sweeper '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        msg = messages.HookToUri(uri='my.uri')
+        sending = loop.create_task(s.send_message(msg))
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(s._deferred, [msg])
+        self.assertFalse(msg.seq in s._deadlines)
+        self.assertEqual(s._sweep_waiting_responses(now=loop.time()+1000), 0)
+        self.assertFalse(sending.done())
+        self.assertEqual(s._deferred, [msg])
+        s._deliver_response(messages.GenericResponse(irt=msg.seq, status=200, error=0, reason='ok'))
+        loop.run_until_complete(sending)
+        self.assertEqual(sending.result().irt, msg.seq)
+        loop.close()
+
+    def test_ws_reconnected_success_deferred_message_expires_after_resent(self):
+        ''' a deferred message should be waited for response_timeout once it is sent again '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        s.store.sync = test.AsyncMock(return_value=True)
+        msg = messages.HookToUri(uri='my.uri')
+        sending = loop.create_task(s.send_message(msg))
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(msg.seq in s._deadlines)
+        s._wss = [Mock(closed=False)]
+        loop.run_until_complete(s._ws_reconnected())
+        self.assertEqual(s._deferred, [])
+        self.assertTrue(msg.seq in s._deadlines)
+        self.assertEqual(s._sweep_waiting_responses(now=loop.time()+20), 1)
+        self.assertEqual(loop.run_until_complete(sending), None)
+        self.assertEqual(s._waiting_response, {})
+        loop.close()
+
+    def test_send_message_success_deferred_message_expires_after_defer_timeout(self):
+        ''' a deferred message should be removed and resolved with None after defer_timeout '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        msg = messages.HookToUri(uri='my.uri')
+        sending = loop.create_task(s.send_message(msg, defer_timeout=100))
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(s._sweep_waiting_responses(now=loop.time()+50), 0)
+        self.assertEqual(s._sweep_waiting_responses(now=loop.time()+150), 1)
+        self.assertEqual(s._deferred, [])
+        self.assertEqual(loop.run_until_complete(sending), None)
+        loop.close()
+
+    def test_send_message_success_response_received_while_sending(self):
+        ''' a response received before the frame send finishes should be delivered to the sender '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        msg = messages.HookToUri(uri='my.uri')
+        async def send_str(data):
+            s._deliver_response(messages.GenericResponse(irt=msg.seq, status=200, error=0, reason='ok'))
+            await asyncio.sleep(0)
+        s._wss = [Mock(closed=False, send_str=send_str)]
+        result = loop.run_until_complete(s.send_message(msg))
+        self.assertEqual(result.irt, msg.seq)
+        self.assertEqual(s.stats['orphaned'], 0)
+        loop.close()
+
+    def test_send_message_failure_not_deferred_future_removed(self):
+        ''' if the send fails and the message is not deferred, no future should be left waiting '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=10)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        msg = messages.HookToUri(uri='my.uri')
+        self.assertEqual(loop.run_until_complete(s.send_message(msg, defer=False)), None)
+        self.assertEqual(s._waiting_response, {})
+        self.assertEqual(s._deadlines, {})
+        loop.close()
+
+    def test_process_received_message_late_response_discarded(self):
+        ''' a response to an already expired message should be discarded and counted '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, response_timeout=0)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        msg = messages.HookToUri(uri='uri')
+        s._mark_message_undone(msg.seq)
+        s._sweep_waiting_responses()
+        rsp = {'v':1, 'action':'generic_response', 'seq':TimeUUID().hex, 'irt':msg.seq.hex, 'payload':{'status':4200, 'error':0, 'reason':None}}
+        ws_msg = Mock(data=json.dumps(rsp))
+        loop.run_until_complete(s._process_received_message(ws_msg))
+        self.assertEqual(s.stats['late'], 1)
+        self.assertEqual(s.stats['orphaned'], 0)
+        self.assertEqual(s._waiting_response, {})
+        loop.close()
+
+    def test_select_ws_success_same_uri_same_connection(self):
+        ''' messages with the same uri should be sent through the same connection '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=4)
+        s._wss = [Mock(closed=False) for i in range(4)]
+        msg1 = messages.HookToUri(uri='my.uri')
+        msg2 = messages.HookToUri(uri='my.uri')
+        ws = s._select_ws(msg1)
+        self.assertTrue(ws in s._wss)
+        self.assertEqual(s._select_ws(msg2), ws)
+
+    def test_select_ws_success_rebalance_if_connection_down(self):
+        ''' if the connection assigned to the uri is down, the next available should be selected '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=3)
+        s._wss = [Mock(closed=False) for i in range(3)]
+        msg = messages.HookToUri(uri='my.uri')
+        first = hash('my.uri') % 3
+        self.assertEqual(s._select_ws(msg), s._wss[first])
+        s._wss[first] = None
+        self.assertEqual(s._select_ws(msg), s._wss[(first+1)%3])
+        s._wss[(first+1)%3].closed = True
+        self.assertEqual(s._select_ws(msg), s._wss[(first+2)%3])
+
+    def test_select_ws_success_multi_uri_message_routed_by_first_uri(self):
+        ''' messages with several uris should be sent through the connection of the first one '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=3)
+        s._wss = [Mock(closed=False) for i in range(3)]
+        uris = [{'uri':'uri1','type':'d','content':'1'},{'uri':'uri2','type':'d','content':'2'}]
+        msg = messages.SendMultiData(t=TimeUUID(), uris=uris)
+        for i in range(5):
+            self.assertEqual(s._select_ws(msg), s._wss[s.shard('uri1')])
+
+    def test_select_ws_failure_no_connection_available(self):
+        ''' _select_ws should fail if no connection is available '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=2)
+        msg = messages.HookToUri(uri='my.uri')
+        with self.assertRaises(exceptions.WebsocketConnectionException) as cm:
+            s._select_ws(msg)
+
+    def test_ws_disconnected_success_only_metrics_hooked_through_the_connection(self):
+        ''' only the metrics hooked through the lost connection should be unhooked, unless no connection is left '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=2)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        s._wss = [Mock(closed=False) for i in range(2)]
+        m1 = Datapoint(uri='uri1')
+        m2 = Datapoint(uri='uri2')
+        s.store._hooked.update({m1, m2})
+        s._hook_routes = {'uri1':0, 'uri2':1}
+        s._wss[0].closed = True
+        s._ws_disconnected(0)
+        self.assertEqual(s.store._hooked, {m2})
+        self.assertEqual(s.store._prev_hooked, {m1})
+        self.assertEqual(s._hook_routes, {'uri2':1})
+        s._wss[1].closed = True
+        s._ws_disconnected(1)
+        self.assertEqual(s.store._hooked, set())
+        self.assertEqual(s.store._prev_hooked, {m1, m2})
+        self.assertEqual(s._hook_routes, {})
+        loop.close()
+
+    def test_send_frame_success_hook_route_recorded(self):
+        ''' _send_frame should record the connection each hook is sent through '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=3)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        s._wss = [Mock(closed=False) for i in range(3)]
+        msg = messages.HookToUri(uri='my.uri')
+        loop.run_until_complete(s._send_frame(msg))
+        self.assertEqual(s._hook_routes, {'my.uri':hash('my.uri') % 3})
+        loop.run_until_complete(s._send_frame(messages.UnHookFromUri(uri='other.uri')))
+        self.assertEqual(s._hook_routes, {'my.uri':hash('my.uri') % 3})
+        loop.close()
+
+    def test_close_stale_sessions_success_closed_when_unused(self):
+        ''' sessions denied by the server should be closed once no connection uses them '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey, num_connections=2)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        stale = Mock(close=test.AsyncMock())
+        s._stale_sessions = [stale]
+        s._ws_sessions = [None, stale]
+        loop.run_until_complete(s._close_stale_sessions())
+        self.assertEqual(stale.close.call_count, 0)
+        s._ws_sessions = [None, None]
+        loop.run_until_complete(s._close_stale_sessions())
+        self.assertEqual(stale.close.call_count, 1)
+        self.assertEqual(s._stale_sessions, [])
+        loop.close()
+
+    def test_process_received_message_multiple_responses_delivered_in_order(self):
+        ''' responses received while no future is pending should be delivered in order to the next futures '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        s._q_msg_workers.push = test.AsyncMock()
+        msg = messages.HookToUri(uri='uri')
+        f1 = s._mark_message_undone(msg.seq)
+        rsps = []
+        for status in (4202, 4200, 4404):
+            rsp = {'v':1, 'action':'generic_response', 'seq':TimeUUID().hex, 'irt':msg.seq.hex, 'payload':{'status':status, 'error':0, 'reason':None}}
+            rsps.append(rsp)
+            loop.run_until_complete(s._process_received_message(Mock(data=json.dumps(rsp))))
+        self.assertFalse(s._q_msg_workers.push.called)
+        self.assertEqual(f1.result().status, 4202)
+        f2 = s._mark_message_undone(msg.seq)
+        self.assertEqual(f2.result().status, 4200)
+        f3 = s._mark_message_undone(msg.seq)
+        self.assertEqual(f3.result().status, 4404)
+        f4 = s._mark_message_undone(msg.seq)
+        self.assertFalse(f4.done())
+        s._mark_message_done(msg.seq)
+        self.assertEqual(s._pending_responses, {})
+        loop.close()
+
+    def test_message_key_success(self):
+        ''' pushed messages should be partitioned by the uris they update '''
+        s = session.KomlogSession(username='username', privkey=crypto.generate_rsa_key())
+        self.assertEqual(s._message_key({'payload':{'uri':{'uri':'uri1','type':'d'}}}), 'uri1')
+        self.assertEqual(s._message_key({'payload':{'uri':'uri1'}}), 'uri1')
+        self.assertEqual(s._message_key({'payload':{'uris':[{'uri':'uri2'},{'uri':'uri1'}]}}), ['uri2','uri1'])
+        self.assertIsNone(s._message_key({'payload':{'status':4200}}))
+        self.assertIsNone(s._message_key({'action':'generic_response'}))
+
+    def test_komlogsession_creation_success_message_queue_parameters(self):
+        ''' message workers and queue size should be set by the session parameters '''
+        s = session.KomlogSession(username='username', privkey=crypto.generate_rsa_key(), num_workers=2, max_workers=4, max_queue_size=100)
+        self.assertEqual(s._q_msg_workers._num_workers, 2)
+        self.assertEqual(s._q_msg_workers._max_workers, 4)
+        self.assertEqual(s._q_msg_workers._max_size, 100)
+
+    def test_process_received_message_non_requested_message_queued(self):
+        ''' messages not related to a request should be queued for the message workers '''
+        username = 'username'
+        privkey=crypto.generate_rsa_key()
+        s = session.KomlogSession(username=username, privkey=privkey)
+        loop = asyncio.new_event_loop()
+        s._loop = loop
+        s._q_msg_workers.push = test.AsyncMock()
+        data = {'v':1, 'action':'generic_response', 'seq':TimeUUID().hex, 'irt':None, 'payload':{'status':4200, 'error':0, 'reason':None}}
+        loop.run_until_complete(s._process_received_message(Mock(data=json.dumps(data))))
+        s._q_msg_workers.push.assert_called_with(data)
+        self.assertEqual(s.stats['orphaned'], 0)
+        loop.close()
@@ -1,17 +1,26 @@
+import decimal
 import gc
+import os
+import threading
+import time
 import unittest
 import uuid
 import asyncio
 import pandas as pd
 from komlogd.api import transfer_methods
 from komlogd.api.common import exceptions
+from komlogd.api.common.timeuuid import TimeUUID
 from komlogd.api.model import schedules, test
 from komlogd.api.model.store import MetricStore
 from komlogd.api.model.metrics import Metric, Datasource, Datapoint, Sample
 from komlogd.api.model.transfer_methods import tmIndex
+from unittest.mock import Mock, patch
 
 loop = asyncio.get_event_loop()
 
+def insert_pid(t, out):
+    out.insert(t=t, value=os.getpid())
+
 class ApiTransferMethodsTest(unittest.TestCase):
 
     def test_transfermethod_failure_invalid_f_params(self):
@@ -38,6 +47,27 @@ class ApiTransferMethodsTest(unittest.TestCase):
             tm=transfer_methods.transfermethod(schedule=schedule)
         self.assertEqual(cm.exception.msg, 'Invalid "schedule" attribute')
 
+    def test_transfermethod_failure_invalid_coalesce_or_min_interval(self):
+        ''' creation of a transfermethod object should fail if coalesce or min_interval are invalid '''
+        for value in [-1, 'str', None, True, [1]]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(coalesce=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "coalesce" attribute')
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(min_interval=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "min_interval" attribute')
+
+    def test_transfermethod_failure_invalid_executor_or_prefetch(self):
+        ''' creation of a transfermethod object should fail if executor or prefetch are invalid '''
+        for value in [None, 'fork', 1]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(executor=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "executor" attribute')
+        for value in [0, -1, 'str', True, 1.5]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(prefetch=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "prefetch" attribute')
+
     def test_transfer_method_DummySchedule_success(self):
         ''' creation of a transfermethod object should succeed if schedule is DummySchedule '''
         schedule = schedules.DummySchedule()
@@ -345,6 +375,320 @@ class ApiTransferMethodsTest(unittest.TestCase):
         finally:
             tmIndex.enable_tm = enable_tm_bck
 
+    @test.sync(loop)
+    async def test_request_run_success_updates_coalesced_in_one_run(self):
+        ''' updates received during the coalesce window should be merged in one run '''
+        tm=transfer_methods.transfermethod(f=lambda: None, coalesce=0.05)
+        tm._run = test.AsyncMock(return_value=None)
+        t1, t2, t3 = TimeUUID(), TimeUUID(), TimeUUID()
+        task = tm.request_run(t=t1, metrics=[Datasource('uri1')], irt=1)
+        self.assertIsNone(tm.request_run(t=t2, metrics=[Datasource('uri2'), Datasource('uri1')], irt=2))
+        self.assertIsNone(tm.request_run(t=t3, metrics=[Datasource('uri3')], irt=3))
+        await task
+        self.assertEqual(tm._run.call_count, 1)
+        tm._run.assert_called_with(t=t3, metrics=[Datasource('uri1'),Datasource('uri2'),Datasource('uri3')], irt=3)
+        self.assertEqual(tm.stats, {'runs':1, 'coalesced':2, 'skipped':0})
+
+    @test.sync(loop)
+    async def test_request_run_success_min_interval_between_runs(self):
+        ''' runs should be delayed until min_interval has passed since the previous one '''
+        tm=transfer_methods.transfermethod(f=lambda: None, min_interval=0.1)
+        tm._run = test.AsyncMock(return_value=None)
+        t = TimeUUID()
+        await tm.request_run(t=t, metrics=[Datasource('uri1')])
+        start = time.monotonic()
+        task = tm.request_run(t=t, metrics=[Datasource('uri1')])
+        tm.request_run(t=t, metrics=[Datasource('uri2')])
+        await task
+        self.assertTrue(time.monotonic()-start >= 0.05)
+        self.assertEqual(tm._run.call_count, 2)
+        self.assertEqual(tm.stats, {'runs':2, 'coalesced':1, 'skipped':0})
+
+    @test.sync(loop)
+    async def test_request_run_success_skipped_if_running(self):
+        ''' updates received while the tm is running should be discarded if skip_if_running is set '''
+        tm=transfer_methods.transfermethod(f=lambda: None, skip_if_running=True)
+        event = asyncio.Event()
+        async def run(t, metrics, irt):
+            await event.wait()
+        tm._run = run
+        t = TimeUUID()
+        task = tm.request_run(t=t, metrics=[Datasource('uri1')])
+        await asyncio.sleep(0)
+        self.assertIsNone(tm.request_run(t=t, metrics=[Datasource('uri1')]))
+        event.set()
+        await task
+        self.assertIsNotNone(tm.request_run(t=t, metrics=[Datasource('uri1')]))
+        self.assertEqual(tm.stats['skipped'], 1)
+
+    @test.sync(loop)
+    async def test_runs_now_success_execution_options_applied(self):
+        ''' _runs_now should be False while a request would be merged, delayed or skipped '''
+        tm=transfer_methods.transfermethod(f=lambda: None)
+        self.assertTrue(tm._runs_now())
+        tm=transfer_methods.transfermethod(f=lambda: None, coalesce=0.05)
+        self.assertFalse(tm._runs_now())
+        tm=transfer_methods.transfermethod(f=lambda: None, min_interval=10)
+        tm._run = test.AsyncMock(return_value=None)
+        self.assertTrue(tm._runs_now())
+        await tm.request_run(t=TimeUUID(), metrics=[Datasource('uri1')])
+        self.assertFalse(tm._runs_now())
+        tm=transfer_methods.transfermethod(f=lambda: None, skip_if_running=True)
+        tm._running = 1
+        self.assertFalse(tm._runs_now())
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_thread_executor(self):
+        ''' sync functions should run in a thread, and their inserts be applied from the event loop '''
+        threads = []
+        store = Mock()
+        store.insert.side_effect = lambda *args, **kwargs: threads.append(threading.get_ident())
+        out = Datapoint('uri.out', session=Mock(username='user', store=store))
+        def func(t, out):
+            threads.append(threading.get_ident())
+            out.insert(t=t, value=1)
+        tm=transfer_methods.transfermethod(f=func, f_params={'out':out}, schedule=schedules.DummySchedule(), executor='thread')
+        tm._decorate_method(func)
+        t = TimeUUID()
+        self.assertTrue(await tm.f(t=t, metrics=[]))
+        self.assertNotEqual(threads[0], threading.get_ident())
+        self.assertEqual(threads[1], threading.get_ident())
+        store.insert.assert_called_once_with(metric=out, t=t, value=decimal.Decimal(1))
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_process_executor(self):
+        ''' sync functions should run in a process, and their inserts be applied from the event loop '''
+        store = Mock()
+        session = Mock(sid=uuid.uuid4(), username='user', store=store)
+        out = Datapoint('uri.out', session=session)
+        tm=transfer_methods.transfermethod(f=insert_pid, f_params={'out':out}, schedule=schedules.DummySchedule(), executor='process')
+        tm._decorate_method(insert_pid)
+        t = TimeUUID()
+        self.assertTrue(await tm.f(t=t, metrics=[]))
+        self.assertEqual(store.insert.call_count, 1)
+        args = store.insert.call_args[1]
+        self.assertEqual(args['metric'], out)
+        self.assertEqual(args['t'], t)
+        self.assertNotEqual(args['value'], os.getpid())
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_prefetched_data(self):
+        ''' functions with a prefetched parameter should receive the data of the activation metrics '''
+        store = Mock()
+        store.get = test.AsyncMock(return_value='data')
+        metric = Datapoint('uri', session=Mock(username='user', store=store))
+        received = {}
+        def func(prefetched):
+            received.update(prefetched)
+        tm=transfer_methods.transfermethod(f=func, schedule=schedules.OnUpdateSchedule(activation_metrics=metric), executor='thread', prefetch=10)
+        tm._decorate_method(func)
+        t = TimeUUID()
+        self.assertTrue(await tm.f(t=t, metrics=[metric]))
+        self.assertEqual(received, {metric:'data'})
+        store.get.assert_called_once_with(metric=metric, end=t, count=10)
+
+    def test_transfermethod_failure_invalid_window(self):
+        ''' creation of a transfermethod object should fail if window is invalid '''
+        for value in [0, -1, 'str', True, 1.5]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(window=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "window" attribute')
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_windows_updated_incrementally(self):
+        ''' windows should be requested once and then updated with the data stored '''
+        store = MetricStore()
+        metric = Datapoint('uri', session=Mock(username='user', store=store))
+        t1 = TimeUUID(100)
+        t2 = TimeUUID(200)
+        t3 = TimeUUID(300)
+        store.get = test.AsyncMock(return_value=pd.Series(index=[t1], data=[1]))
+        received = []
+        def func(windows):
+            received.append(windows[metric])
+        tm=transfer_methods.transfermethod(f=func, schedule=schedules.OnUpdateSchedule(activation_metrics=metric), window=2)
+        tm._decorate_method(func)
+        self.assertTrue(await tm.f(t=t2, metrics=[metric]))
+        store.insert(metric, t2, 2)
+        store.insert(metric, t3, 3)
+        self.assertTrue(await tm.f(t=t3, metrics=[metric]))
+        self.assertEqual(store.get.call_count, 1)
+        self.assertEqual(list(received[0].index), [t1])
+        self.assertEqual(list(received[1].index), [t2, t3])
+        self.assertEqual(list(received[1].values), [2, 3])
+        tm.unbind()
+        self.assertEqual(store._windows, {})
+
+    def test_transfermethod_failure_invalid_vectorized(self):
+        ''' creation of a transfermethod object should fail if vectorized is not a bool '''
+        for value in [None, 1, 'True']:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(vectorized=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "vectorized" attribute')
+
+    def test_transfermethod_failure_invalid_admission_parameters(self):
+        ''' creation of a transfermethod object should fail if priority, max_concurrency or timeout are invalid '''
+        for value in [None, 'urgent', 1]:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(priority=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "priority" attribute')
+        for value in [0, -1, 1.5, True, 'str']:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(max_concurrency=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "max_concurrency" attribute')
+        for value in [0, -1, True, 'str']:
+            with self.assertRaises(exceptions.BadParametersException) as cm:
+                tm=transfer_methods.transfermethod(timeout=value)
+            self.assertEqual(cm.exception.msg, 'Invalid "timeout" attribute')
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_max_concurrency(self):
+        ''' no more than max_concurrency executions of the tm should run at a time '''
+        running = []
+        max_running = []
+        async def func():
+            running.append(1)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+        tm=transfer_methods.transfermethod(f=func, schedule=schedules.DummySchedule(), max_concurrency=2)
+        tm._decorate_method(func)
+        await asyncio.gather(*[tm.run(t=TimeUUID(), metrics=[]) for i in range(5)])
+        self.assertEqual(max(max_running), 2)
+        self.assertEqual(tm.telemetry.counters['success'], 5)
+        self.assertEqual(tmIndex.admission.running, 0)
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_timeout_cancels_execution(self):
+        ''' executions lasting more than timeout should be cancelled and counted '''
+        finished = []
+        async def func():
+            await asyncio.sleep(1)
+            finished.append(1)
+        tm=transfer_methods.transfermethod(f=func, schedule=schedules.DummySchedule(), timeout=0.01)
+        tm._decorate_method(func)
+        self.assertEqual(await tm.run(t=TimeUUID(), metrics=[]), [])
+        self.assertEqual(finished, [])
+        self.assertEqual(tm.telemetry.counters['timeout'], 1)
+        self.assertEqual(tm.telemetry.counters['success'], 0)
+        self.assertEqual(tm._running, 0)
+        self.assertEqual(tmIndex.admission.running, 0)
+
+    @test.sync(loop)
+    async def test_backfill_success_on_update_schedule_run_per_tick(self):
+        ''' backfill should run the function for every update in the interval and send the samples in batches '''
+        store = MetricStore()
+        session = Mock(username='user', store=store)
+        metric = Datapoint('uri', session=session)
+        out = Datapoint('out', session=session)
+        t1, t2, t3 = TimeUUID(100), TimeUUID(200), TimeUUID(300)
+        store.get = test.AsyncMock(return_value=pd.Series(index=[t1, t2, t3], data=[1, 2, 3]))
+        def func(t, updated, out):
+            out.insert(t=t, value=len(updated))
+        tm=transfer_methods.transfermethod(f=func, f_params={'out':out}, schedule=schedules.OnUpdateSchedule(activation_metrics=metric))
+        send_samples = test.AsyncMock(return_value={'success':True, 'errors':[]})
+        with patch.object(transfer_methods.prproc, 'send_samples', new=send_samples):
+            stats = await tm.backfill(start=TimeUUID(50), end=TimeUUID(250), batch_size=1)
+        self.assertEqual(stats, {'ticks':2, 'samples':2, 'batches':2, 'errors':0})
+        self.assertEqual(store.get.call_count, 2)
+        batches = [call[0][0] for call in send_samples.call_args_list]
+        self.assertEqual([[(s.metric, s.t, s.value) for s in b] for b in batches], [[(out, t1, 1)], [(out, t2, 1)]])
+        self.assertEqual(store._tr_dfs, {})
+
+    @test.sync(loop)
+    async def test_backfill_success_cron_schedule_vectorized(self):
+        ''' vectorized tms should be run once with every tick of the interval '''
+        store = MetricStore()
+        out = Datapoint('out', session=Mock(username='user', store=store))
+        store.get = test.AsyncMock(return_value=None)
+        calls = []
+        def func(t, ticks, out):
+            calls.append(t)
+            for tick in ticks:
+                out.insert(t=tick, value=1)
+        tm=transfer_methods.transfermethod(f=func, f_params={'out':out}, schedule=schedules.CronSchedule(), vectorized=True)
+        send_samples = test.AsyncMock(return_value={'success':True, 'errors':[]})
+        with patch.object(transfer_methods.prproc, 'send_samples', new=send_samples):
+            stats = await tm.backfill(start=TimeUUID(1500000000), end=TimeUUID(1500000180), batch_size=3)
+        self.assertEqual(stats, {'ticks':4, 'samples':4, 'batches':2, 'errors':0})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].timestamp, 1500000180)
+        sent = [s.t.timestamp for call in send_samples.call_args_list for s in call[0][0]]
+        self.assertEqual(sorted(sent), [1500000000, 1500000060, 1500000120, 1500000180])
+
+    @test.sync(loop)
+    async def test_backfill_success_inputs_requested_once(self):
+        ''' the inputs of every tick should be served from the interval prefetched, even if they are not hooked '''
+        store = MetricStore(readahead=0)
+        session = Mock(username='user', store=store)
+        inp = Datapoint('in', session=session)
+        out = Datapoint('out', session=session)
+        async def func(t, inp, out):
+            data = await inp.get(start=TimeUUID(t=t.timestamp-60, lowest=True), end=t)
+            out.insert(t=t, value=len(data) if data is not None else 0)
+        tm=transfer_methods.transfermethod(f=func, f_params={'inp':inp, 'out':out}, schedule=schedules.CronSchedule())
+        rows = [(TimeUUID(t=1500000000+i*30), decimal.Decimal(i)) for i in range(-2, 7)]
+        request_data = test.AsyncMock(return_value={'success':True, 'data':rows, 'error':None})
+        send_samples = test.AsyncMock(return_value={'success':True, 'errors':[]})
+        with patch.object(transfer_methods.prproc, 'send_samples', new=send_samples), patch('komlogd.api.model.store.prproc.request_data', new=request_data):
+            stats = await tm.backfill(start=TimeUUID(1500000000), end=TimeUUID(1500000180), lookback=pd.Timedelta('60s'))
+        self.assertEqual(stats['ticks'], 4)
+        # every metric in f_params is prefetched once, and not requested again on the ticks
+        self.assertEqual([c[0][0] for c in request_data.call_args_list], [inp, out])
+        sent = sorted((s.t.timestamp, s.value) for call in send_samples.call_args_list for s in call[0][0])
+        self.assertEqual(sent, [(1500000000, 2), (1500000060, 2), (1500000120, 2), (1500000180, 2)])
+        # the ranges of metrics not hooked are released after the backfill
+        self.assertEqual(store._pinned, {})
+        self.assertFalse(inp in store._synced_ranges)
+
+    @test.sync(loop)
+    async def test_backfill_success_windows_filled_with_the_samples_prefetched(self):
+        ''' every tick of a backfill should receive the window ending at the tick, not the live window '''
+        store = MetricStore(readahead=0)
+        session = Mock(username='user', store=store)
+        inp = Datapoint('in', session=session)
+        out = Datapoint('out', session=session)
+        def func(t, windows, out):
+            out.insert(t=t, value=int(sum(windows[inp].values)))
+        tm=transfer_methods.transfermethod(f=func, f_params={'out':out}, schedule=schedules.OnUpdateSchedule(activation_metrics=inp), window=2)
+        rows = [(TimeUUID(t=1500000000+i*60), decimal.Decimal(i)) for i in range(-1, 10)]
+        async def request_data(metric, its, ets, count):
+            data = [r for r in rows if (its is None or its <= r[0]) and (ets is None or r[0] <= ets)] if metric == inp else []
+            return {'success':True, 'data':data[-count:] if count else data, 'error':None}
+        send_samples = test.AsyncMock(return_value={'success':True, 'errors':[]})
+        with patch.object(transfer_methods.prproc, 'send_samples', new=send_samples), patch('komlogd.api.model.store.prproc.request_data', new=request_data):
+            stats = await tm.backfill(start=TimeUUID(t=1500000000, lowest=True), end=TimeUUID(t=1500000540, highest=True))
+        self.assertEqual(stats['ticks'], 10)
+        sent = sorted((s.t, s.value) for call in send_samples.call_args_list for s in call[0][0])
+        self.assertEqual(sent, [(rows[i][0], 2*i-3) for i in range(1, 11)])
+        self.assertEqual(tm._windows, {})
+        self.assertEqual(store._windows, {})
+
+    @test.sync(loop)
+    async def test_run_transfermethod_success_telemetry_recorded(self):
+        ''' run should record queue delay, function, fetch and commit times and the result counters '''
+        store = MetricStore()
+        metric = Datapoint('uri', session=Mock(username='user', store=store))
+        store.get = test.AsyncMock(return_value=None)
+        async def func(t, metric):
+            await metric.get(end=t, count=1)
+        def fail():
+            raise Exception()
+        tm=transfer_methods.transfermethod(f=func, f_params={'metric':metric}, schedule=schedules.DummySchedule())
+        tm._decorate_method(func)
+        t = TimeUUID()
+        await tm.request_run(t=t, metrics=[])
+        tel = tm.telemetry.to_dict()
+        self.assertEqual(tel['counters'], {'success':1, 'failure':0, 'commit_failure':0, 'timeout':0})
+        for name in ('queue_delay', 'function', 'fetch', 'commit'):
+            self.assertEqual(tel['latencies'][name]['count'], 1)
+        tm._decorate_method(fail)
+        await tm.run(t=t, metrics=[])
+        tel = tm.telemetry.to_dict()
+        self.assertEqual(tel['counters'], {'success':1, 'failure':1, 'commit_failure':0, 'timeout':0})
+        self.assertEqual(tel['latencies']['queue_delay']['count'], 1)
+        self.assertEqual(tel['latencies']['function']['count'], 1)
+
     def test_run_transfermethod_success_decorated_tm(self):
         ''' calling run should execute the tm associated function '''
         var = 0
@@ -7,25 +7,74 @@ transfermethod decorator
 
 import asyncio
 import inspect
+import itertools
+import time
 import uuid
 import pandas as pd
 import traceback
 import weakref
-from functools import wraps
-from komlogd.api.common import logging, exceptions
-from komlogd.api.model.metrics import Metric
-from komlogd.api.model.schedules import Schedule, OnUpdateSchedule
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
+from komlogd.api.common import logging, exceptions, timeuuid
+from komlogd.api.model.metrics import Metric, DeferredInserts
+from komlogd.api.model.schedules import Schedule, OnUpdateSchedule, CronSchedule
+from komlogd.api.model.telemetry import TransferMethodTelemetry
+from komlogd.api.model.windows import MetricWindow
 from komlogd.api.model.transactions import Transaction, TransactionTask
-from komlogd.api.model.transfer_methods import tmIndex
+from komlogd.api.model.transfer_methods import TransferMethodsIndex, tmIndex, PRIORITIES
+from komlogd.api.protocol.processing import procedure as prproc
+
+EXECUTORS = ('loop', 'thread', 'process')
+
+_process_pool = None
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor()
+    return _process_pool
+
+def _find_metrics(obj):
+    if isinstance(obj, Metric):
+        yield obj
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _find_metrics(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _find_metrics(item)
+
+def _run_deferred(f, exec_params):
+    ''' runs f in an executor. Returns the samples inserted, to insert them from the event loop '''
+    with DeferredInserts() as deferred:
+        f(**exec_params)
+    return deferred.samples
 
 
 class transfermethod:
 
-    def __init__(self, f=None, f_params=None, schedule=None):
+    def __init__(self, f=None, f_params=None, schedule=None, coalesce=0, min_interval=0, skip_if_running=False, executor='loop', prefetch=None, window=None, vectorized=False, priority='normal', max_concurrency=None, timeout=None):
         self.mid = uuid.uuid4()
         self._f = f
         self.f_params = f_params
         self.schedule = schedule
+        self.executor = executor
+        self.prefetch = prefetch
+        self.window = window
+        self._windows = {}
+        self.vectorized = vectorized
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._concurrency = None
+        self.coalesce = coalesce
+        self.min_interval = min_interval
+        self.skip_if_running = skip_if_running
+        self._pending = None
+        self._running = 0
+        self._last_run = None
+        self.stats = {'runs':0, 'coalesced':0, 'skipped':0}
+        self.telemetry = TransferMethodTelemetry()
 
     @property
     def f_params(self):
@@ -37,7 +86,7 @@ class transfermethod:
             self._f_params = {}
         elif isinstance(value, dict):
             for k in value.keys():
-                if k in ['t','updated','others']:
+                if k in ['t','updated','others','prefetched','windows','ticks']:
                     raise exceptions.BadParametersException('Invalid function parameter. "{}" is a reserved parameter'.format(str(k)))
             else:
                 self._f_params = value
@@ -52,16 +101,119 @@ class transfermethod:
     def schedule(self, value):
         if value is None or isinstance(value, Schedule):
             self._schedule = value
+            TransferMethodsIndex.schedule_updated(self.mid)
         else:
             raise exceptions.BadParametersException('Invalid "schedule" attribute')
 
-    def _get_execution_params(self, t, metrics):
+    @property
+    def executor(self):
+        return self._executor
+
+    @executor.setter
+    def executor(self, value):
+        if value in EXECUTORS:
+            self._executor = value
+        else:
+            raise exceptions.BadParametersException('Invalid "executor" attribute')
+
+    @property
+    def prefetch(self):
+        return self._prefetch
+
+    @prefetch.setter
+    def prefetch(self, value):
+        if value is None or isinstance(value, pd.Timedelta) or (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self._prefetch = value
+        else:
+            raise exceptions.BadParametersException('Invalid "prefetch" attribute')
+
+    @property
+    def window(self):
+        return self._window
+
+    @window.setter
+    def window(self, value):
+        if value is None or isinstance(value, pd.Timedelta) or (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self._window = value
+        else:
+            raise exceptions.BadParametersException('Invalid "window" attribute')
+
+    @property
+    def vectorized(self):
+        return self._vectorized
+
+    @vectorized.setter
+    def vectorized(self, value):
+        if isinstance(value, bool):
+            self._vectorized = value
+        else:
+            raise exceptions.BadParametersException('Invalid "vectorized" attribute')
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, value):
+        if value in PRIORITIES:
+            self._priority = value
+        else:
+            raise exceptions.BadParametersException('Invalid "priority" attribute')
+
+    @property
+    def max_concurrency(self):
+        return self._max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value):
+        if value is None or (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self._max_concurrency = value
+            self._concurrency = None
+        else:
+            raise exceptions.BadParametersException('Invalid "max_concurrency" attribute')
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+            self._timeout = value
+        else:
+            raise exceptions.BadParametersException('Invalid "timeout" attribute')
+
+    @property
+    def coalesce(self):
+        return self._coalesce
+
+    @coalesce.setter
+    def coalesce(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0:
+            self._coalesce = value
+        else:
+            raise exceptions.BadParametersException('Invalid "coalesce" attribute')
+
+    @property
+    def min_interval(self):
+        return self._min_interval
+
+    @min_interval.setter
+    def min_interval(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0:
+            self._min_interval = value
+        else:
+            raise exceptions.BadParametersException('Invalid "min_interval" attribute')
+
+    def _get_execution_params(self, t, metrics, ticks=None):
         exec_params={}
         updated = []
         others = []
         for arg in self._func_params:
             if arg == 't':
                 exec_params[arg]=t
+            elif arg == 'ticks':
+                exec_params[arg]=ticks if ticks != None else [t]
             elif arg == 'updated':
                 exec_params[arg]=metrics
             elif arg == 'others':
@@ -70,15 +222,79 @@ class transfermethod:
                 exec_params[arg]=self._f_params[arg]
         return exec_params
 
+    async def _get_prefetched(self, t):
+        ''' Returns the data of the activation metrics requested with the prefetch attribute '''
+        prefetched = {}
+        for metric in self.schedule.activation_metrics:
+            if self.prefetch is None:
+                prefetched[metric] = None
+            elif isinstance(self.prefetch, pd.Timedelta):
+                start = timeuuid.TimeUUID(t=t.timestamp-self.prefetch.total_seconds(), lowest=True)
+                prefetched[metric] = await metric.get(start=start, end=t)
+            else:
+                prefetched[metric] = await metric.get(end=t, count=self.prefetch)
+        return prefetched
+
+    async def _get_windows(self, t, backfill=None):
+        '''
+        Returns the window ending at t of every activation metric. Windows are requested to
+        the store the first time, and then kept updated with the data stored. backfill has
+        the windows of a backfill, used instead.
+        '''
+        windows = {}
+        for metric in self.schedule.activation_metrics:
+            if self.window is None:
+                windows[metric] = None
+                continue
+            if backfill is not None:
+                windows[metric] = backfill[metric].series(t)
+                continue
+            window = self._windows.get(metric, None)
+            if window is None:
+                window = MetricWindow(metric=metric, size=self.window)
+                metric.session.store.add_window(window)
+                self._windows[metric] = window
+            await window.load(t)
+            windows[metric] = window.series(t)
+        return windows
+
+    def _release_windows(self):
+        for metric, window in getattr(self, '_windows', {}).items():
+            try:
+                metric.session.store.remove_window(window)
+            except exceptions.SessionNotFoundException:
+                pass
+        self._windows = {}
+
+    async def _run_in_executor(self, f, exec_params):
+        '''
+        Synchronous functions run in a thread or process. Their inserts are applied
+        to the transaction when they finish.
+        '''
+        executor = _get_process_pool() if self.executor == 'process' else None
+        loop = asyncio.get_event_loop()
+        samples = await loop.run_in_executor(executor, partial(_run_deferred, f, exec_params))
+        # metrics returned by a process lose their session. Bind them to the session of the metric sent
+        sessions = {(m._m_type_, m.uri):m._session for m in _find_metrics(exec_params) if m._session != None}
+        for sample in samples:
+            if sample.metric._session is None:
+                sample.metric._session = sessions.get((sample.metric._m_type_, sample.metric.uri), None)
+            sample.metric.insert(t=sample.t, value=sample.value)
+
     def _decorate_method(self, f):
         @wraps(f)
-        async def decorated(t, metrics):
-            now=pd.Timestamp('now',tz='utc')
-            exec_params=self._get_execution_params(t=t, metrics=metrics)
+        async def decorated(t, metrics, ticks=None, windows=None):
+            exec_params=self._get_execution_params(t=t, metrics=metrics, ticks=ticks)
+            if 'prefetched' in self._func_params:
+                exec_params['prefetched'] = await self._get_prefetched(t)
+            if 'windows' in self._func_params:
+                exec_params['windows'] = await self._get_windows(t, backfill=windows)
             if asyncio.iscoroutinefunction(f):
                 await f(**exec_params)
-            else:
+            elif self.executor == 'loop':
                 f(**exec_params)
+            else:
+                await self._run_in_executor(f, exec_params)
             return True
         self.f = decorated
         self._func_params = inspect.signature(f).parameters
@@ -104,22 +320,262 @@ class transfermethod:
     def unbind(self):
         logging.logger.debug('Unbinding transfer method '+self.mid.hex)
         tmIndex.delete_tm(self.mid)
+        self._release_windows()
+
+    def request_run(self, t, metrics, irt=None):
+        '''
+        Requests an execution because of updated metrics. Updates received during the
+        coalesce window, or before min_interval has passed since the last run, are merged
+        in one execution. If skip_if_running is set, updates received while the tm is
+        running are discarded.
+        '''
+        if self._pending != None:
+            for m in metrics:
+                if m not in self._pending['metrics']:
+                    self._pending['metrics'].append(m)
+            self._pending['t'] = t
+            self._pending['irt'] = irt
+            self.stats['coalesced'] += 1
+            return None
+        if self.skip_if_running and self._running > 0:
+            self.stats['skipped'] += 1
+            return None
+        delay = self._run_delay()
+        if delay <= 0:
+            return asyncio.ensure_future(self.run(t=t, metrics=metrics, irt=irt, queued=time.monotonic()))
+        self._pending = {'t':t, 'metrics':list(metrics), 'irt':irt, 'queued':time.monotonic()}
+        return asyncio.ensure_future(self._run_pending(delay))
+
+    def _run_delay(self):
+        ''' seconds a requested execution waits because of coalesce and min_interval '''
+        delay = self.coalesce
+        if self.min_interval and self._last_run != None:
+            delay = max(delay, self._last_run + self.min_interval - time.monotonic())
+        return delay
 
-    async def run(self, t, metrics, irt=None):
+    def _runs_now(self):
+        ''' True if a requested execution would run now, not merged, skipped or delayed '''
+        if self._pending != None or (self.skip_if_running and self._running > 0):
+            return False
+        return self._run_delay() <= 0
+
+    async def _run_pending(self, delay):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            pending, self._pending = self._pending, None
+        if self.skip_if_running and self._running > 0:
+            self.stats['skipped'] += 1
+            return
+        await self.run(t=pending['t'], metrics=pending['metrics'], irt=pending['irt'], queued=pending['queued'])
+
+    async def run(self, t, metrics, irt=None, queued=None, propagate=True):
+        '''
+        queued is the monotonic time when the execution was requested. If propagate is set,
+        the tms activated by the samples commited are run locally after this one.
+        The execution waits for a slot of the tm, if max_concurrency is set, and then for
+        the admission of the index, and is cancelled if it lasts more than timeout.
+        Returns the samples commited.
+        '''
+        self._running += 1
+        try:
+            if self.max_concurrency != None:
+                if self._concurrency is None:
+                    self._concurrency = asyncio.Semaphore(self.max_concurrency)
+                async with self._concurrency:
+                    committed = await self._admit_and_run(t=t, metrics=metrics, irt=irt, queued=queued)
+            else:
+                committed = await self._admit_and_run(t=t, metrics=metrics, irt=irt, queued=queued)
+        finally:
+            self._running -= 1
+        if propagate and committed:
+            await tmIndex.propagate(self.mid, committed, irt=irt)
+        return committed
+
+    async def _admit_and_run(self, t, metrics, irt, queued):
+        await tmIndex.admission.acquire(self.priority)
+        try:
+            self._last_run = time.monotonic()
+            self.stats['runs'] += 1
+            if queued != None:
+                self.telemetry.latencies['queue_delay'].add(self._last_run-queued)
+            if self.timeout is None:
+                return await self._run(t=t, metrics=metrics, irt=irt)
+            try:
+                return await asyncio.wait_for(self._run(t=t, metrics=metrics, irt=irt), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.telemetry.counters['timeout'] += 1
+                logging.logger.error('Execution of tm {} cancelled after {} s.'.format(self.mid.hex, self.timeout))
+                return []
+        finally:
+            tmIndex.admission.release()
+
+    async def _run(self, t, metrics, irt=None):
+        committed = []
+        latencies = self.telemetry.latencies
+        counters = self.telemetry.counters
         async with Transaction(t=t, irt=irt) as tr:
+            started = time.monotonic()
             try:
                 await TransactionTask(coro=self.f(t=t, metrics=metrics), tr=tr)
             except Exception:
+                counters['failure'] += 1
                 logging.logger.error('Error while executing tm {}. disabling it.'.format(self.mid.hex))
                 ex_info=traceback.format_exc().splitlines()
                 for line in ex_info:
                     logging.logger.error(line)
             else:
+                latencies['function'].add(time.monotonic()-started)
+                latencies['fetch'].add(tr.fetch_time)
+                started = time.monotonic()
                 try:
                     await tr.commit()
                 except exceptions.SessionException as e:
+                    counters['commit_failure'] += 1
                     logging.logger.error('Transaction could not be commited completely {}.'.format(tr.tid.hex))
                     logging.logger.error('Error: {}'.format(e.msg))
+                else:
+                    counters['success'] += 1
+                    latencies['commit'].add(time.monotonic()-started)
+                    committed = tr.committed
+        return committed
+
+    async def backfill(self, start, end, lookback=None, batch_size=1000, max_inflight=4):
+        '''
+        Replays the schedule over the interval [start, end]. The inputs are requested in bulk
+        first, from start-lookback, and the function is run for every tick of the interval,
+        or once with all of them if the tm is vectorized. Inserted samples are sent in
+        batches of batch_size, with up to max_inflight batches pending at a time.
+        '''
+        if not isinstance(start, timeuuid.TimeUUID) or not isinstance(end, timeuuid.TimeUUID) or start > end:
+            raise exceptions.BadParametersException('Invalid backfill interval')
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise exceptions.BadParametersException('Invalid "batch_size" attribute')
+        if getattr(self, 'f', None) is None:
+            if self._f is None:
+                raise exceptions.BadParametersException('No function associated to transfermethod object')
+            self._decorate_method(self._f)
+        if lookback is None:
+            lookback = max((x for x in (self.window, self.prefetch) if isinstance(x, pd.Timedelta)), default=pd.Timedelta(0))
+        inputs = []
+        for metric in itertools.chain(self.schedule.activation_metrics, _find_metrics(self.f_params)):
+            if metric not in inputs:
+                inputs.append(metric)
+        its = timeuuid.TimeUUID(t=max(start.timestamp-lookback.total_seconds(), 0), lowest=True)
+        # inputs are pinned so the interval prefetched is served from the store on every tick
+        for metric in inputs:
+            metric.session.store.pin([metric])
+        try:
+            return await self._backfill(start, end, its, inputs, batch_size, max_inflight)
+        finally:
+            for metric in inputs:
+                metric.session.store.unpin([metric])
+
+    async def _backfill(self, start, end, its, inputs, batch_size, max_inflight):
+        data = await asyncio.gather(*[metric.get(start=its, end=end) for metric in inputs])
+        prefetched = dict(zip(inputs, data))
+        ticks = self._get_backfill_ticks(start, end, prefetched)
+        windows = await self._get_backfill_windows(its, prefetched)
+        stats = {'ticks':len(ticks), 'samples':0, 'batches':0, 'errors':0}
+        sem = asyncio.Semaphore(max_inflight)
+        sending = []
+        pending = []
+
+        async def send(batch):
+            try:
+                response = await prproc.send_samples(batch)
+                stats['errors'] += len(response['errors'])
+            finally:
+                sem.release()
+
+        cursors = {metric:0 for metric in windows or {}}
+
+        def advance(t):
+            ''' appends to the backfill windows the samples prefetched up to t '''
+            for metric, window in (windows or {}).items():
+                data = prefetched.get(metric, None)
+                if data is None:
+                    continue
+                i = cursors[metric]
+                while i < len(data) and data.index[i] <= t:
+                    window.append(data.index[i], data.iloc[i])
+                    i += 1
+                cursors[metric] = i
+
+        async def flush(force=False):
+            while pending and (force or len(pending) >= batch_size):
+                batch = pending[:batch_size]
+                del pending[:batch_size]
+                await sem.acquire()
+                stats['batches'] += 1
+                stats['samples'] += len(batch)
+                sending.append(asyncio.ensure_future(send(batch)))
+
+        try:
+            if self.vectorized and ticks:
+                updated = []
+                for tick, metrics in ticks:
+                    updated.extend(m for m in metrics if m not in updated)
+                t = ticks[-1][0]
+                advance(t)
+                async with Transaction(t=t) as tr:
+                    await TransactionTask(coro=self.f(t=t, metrics=updated, ticks=[tick for tick, metrics in ticks], windows=windows), tr=tr)
+                    pending.extend(tr.inserted_samples())
+                await flush()
+            else:
+                for t, metrics in ticks:
+                    advance(t)
+                    async with Transaction(t=t) as tr:
+                        await TransactionTask(coro=self.f(t=t, metrics=metrics, windows=windows), tr=tr)
+                        pending.extend(tr.inserted_samples())
+                    await flush()
+            await flush(force=True)
+        finally:
+            if sending:
+                await asyncio.gather(*sending)
+        logging.logger.debug('Backfill of tm {} finished. {}'.format(self.mid.hex, str(stats)))
+        return stats
+
+    async def _get_backfill_windows(self, its, prefetched):
+        '''
+        Returns new windows of the activation metrics, filled with the prefetched samples as
+        the ticks advance. The live windows are not modified. Count windows are loaded with
+        the samples before the interval prefetched, time windows are covered by the lookback.
+        '''
+        if self.window is None:
+            return None
+        windows = {}
+        for metric in self.schedule.activation_metrics:
+            data = prefetched.get(metric, None)
+            if data is not None:
+                prefetched[metric] = data.sort_index()
+            window = MetricWindow(metric=metric, size=self.window)
+            if window.count_based:
+                await window.load(its)
+            windows[metric] = window
+        return windows
+
+    def _get_backfill_ticks(self, start, end, prefetched):
+        ''' Returns the (t, updated metrics) executions of the schedule in [start, end] '''
+        if isinstance(self.schedule, CronSchedule):
+            ticks = []
+            ts = self.schedule.next_after(start.timestamp-1)
+            while ts != None and ts <= end.timestamp:
+                if ts >= start.timestamp:
+                    ticks.append((timeuuid.TimeUUID(t=ts, lowest=True), []))
+                ts = self.schedule.next_after(ts)
+            return ticks
+        elif isinstance(self.schedule, OnUpdateSchedule):
+            updates = {}
+            for metric in self.schedule.activation_metrics:
+                data = prefetched.get(metric, None)
+                if data is None:
+                    continue
+                for t in data.index:
+                    if start <= t <= end:
+                        updates.setdefault(t, []).append(metric)
+            return sorted(updates.items())
+        raise exceptions.BadParametersException('Schedule does not support backfill')
 
     def __del__(self):
         logging.logger.debug('Automatically unbinding transfer method '+self.mid.hex)
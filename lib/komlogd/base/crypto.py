@@ -3,8 +3,13 @@ from komlogd.api.common import crypto
 from komlogd.base import config, exceptions, logging
 from komlogd.base.settings import defaults
 
+# private keys already loaded, by file
+_keys = {}
+
 def get_private_key():
     privkey_file = config.config.key
+    if privkey_file in _keys:
+        return _keys[privkey_file]
     if not os.path.isfile(privkey_file):
         logging.logger.debug('Generating RSA keys...')
         key_dir=os.path.dirname(privkey_file)
@@ -15,10 +20,10 @@ def get_private_key():
         pubkey=privkey.public_key()
         key_str=crypto.get_printable_pubkey(pubkey)
         logging.logger.info('This is the public key, add it to your Komlog account:\n'+key_str)
-        return privkey
     else:
         privkey=crypto.load_private_key(privkey_file)
-        return privkey
+    _keys[privkey_file] = privkey
+    return privkey
 
 def get_public_key():
     privkey=get_private_key()
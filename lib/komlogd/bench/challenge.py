@@ -0,0 +1,67 @@
+'''
+
+Login challenge benchmark
+
+Measures the event loop lag while solving login challenges, running the
+cpu bound RSA operations inline in the loop and in the loop default executor,
+as KomlogSession does. The lag is sampled with a ticker task that sleeps 1ms.
+
+'''
+
+import argparse
+import asyncio
+import time
+from base64 import b64encode
+from komlogd.api.common import crypto
+
+MODES = ('inline', 'executor')
+
+
+async def _ticker(lags, stop, interval=0.001):
+    while not stop:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lags.append(time.monotonic()-start-interval)
+
+async def run_benchmark(mode, privkey, num_challenges=20, loop=None):
+    loop = loop or asyncio.get_event_loop()
+    if mode not in MODES:
+        raise ValueError('Invalid mode')
+    challenge = b64encode(crypto.encrypt(privkey.public_key(), b'x'*32)).decode()
+    lags = []
+    stop = []
+    ticker = asyncio.ensure_future(_ticker(lags, stop), loop=loop)
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    for i in range(num_challenges):
+        if mode == 'inline':
+            crypto.solve_challenge(privkey, challenge)
+        else:
+            await loop.run_in_executor(None, crypto.solve_challenge, privkey, challenge)
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter()-start
+    stop.append(True)
+    await ticker
+    return {
+        'mode':mode,
+        'challenges_per_second':num_challenges/elapsed if elapsed else None,
+        'max_lag_ms':max(lags)*1000 if lags else None,
+    }
+
+def menu():
+    parser = argparse.ArgumentParser(description='komlogd login challenge benchmark')
+    parser.add_argument('-c','--challenges', required=False, type=int, default=20, help='Number of challenges solved')
+    parser.add_argument('-k','--key-size', required=False, type=int, default=4096, help='RSA key size')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = menu()
+    loop = asyncio.get_event_loop()
+    privkey = crypto.generate_rsa_key(key_size=args.key_size)
+    for mode in MODES:
+        result = loop.run_until_complete(run_benchmark(mode, privkey, num_challenges=args.challenges, loop=loop))
+        print('{}: challenges per second: {:.1f}, max loop lag: {:.1f} ms'.format(mode, result['challenges_per_second'], result['max_lag_ms']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+
+End to end load benchmark
+
+Runs a KomlogSession against the in-process server stand-in, inserting
+samples inside transactions, and reports throughput, commit latency and
+cpu usage per message.
+
+'''
+
+import argparse
+import asyncio
+import time
+from komlogd.api import session
+from komlogd.api.common import crypto, timeuuid
+from komlogd.api.model.metrics import Datapoint
+from komlogd.api.model.transactions import Transaction, TransactionTask
+from komlogd.bench.server import KomlogServerStandIn
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = min(len(values)-1, int(round(p/100*(len(values)-1))))
+    return values[index]
+
+async def _insert(metrics, t, value):
+    for metric in metrics:
+        metric.insert(t=t, value=value)
+
+async def run_benchmark(num_metrics=100, num_commits=1000, latency=0, loss=0, num_connections=1, loop=None):
+    loop = loop or asyncio.get_event_loop()
+    server = KomlogServerStandIn(latency=latency, loss=loss, loop=loop)
+    await server.start()
+    privkey = crypto.generate_rsa_key()
+    s = session.KomlogSession(username='bench', privkey=privkey, num_connections=num_connections, login_url=server.login_url, ws_url=server.ws_url)
+    try:
+        await s.login()
+        metrics = [Datapoint(uri='bench.metric_{}'.format(i), session=s) for i in range(num_metrics)]
+        latencies = []
+        received = server.stats['received']
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        for i in range(num_commits):
+            t = timeuuid.TimeUUID()
+            async with Transaction(t=t) as tr:
+                await TransactionTask(coro=_insert(metrics, t, i), tr=tr)
+                commit_start = time.monotonic()
+                await tr.commit()
+                latencies.append(time.monotonic()-commit_start)
+        elapsed = time.monotonic()-start
+        cpu = time.process_time()-cpu_start
+        num_messages = server.stats['received']-received
+    finally:
+        await s.close()
+        await server.stop()
+    return {
+        'samples':num_metrics*num_commits,
+        'messages':num_messages,
+        'elapsed':elapsed,
+        'samples_per_second':num_metrics*num_commits/elapsed if elapsed else None,
+        'commit_latency':{
+            'p50':percentile(latencies, 50),
+            'p90':percentile(latencies, 90),
+            'p99':percentile(latencies, 99),
+            'max':max(latencies) if latencies else None,
+        },
+        'cpu_per_message':cpu/num_messages if num_messages else None,
+    }
+
+def menu():
+    parser = argparse.ArgumentParser(description='komlogd end to end benchmark')
+    parser.add_argument('-m','--metrics', required=False, type=int, default=100, help='Number of metrics updated in each commit')
+    parser.add_argument('-n','--commits', required=False, type=int, default=1000, help='Number of transactions commited')
+    parser.add_argument('-l','--latency', required=False, type=float, default=0, help='Server response latency in seconds')
+    parser.add_argument('-p','--loss', required=False, type=float, default=0, help='Server response loss probability')
+    parser.add_argument('-c','--connections', required=False, type=int, default=1, help='Number of websocket connections')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = menu()
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(run_benchmark(num_metrics=args.metrics, num_commits=args.commits, latency=args.latency, loss=args.loss, num_connections=args.connections, loop=loop))
+    print('samples: {}'.format(result['samples']))
+    print('messages: {}'.format(result['messages']))
+    print('elapsed: {:.3f} s'.format(result['elapsed']))
+    print('samples per second: {:.1f}'.format(result['samples_per_second']))
+    for k,v in result['commit_latency'].items():
+        print('commit latency {}: {:.2f} ms'.format(k, v*1000))
+    print('cpu per message: {:.1f} us'.format(result['cpu_per_message']*1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''
+
+Komlog server stand-in
+
+In-process server implementing the login challenge and the agent protocol,
+for measuring komlogd without connecting to Komlog.
+
+'''
+
+import asyncio
+import json
+import os
+import random
+import socket
+from base64 import b64encode
+from aiohttp import web
+from komlogd.api.common import crypto, timeuuid
+from komlogd.api.protocol import messages
+from komlogd.api.protocol.codes import Status
+from komlogd.api.model.metrics import Metrics
+
+
+class KomlogServerStandIn:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, loss=0, loop=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self._loop = loop or asyncio.get_event_loop()
+        self._runner = None
+        self._server = None
+        self._handler = None
+        self._app = None
+        self._challenges = {}
+        self._metrics = {}
+        self._hooks = {}
+        self._wss = set()
+        self.stats = {'received':0, 'sent':0, 'dropped':0, 'samples':0}
+
+    @property
+    def login_url(self):
+        return 'http://{}:{}/login'.format(self.host, self.port)
+
+    @property
+    def ws_url(self):
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/login', self._login_handler)
+        app.router.add_get('/', self._ws_handler)
+        # we bind the socket ourselves to know the port assigned if port is 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        if hasattr(web, 'AppRunner'):
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            site = web.SockSite(self._runner, sock)
+            await site.start()
+        else:
+            # aiohttp 2
+            self._app = app
+            self._handler = app.make_handler(loop=self._loop)
+            self._server = await self._loop.create_server(self._handler, sock=sock)
+
+    async def stop(self):
+        for ws in list(self._wss):
+            await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            await self._app.shutdown()
+            await self._handler.shutdown()
+            await self._app.cleanup()
+            self._server = None
+        self._server = None
+        self._handler = None
+        self._app = None
+
+    async def _login_handler(self, request):
+        data = await request.post()
+        if not ('u' in data and 'k' in data and 'pv' in data):
+            return web.json_response({'error':'missing parameters'}, status=400)
+        if not 'c' in data:
+            pubkey = crypto.deserialize_public_key(data['k'])
+            plaintext = os.urandom(32)
+            self._challenges[data['k']] = b64encode(crypto.get_hash(plaintext)).decode('utf-8')
+            challenge = b64encode(crypto.encrypt(pubkey, plaintext)).decode('utf-8')
+            return web.json_response({'challenge':challenge})
+        elif self._challenges.pop(data['k'], None) == data['c']:
+            return web.json_response({})
+        else:
+            return web.json_response({'error':'access denied'}, status=403)
+
+    async def _ws_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._wss.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == web.WSMsgType.TEXT:
+                    self.stats['received'] += 1
+                    self._process_message(ws, json.loads(msg.data))
+        finally:
+            self._wss.discard(ws)
+            for wss in self._hooks.values():
+                wss.discard(ws)
+        return ws
+
+    def _process_message(self, ws, data):
+        action = data['action']
+        payload = data['payload']
+        if action == messages.Actions.HOOK_TO_URI.value:
+            self._hooks.setdefault(payload['uri'], set()).add(ws)
+            status = Status.MESSAGE_EXECUTION_OK if payload['uri'] in self._metrics else Status.RESOURCE_NOT_FOUND
+            self._respond(ws, [self._generic_response(data, status)])
+        elif action == messages.Actions.UNHOOK_FROM_URI.value:
+            self._hooks.get(payload['uri'], set()).discard(ws)
+            self._respond(ws, [self._generic_response(data, Status.MESSAGE_EXECUTION_OK)])
+        elif action == messages.Actions.REQUEST_DATA.value:
+            rsps = [self._generic_response(data, Status.MESSAGE_ACCEPTED_FOR_PROCESSING), self._data_interval(data)]
+            self._respond(ws, rsps)
+        elif action == messages.Actions.SEND_DS_DATA.value:
+            self._store(ws, data, [{'uri':payload['uri'], 'type':Metrics.DATASOURCE.value, 'content':payload['content']}])
+        elif action == messages.Actions.SEND_DP_DATA.value:
+            self._store(ws, data, [{'uri':payload['uri'], 'type':Metrics.DATAPOINT.value, 'content':payload['content']}])
+        elif action == messages.Actions.SEND_MULTI_DATA.value:
+            self._store(ws, data, payload['uris'])
+        elif action == messages.Actions.SEND_DS_INFO.value:
+            self._respond(ws, [self._generic_response(data, Status.MESSAGE_EXECUTION_OK)])
+        else:
+            self._respond(ws, [self._generic_response(data, Status.PROTOCOL_ERROR, error=1, reason='unknown action')])
+
+    def _store(self, ws, data, uris):
+        t = data['payload']['t']
+        for item in uris:
+            metric = self._metrics.setdefault(item['uri'], {'type':item['type'], 'rows':{}})
+            metric['rows'][t] = item['content']
+            self.stats['samples'] += 1
+        by_ws = {}
+        for item in uris:
+            for hooked_ws in self._hooks.get(item['uri'], []):
+                by_ws.setdefault(hooked_ws, []).append(item)
+        for hooked_ws, items in by_ws.items():
+            self._respond(hooked_ws, [{
+                'v':messages.KomlogMessage._version_,
+                'action':messages.Actions.SEND_MULTI_DATA.value,
+                'seq':timeuuid.TimeUUID().hex,
+                'irt':None,
+                'payload':{'t':t, 'uris':items}
+            }])
+        self._respond(ws, [self._generic_response(data, Status.MESSAGE_ACCEPTED_FOR_PROCESSING)])
+
+    def _generic_response(self, data, status, error=0, reason=None):
+        return {
+            'v':messages.KomlogMessage._version_,
+            'action':messages.Actions.GENERIC_RESPONSE.value,
+            'seq':timeuuid.TimeUUID().hex,
+            'irt':data['seq'],
+            'payload':{'status':status.value, 'error':error, 'reason':reason}
+        }
+
+    def _data_interval(self, data):
+        payload = data['payload']
+        # unknown metrics get an empty interval, so the client does not wait for it
+        metric = self._metrics.get(payload['uri'], {'type':Metrics.DATASOURCE.value, 'rows':{}})
+        start = timeuuid.TimeUUID(s=payload['start']) if payload['start'] else timeuuid.MIN_TIMEUUID
+        end = timeuuid.TimeUUID(s=payload['end']) if payload['end'] else timeuuid.MAX_TIMEUUID
+        rows = [(timeuuid.TimeUUID(s=t),v) for t,v in metric['rows'].items()]
+        rows = sorted([r for r in rows if start <= r[0] <= end], key=lambda r: r[0], reverse=True)
+        count = payload['count']
+        if count:
+            rows = rows[-count:] if payload['end'] is None else rows[:count]
+        return {
+            'v':messages.KomlogMessage._version_,
+            'action':messages.Actions.SEND_DATA_INTERVAL.value,
+            'seq':timeuuid.TimeUUID().hex,
+            'irt':data['seq'],
+            'payload':{
+                'uri':{'uri':payload['uri'], 'type':metric['type']},
+                'start':start.hex,
+                'end':end.hex,
+                'data':[[r[0].hex, r[1]] for r in rows]
+            }
+        }
+
+    def _respond(self, ws, rsps):
+        if self.loss and random.random() < self.loss:
+            self.stats['dropped'] += len(rsps)
+            return
+        asyncio.ensure_future(self._send(ws, rsps), loop=self._loop)
+
+    async def _send(self, ws, rsps):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for rsp in rsps:
+            if ws.closed:
+                return
+            # send_str is a coroutine since aiohttp 3
+            result = ws.send_str(json.dumps(rsp))
+            if asyncio.iscoroutine(result):
+                await result
+            self.stats['sent'] += 1
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import unittest
+from komlogd.api import session
+from komlogd.api.common import crypto
+from komlogd.api.common.timeuuid import TimeUUID
+from komlogd.api.protocol import messages
+from komlogd.api.protocol.codes import Status
+from komlogd.bench.server import KomlogServerStandIn
+
+
+class BenchServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = KomlogServerStandIn(loop=self.loop)
+        self.loop.run_until_complete(self.server.start())
+        self.session = session.KomlogSession(username='username', privkey=crypto.generate_rsa_key(), login_url=self.server.login_url, ws_url=self.server.ws_url)
+        self.session._loop = self.loop
+
+    def tearDown(self):
+        async def close():
+            if self.session._wss[0]:
+                await self.session._wss[0].close()
+            if self.session._session:
+                await self.session._session.close()
+            await self.server.stop()
+        self.loop.run_until_complete(close())
+        self.loop.close()
+
+    def _request(self, message, num_responses=1):
+        async def request():
+            await self.session._send_frame(message)
+            return [json.loads((await self.session._wss[0].receive()).data) for i in range(num_responses)]
+        return self.loop.run_until_complete(request())
+
+    def test_login_and_ws_connect_success(self):
+        ''' the session should authenticate against the stand-in solving its challenge '''
+        self.loop.run_until_complete(self.session._auth())
+        self.loop.run_until_complete(self.session._ws_connect())
+        self.assertFalse(self.session._wss[0].closed)
+
+    def test_hook_send_and_request_data_success(self):
+        ''' the stand-in should store samples, echo them to hooked connections and return them on request '''
+        self.loop.run_until_complete(self.session._auth())
+        self.loop.run_until_complete(self.session._ws_connect())
+        rsps = self._request(messages.HookToUri(uri='my.uri'))
+        self.assertEqual(rsps[0]['payload']['status'], Status.RESOURCE_NOT_FOUND)
+        t = TimeUUID()
+        rsps = self._request(messages.SendDpData(uri='my.uri', t=t, content=1), num_responses=2)
+        self.assertEqual(rsps[0]['action'], messages.Actions.SEND_MULTI_DATA.value)
+        self.assertEqual(rsps[0]['payload']['uris'][0]['uri'], 'my.uri')
+        self.assertEqual(rsps[1]['payload']['status'], Status.MESSAGE_ACCEPTED_FOR_PROCESSING)
+        msg = messages.RequestData(uri='my.uri', start=None, end=None, count=10)
+        rsps = self._request(msg, num_responses=2)
+        self.assertEqual(rsps[1]['action'], messages.Actions.SEND_DATA_INTERVAL.value)
+        self.assertEqual(rsps[1]['irt'], msg.seq.hex)
+        self.assertEqual(rsps[1]['payload']['data'], [[t.hex, '1']])
+        self.assertEqual(self.server.stats['samples'], 1)
+
+    def test_request_data_success_unknown_metric_empty_interval(self):
+        ''' the stand-in should answer requests of unknown metrics with an empty interval '''
+        self.loop.run_until_complete(self.session._auth())
+        self.loop.run_until_complete(self.session._ws_connect())
+        msg = messages.RequestData(uri='unknown.uri', start=None, end=None, count=10)
+        rsps = self._request(msg, num_responses=2)
+        self.assertEqual(rsps[0]['payload']['status'], Status.MESSAGE_ACCEPTED_FOR_PROCESSING)
+        self.assertEqual(rsps[1]['action'], messages.Actions.SEND_DATA_INTERVAL.value)
+        self.assertEqual(rsps[1]['irt'], msg.seq.hex)
+        self.assertEqual(rsps[1]['payload']['data'], [])
@@ -0,0 +1,104 @@
+'''
+
+Transaction propagation benchmark
+
+Measures the cost of creating tasks and of looking up the transaction of the
+running task, with the TransactionTask factory installed in the loop (how
+transactions were propagated before contextvars) and without it, and the
+throughput of store inserts inside a transaction and of store reads.
+
+'''
+
+import argparse
+import asyncio
+import time
+from komlogd.api.common import timeuuid
+from komlogd.api.model import transactions
+from komlogd.api.model.metrics import Datapoint
+from komlogd.api.model.store import MetricStore
+from komlogd.api.model.transactions import Transaction, TransactionTask
+
+MODES = ('task_factory', 'contextvars')
+
+
+async def _noop():
+    pass
+
+async def _create_tasks(num_tasks, batch=1000):
+    for i in range(0, num_tasks, batch):
+        await asyncio.gather(*[asyncio.ensure_future(_noop()) for j in range(min(batch, num_tasks-i))])
+
+async def _lookups(mode, num_lookups):
+    if mode == 'task_factory':
+        for i in range(num_lookups):
+            asyncio.Task.current_task().get_tr()
+    else:
+        for i in range(num_lookups):
+            transactions.get_tr()
+
+async def _inserts(store, metric, num_ops):
+    for i in range(num_ops):
+        store.insert(metric, timeuuid.TimeUUID(t=i+1), i)
+
+async def _gets(store, metric, num_ops):
+    for i in range(num_ops):
+        await store.get(metric, t=timeuuid.TimeUUID(t=i+1))
+
+async def run_benchmark(mode, num_tasks=100000, num_lookups=100000, num_ops=1000, loop=None):
+    loop = loop or asyncio.get_event_loop()
+    if mode not in MODES:
+        raise ValueError('Invalid mode')
+    if mode == 'contextvars' and transactions.contextvars is None:
+        raise ValueError('contextvars not available')
+    factory = loop.get_task_factory()
+    loop.set_task_factory(transactions._task_factory if mode == 'task_factory' else None)
+    try:
+        start = time.perf_counter()
+        await _create_tasks(num_tasks)
+        tasks_elapsed = time.perf_counter()-start
+        store = MetricStore()
+        metric = Datapoint(uri='bench.metric')
+        async with Transaction(t=timeuuid.TimeUUID()) as tr:
+            start = time.perf_counter()
+            await TransactionTask(coro=_lookups(mode, num_lookups), tr=tr)
+            lookups_elapsed = time.perf_counter()-start
+            start = time.perf_counter()
+            await TransactionTask(coro=_inserts(store, metric, num_ops), tr=tr)
+            inserts_elapsed = time.perf_counter()-start
+        # reads outside transactions of a hooked metric are served from the store
+        await _inserts(store, metric, num_ops)
+        store._hooked.add(metric)
+        store._add_synced_range(metric, time.monotonic(), timeuuid.MIN_TIMEUUID, timeuuid.MAX_TIMEUUID)
+        start = time.perf_counter()
+        await _gets(store, metric, num_ops)
+        gets_elapsed = time.perf_counter()-start
+    finally:
+        loop.set_task_factory(factory)
+    return {
+        'mode':mode,
+        'tasks_per_second':num_tasks/tasks_elapsed if tasks_elapsed else None,
+        'lookup_ns':lookups_elapsed/num_lookups*1e9 if num_lookups else None,
+        'inserts_per_second':num_ops/inserts_elapsed if inserts_elapsed else None,
+        'gets_per_second':num_ops/gets_elapsed if gets_elapsed else None,
+    }
+
+def menu():
+    parser = argparse.ArgumentParser(description='komlogd transaction propagation benchmark')
+    parser.add_argument('-t','--tasks', required=False, type=int, default=100000, help='Number of tasks created')
+    parser.add_argument('-l','--lookups', required=False, type=int, default=100000, help='Number of transaction lookups')
+    parser.add_argument('-o','--ops', required=False, type=int, default=1000, help='Number of store inserts and reads')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = menu()
+    loop = asyncio.get_event_loop()
+    for mode in MODES:
+        if mode == 'contextvars' and transactions.contextvars is None:
+            print('{}: not available'.format(mode))
+            continue
+        result = loop.run_until_complete(run_benchmark(mode, num_tasks=args.tasks, num_lookups=args.lookups, num_ops=args.ops, loop=loop))
+        print('{}: tasks per second: {:.0f}, transaction lookup: {:.0f} ns, inserts per second: {:.0f}, gets per second: {:.0f}'.format(mode, result['tasks_per_second'], result['lookup_ns'], result['inserts_per_second'], result['gets_per_second']))
+
+if __name__ == '__main__':
+    main()
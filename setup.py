@@ -24,7 +24,8 @@ setup(
     test_suite = 'komlogd',
     entry_points = {
         'console_scripts': [
-            'komlogd = komlogd.main:main'
+            'komlogd = komlogd.main:main',
+            'komlogd-bench = komlogd.bench.runner:main'
         ],
     },
     classifiers=[